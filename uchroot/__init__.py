@@ -9,19 +9,19 @@ Based on: https://gist.github.com/cheshirekow/fe1451e245d1a0855ad3d1dca115aeca
 # subordinate UIDs.
 # https://lwn.net/Articles/532593/
 
+import collections
 import ctypes
 import errno
-import inspect
+import fcntl
 import logging
 import os
-import pprint
 import pwd
-import json
-import re
-import subprocess
 import sys
-import tempfile
-import textwrap
+import threading
+import time
+
+# NOTE(josh): modules which are only needed on some code paths are imported
+# where they are used, to keep the startup time of the command line tool down.
 
 VERSION = '0.1.4'
 
@@ -33,10 +33,53 @@ else:
 logger = logging.getLogger(__name__)
 
 
-def get_glibc():
+# Values of the glibc constants used by this module. Run dump_constants.py to
+# check them against the headers of the current system.
+GLIBC_CONSTANTS = {
+    "CLONE_NEWNS": 0x20000,
+    "CLONE_NEWPID": 0x20000000,
+    "CLONE_NEWUSER": 0x10000000,
+    "IN_ACCESS": 0x1,
+    "IN_ATTRIB": 0x4,
+    "IN_CLOEXEC": 0x80000,
+    "IN_CLOSE_NOWRITE": 0x10,
+    "IN_CLOSE_WRITE": 0x8,
+    "IN_CREATE": 0x100,
+    "IN_DELETE": 0x200,
+    "IN_DELETE_SELF": 0x400,
+    "IN_DONT_FOLLOW": 0x2000000,
+    "IN_IGNORED": 0x8000,
+    "IN_ISDIR": 0x40000000,
+    "IN_MODIFY": 0x2,
+    "IN_MOVED_FROM": 0x40,
+    "IN_MOVED_TO": 0x80,
+    "IN_MOVE_SELF": 0x800,
+    "IN_NONBLOCK": 0x800,
+    "IN_ONLYDIR": 0x1000000,
+    "IN_OPEN": 0x20,
+    "IN_Q_OVERFLOW": 0x4000,
+    "MNT_DETACH": 0x2,
+    "MS_BIND": 0x1000,
+    "MS_NODEV": 0x4,
+    "MS_NOEXEC": 0x8,
+    "MS_NOSUID": 0x2,
+    "MS_RDONLY": 0x1,
+    "MS_REC": 0x4000,
+    "MS_REMOUNT": 0x20,
+    "PR_SET_CHILD_SUBREAPER": 0x24,
+    "SFD_CLOEXEC": 0x80000,
+    "SFD_NONBLOCK": 0x800,
+    "SIG_BLOCK": 0x0,
+    "SIG_SETMASK": 0x2,
+    "SIG_UNBLOCK": 0x1,
+    "SI_KERNEL": 0x80,
+}
+
+
+def make_glibc():
   """
-  Return a ctypes wrapper around glibc. Only wraps functions needed by this
-  script.
+  Construct a new ctypes wrapper around glibc. Only wraps functions needed by
+  this script. Use `get_glibc()` to get the shared instance.
   """
 
   glibc = ctypes.CDLL('libc.so.6', use_errno=True)
@@ -53,6 +96,10 @@ def get_glibc():
   glibc.unshare.restype = ctypes.c_int
   glibc.unshare.argtypes = [ctypes.c_int]
 
+  # http://man7.org/linux/man-pages/man2/setns.2.html
+  glibc.setns.restype = ctypes.c_int
+  glibc.setns.argtypes = [ctypes.c_int, ctypes.c_int]
+
   # http://man7.org/linux/man-pages/man2/getpid.2.html
   glibc.getpid.restype = ctypes.c_int  # pid_t, int32_t on my system
   glibc.getpid.argtypes = []
@@ -73,6 +120,10 @@ def get_glibc():
                           ctypes.c_uint,  # unsigned long
                           ctypes.c_void_p]
 
+  # http://man7.org/linux/man-pages/man2/umount.2.html
+  glibc.umount2.restype = ctypes.c_int
+  glibc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+
   # http://man7.org/linux/man-pages/man2/inotify_init.2.html
   glibc.inotify_init.restype = ctypes.c_int
   glibc.inotify_init.argtypes = []
@@ -93,76 +144,351 @@ def get_glibc():
   glibc.signalfd.restype = ctypes.c_int
   glibc.signalfd.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
 
-  glibc.CLONE_NEWNS = 0x20000
-  glibc.CLONE_NEWUSER = 0x10000000
-  glibc.IN_ACCESS = 0x1
-  glibc.IN_ATTRIB = 0x4
-  glibc.IN_CLOEXEC = 0x80000
-  glibc.IN_CLOSE_NOWRITE = 0x10
-  glibc.IN_CLOSE_WRITE = 0x8
-  glibc.IN_CREATE = 0x100
-  glibc.IN_DELETE = 0x200
-  glibc.IN_DELETE_SELF = 0x400
-  glibc.IN_MODIFY = 0x2
-  glibc.IN_MOVED_FROM = 0x40
-  glibc.IN_MOVED_TO = 0x80
-  glibc.IN_MOVE_SELF = 0x800
-  glibc.IN_NONBLOCK = 0x800
-  glibc.IN_OPEN = 0x20
-  glibc.MS_BIND = 0x1000
-  glibc.MS_REC = 0x4000
-  glibc.SFD_CLOEXEC = 0x80000
-  glibc.SFD_NONBLOCK = 0x800
+  # http://man7.org/linux/man-pages/man2/sigprocmask.2.html
+  glibc.sigprocmask.restype = ctypes.c_int
+  glibc.sigprocmask.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p]
+
+  # http://man7.org/linux/man-pages/man2/syscall.2.html
+  glibc.syscall.restype = ctypes.c_long
+
+  # http://man7.org/linux/man-pages/man2/prctl.2.html
+  glibc.prctl.restype = ctypes.c_int
+  glibc.prctl.argtypes = [ctypes.c_int, ctypes.c_ulong, ctypes.c_ulong,
+                          ctypes.c_ulong, ctypes.c_ulong]
+
+  for key, value in GLIBC_CONSTANTS.items():
+    setattr(glibc, key, value)
 
   return glibc
 
 
+_GLIBC = None
+_GLIBC_LOCK = threading.Lock()
+
+
+def get_glibc():
+  """
+  Return the process-wide ctypes wrapper around glibc, constructing it on
+  first use. The library handle, function prototypes and constants are set up
+  exactly once and shared by all callers.
+  """
+  global _GLIBC  # pylint: disable=global-statement
+  if _GLIBC is None:
+    with _GLIBC_LOCK:
+      if _GLIBC is None:
+        _GLIBC = make_glibc()
+  return _GLIBC
+
+
+class TraceSpan(object):
+  """
+  Context manager which reports the beginning and end of one step to a
+  `Tracer`. If the step raises an `EnvironmentError`, or `fail()` is called,
+  the errno is reported with the end event.
+  """
+
+  def __init__(self, tracer, name, args=None):
+    self.tracer = tracer
+    self.name = name
+    self.args = args
+    self.err = None
+
+  def fail(self, err):
+    """Record that the step failed with the errno value `err`."""
+    self.err = err
+
+  def __enter__(self):
+    self.tracer.begin(self.name, time.monotonic(), os.getpid(), self.args)
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if self.err is None and isinstance(exc_value, EnvironmentError):
+      self.err = exc_value.errno
+    self.tracer.end(self.name, time.monotonic(), os.getpid(), self.err)
+    return False
+
+
+class Tracer(object):
+  """
+  Receives an event at the beginning and end of each step of building (or
+  joining) a jail, see `main()`, `set_userns_idmap()` and `enter()`.
+  Timestamps are seconds on the system-wide monotonic clock. Events are
+  delivered in whichever process performs the step, which is usually a forked
+  child that is about to exec, so a tracer must write its output somewhere
+  (e.g. a file) rather than keep it in memory.
+
+  This base class ignores all events.
+  """
+
+  def begin(self, name, timestamp, pid, args=None):
+    """Called when the step `name` begins. `args` is an optional dict."""
+
+  def end(self, name, timestamp, pid, err=None):
+    """Called when the step `name` ends. `err` is the errno if it failed."""
+
+  def span(self, name, args=None):
+    """Return a context manager which traces the step `name`."""
+    return TraceSpan(self, name, args)
+
+
+# Tracer used when none is given
+NULL_TRACER = Tracer()
+
+
+class ChromeTracer(Tracer):
+  """
+  Appends events to the file at `path` in the Chrome trace-event format (the
+  JSON array format, which does not need to be terminated), which can be
+  loaded into chrome://tracing or https://ui.perfetto.dev. Each event is
+  written with a single append, so any number of processes (e.g. every
+  invocation in a pipeline) can share one trace file.
+  """
+
+  def __init__(self, path):
+    import json
+
+    self.path = path
+    self._dumps = json.dumps
+    try:
+      self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT
+                        | os.O_EXCL, 0o644)
+      os.write(self.fd, b"[\n")
+    except OSError as ex:
+      if ex.errno != errno.EEXIST:
+        raise
+      self.fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+
+  def write_event(self, event):
+    os.write(self.fd, (self._dumps(event) + ",\n").encode("utf-8"))
+
+  def begin(self, name, timestamp, pid, args=None):
+    event = {"name": name, "ph": "B", "ts": timestamp * 1e6, "pid": pid,
+             "tid": pid}
+    if args:
+      event["args"] = args
+    self.write_event(event)
+
+  def end(self, name, timestamp, pid, err=None):
+    event = {"name": name, "ph": "E", "ts": timestamp * 1e6, "pid": pid,
+             "tid": pid}
+    if err is not None:
+      event["args"] = {"errno": err, "error": errno.errorcode.get(err, "??")}
+    self.write_event(event)
+
+  def close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+
+class SubidFile(object):
+  """
+  Parsed contents of a subordinate id file (/etc/subuid or /etc/subgid),
+  indexed by user name and by numeric uid.
+  """
+
+  def __init__(self, path, stamp, by_name, by_uid):
+    self.path = path
+    self.stamp = stamp
+    self.by_name = by_name
+    self.by_uid = by_uid
+
+  @classmethod
+  def parse(cls, path, stamp):
+    """
+    Parse the file at `path`. The index maps each key to
+    (lineno, (subid_min, subid_count)) of the first line it appears on.
+    """
+    by_name = {}
+    by_uid = {}
+    with open(path, 'r') as infile:
+      for lineno, line in enumerate(infile):
+        line = line.strip()
+        if not line or line.startswith('#'):
+          continue
+        subid_name, subid_min, subid_count = line.split(':')
+        entry = (lineno, (int(subid_min), int(subid_count)))
+        by_name.setdefault(subid_name, entry)
+        try:
+          by_uid.setdefault(int(subid_name), entry)
+        except ValueError:
+          pass
+    return cls(path, stamp, by_name, by_uid)
+
+  def lookup(self, username, uid):
+    """
+    Return the subid range for the given user, matching either the user name
+    or numeric uid, whichever appears first in the file. Returns None if
+    neither is present.
+    """
+    matches = [entry for entry in (self.by_name.get(username),
+                                   self.by_uid.get(uid))
+               if entry is not None]
+    if not matches:
+      return None
+    return min(matches)[1]
+
+
+# Cache of parsed subid files, keyed by path. Each entry is invalidated when
+# the file's mtime, size or inode changes.
+_SUBID_CACHE = {}
+_USERNAME_CACHE = {}
+_SUBID_CACHE_LOCK = threading.Lock()
+
+
+def _reset_locks_after_fork():
+  """
+  A fork() from a multi-threaded process may copy a lock that is held by
+  some other thread. Replace module locks in the child so that it can't
+  deadlock on them.
+  """
+  global _GLIBC_LOCK, _SUBID_CACHE_LOCK  # pylint: disable=global-statement
+  _GLIBC_LOCK = threading.Lock()
+  _SUBID_CACHE_LOCK = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+  getattr(os, "register_at_fork")(after_in_child=_reset_locks_after_fork)
+
+
+def get_subid_file(subid_path):
+  """Return the (cached) parsed `SubidFile` for subid_path."""
+  stat = os.stat(subid_path)
+  stamp = (stat.st_mtime, stat.st_size, stat.st_ino)
+  with _SUBID_CACHE_LOCK:
+    cached = _SUBID_CACHE.get(subid_path)
+    if cached is not None and cached.stamp == stamp:
+      return cached
+
+  parsed = SubidFile.parse(subid_path, stamp)
+  with _SUBID_CACHE_LOCK:
+    _SUBID_CACHE[subid_path] = parsed
+  return parsed
+
+
+def get_username(uid):
+  """Return the (cached) user name for uid."""
+  with _SUBID_CACHE_LOCK:
+    username = _USERNAME_CACHE.get(uid)
+  if username is None:
+    username = pwd.getpwuid(uid)[0]
+    with _SUBID_CACHE_LOCK:
+      _USERNAME_CACHE[uid] = username
+  return username
+
+
 def get_subid_range(subid_path, username, uid):
   """Return the subordinate user/group id and count for the given user."""
 
-  with open(subid_path, 'r') as subuid:
-    for line in subuid:
-      subuid_name, subuid_min, subuid_count = line.strip().split(':')
-      if subuid_name == username:
-        return (int(subuid_min), int(subuid_count))
+  subid_range = get_subid_file(subid_path).lookup(username, uid)
+  if subid_range is None:
+    raise ValueError("user {}({}) not found in subid file {}".format(
+        username, uid, subid_path))
+  return subid_range
 
-      try:
-        subuid_uid = int(subuid_name)
-        if subuid_uid == uid:
-          return (int(subuid_min), int(subuid_count))
-      except ValueError:
-        pass
 
-  raise ValueError("user {}({}) not found in subid file {}".format(
-      username, uid, subid_path))
+def has_idmap_bins():
+  """Return true if the setuid-root id map helpers are installed."""
+  return all(os.path.exists('/usr/bin/{}'.format(idmap_bin))
+             for idmap_bin in IDMAP_BINS)
+
+
+def resolve_idmap(idmap):
+  """Resolve an `idmap` mode of "auto" to either "single" or "subid"."""
+  if idmap is None:
+    idmap = 'auto'
+  if idmap not in IDMAP_MODES:
+    raise ValueError("idmap must be one of {}, not {}".format(
+        ", ".join(IDMAP_MODES), idmap))
+  if idmap != 'auto':
+    return idmap
+
+  if not has_idmap_bins():
+    return 'single'
+  try:
+    get_subid_ranges()
+  except (KeyError, ValueError, IOError, OSError):
+    return 'single'
+  return 'subid'
+
+
+def resolve_id_ranges(idmap, uid_range, gid_range):
+  """
+  Return (subid_ranges, uid_range, gid_range) for the given (resolved) idmap
+  mode, using the current user's subordinate ranges as the default.
+  subid_ranges is None if subordinate ids are not used.
+  """
+  if idmap != 'subid':
+    return None, uid_range, gid_range
+
+  subid_ranges = get_subid_ranges()
+  return (subid_ranges, get_default(uid_range, subid_ranges[0]),
+          get_default(gid_range, subid_ranges[1]))
+
+
+def get_subid_ranges(uid=None):
+  """
+  Return the pair (subuid_range, subgid_range) for the user `uid` (default:
+  the current user).
+  """
+  if uid is None:
+    uid = os.getuid()
+  username = get_username(uid)
+  return (get_subid_range('/etc/subuid', username, uid),
+          get_subid_range('/etc/subgid', username, uid))
 
 
-def write_id_map(id_map_path, id_outside, subid_range):
+# The setuid-root helper programs used to write a uid/gid map containing
+# subordinate ids.
+IDMAP_BINS = ['newuidmap', 'newgidmap']
+
+# Supported values for the `idmap` option:
+#  * "subid": map id 0 to the current user and ids starting at 1 to the user's
+#    subordinate range, using the setuid-root helpers.
+#  * "single": map only id 0 to the current user. The jailed process writes
+#    its own map so that no helper process or program is needed.
+#  * "auto": "subid" if the user has subordinate ids and the helpers are
+#    installed, otherwise "single".
+IDMAP_MODES = ['auto', 'single', 'subid']
+
+
+def write_id_map(id_map_path, id_outside):
   """
-  Write uid_map or gid_map.
-  NOTE(josh): doesn't work. We need CAP_SETUID (CAP_SETGID) in the *parent*
-  namespace to be allowed to do this. Evidently, that is why there the
-  setuid-root newuidmap/newgidmap programs exist.
+  Write uid_map or gid_map mapping the single id 0 to `id_outside`.
+  NOTE(josh): a process can only do this without CAP_SETUID (CAP_SETGID) in
+  the *parent* namespace if it maps exactly its own id. That is why the
+  setuid-root newuidmap/newgidmap programs exist for mapping subordinate ids.
   """
   with open(id_map_path, 'wb') as id_map:
     logger.debug("Writing : %s (fd=%d)", id_map_path, id_map.fileno())
     id_map.write("{id_inside} {id_outside} {count}\n".format(
-        id_inside=0, id_outside=id_outside, count=1))
-    id_map.write("{id_inside} {id_outside} {count}\n".format(
-        id_inside=1, id_outside=subid_range[0], count=subid_range[1]))
+        id_inside=0, id_outside=id_outside, count=1).encode("utf-8"))
 
 
-def write_setgroups(pid):
+def write_setgroups(pid, policy=b"allow"):
   setgroups_path = '/proc/{}/setgroups'.format(pid)
   with open(setgroups_path, 'wb') as setgroups:
     logger.debug("Writing : %s (fd=%d)", setgroups_path, setgroups.fileno())
     # NOTE(josh): was previously "deny", but apt-get calls this so we must
-    # allow it if we want to use apt-get. Look into this more.
-    setgroups.write(b"allow\n")
+    # allow it if we want to use apt-get. Look into this more. An unprivileged
+    # process must deny it before writing its own gid_map.
+    setgroups.write(policy + b"\n")
+
+
+def set_self_idmap(uid, gid):
+  """
+  Writes a single-id uid/gid map for the calling process, which must have
+  just unshared its user namespace.
+  """
+  write_id_map('/proc/self/uid_map', uid)
+  write_setgroups('self', b"deny")
+  write_id_map('/proc/self/gid_map', gid)
 
 
 def set_id_map(idmap_bin, pid, id_outside, subid_range):
   """Set uid_map or gid_map through subprocess calls."""
+  import subprocess
+
   logger.debug("Calling %s", idmap_bin)
   subprocess.check_call(['/usr/bin/{}'.format(idmap_bin), str(pid),
                          '0', str(id_outside), '1',
@@ -183,7 +509,8 @@ def make_sure_is_dir(need_dir, source):
       os.remove(need_dir)
     logger.warning("creating rootfs directory %s because it is "
                    " needed to bind mount %s.\n", need_dir, source)
-    os.makedirs(need_dir)
+    # NOTE: mountpoints may be prepared concurrently, see MountPlan.prepare()
+    os.makedirs(need_dir, exist_ok=True)
 
 
 def make_sure_is_file(need_path, source):
@@ -200,20 +527,503 @@ def make_sure_is_file(need_path, source):
       touchfile.write('# written by uchroot'.encode("utf-8"))
 
 
+# Supported values for the `qemu_mode` option:
+#  * "bind": bind-mount the interpreter read-only into the mount namespace of
+#    the jail. Falls back to "copy" if the mount fails. The mountpoint (an
+#    empty file, and its parent directories) is created in the rootfs if it
+#    is missing, and is left there for later jails.
+#  * "copy": copy the interpreter into the rootfs, unless an identical copy is
+#    already there.
+QEMU_MODES = ['bind', 'copy']
+
+# ioctl request to reflink a whole file, from <linux/fs.h>
+FICLONE = 0x40049409
+
+
+def copy_file_contents(source, dest):
+  """
+  Copy the contents of `source` to `dest` without staging them through
+  userspace buffers if possible. Tries, in order: reflink, copy_file_range,
+  sendfile, and finally a plain read/write loop.
+  """
+  with open(source, 'rb') as infile, open(dest, 'wb') as outfile:
+    in_fd = infile.fileno()
+    out_fd = outfile.fileno()
+    remaining = os.fstat(in_fd).st_size
+
+    try:
+      fcntl.ioctl(out_fd, FICLONE, in_fd)
+      return
+    except (IOError, OSError):
+      pass
+
+    for copy_fn in (getattr(os, 'copy_file_range', None),
+                    getattr(os, 'sendfile', None)):
+      if copy_fn is None:
+        continue
+      try:
+        while remaining > 0:
+          if copy_fn is os.sendfile:
+            count = copy_fn(out_fd, in_fd, None, remaining)
+          else:
+            count = copy_fn(in_fd, out_fd, remaining)
+          if count == 0:
+            break
+          remaining -= count
+        return
+      except OSError as ex:
+        if ex.errno not in (errno.EINVAL, errno.ENOSYS, errno.EXDEV,
+                            errno.EOPNOTSUPP):
+          raise
+        # Nothing has been written if the very first call fails
+        infile.seek(os.fstat(out_fd).st_size)
+
+    chunk = infile.read(1024 * 1024)
+    while chunk:
+      outfile.write(chunk)
+      chunk = infile.read(1024 * 1024)
+
+
+def copy_qemu(qemu, rootfs_dest):
+  """
+  Copy the qemu binary to `rootfs_dest` unless a file with identical content
+  is already there. The copy is written next to the destination and renamed
+  over it so that jails currently executing the old copy are unaffected.
+  """
+  import filecmp
+
+  if os.path.isfile(rootfs_dest) and filecmp.cmp(qemu, rootfs_dest,
+                                                 shallow=False):
+    logger.debug("%s is already installed", qemu)
+    return
+
+  logger.debug("Installing %s", qemu)
+  tmp_dest = "{}.uchroot-{}".format(rootfs_dest, os.getpid())
+  try:
+    copy_file_contents(qemu, tmp_dest)
+    os.chmod(tmp_dest, 0o755)
+    os.rename(tmp_dest, rootfs_dest)
+  except BaseException:
+    if os.path.lexists(tmp_dest):
+      os.remove(tmp_dest)
+    raise
+
+
+def bind_qemu(glibc, qemu, rootfs_dest):
+  """
+  Bind-mount the qemu binary read-only at `rootfs_dest`. Returns true on
+  success. Must be called from within the jail's mount namespace.
+
+  The binary itself is not copied, but if `rootfs_dest` doesn't exist an
+  empty placeholder file (and any missing parent directory) is created as the
+  mountpoint. It can't be removed while the jail uses it, so it stays in the
+  rootfs (and is reused by later jails). With a "tmpfs" overlay it is
+  created in the throwaway upper layer instead.
+  """
+  make_sure_is_file(rootfs_dest, qemu)
+
+  null_ptr = ctypes.POINTER(ctypes.c_char)()
+  result = glibc.mount(qemu.encode("utf-8"), rootfs_dest.encode("utf-8"),
+                       null_ptr, glibc.MS_BIND, null_ptr)
+  if result == -1:
+    err = ctypes.get_errno()
+    logger.warning('Failed to bind %s -> %s [%s](%d) %s', qemu, rootfs_dest,
+                   errno.errorcode.get(err, '??'), err, os.strerror(err))
+    return False
+
+  # NOTE: within a user namespace, a remount must preserve the nosuid, nodev
+  # and noexec flags of the source mount, or it will fail with EPERM.
+  flags = glibc.MS_BIND | glibc.MS_REMOUNT | glibc.MS_RDONLY
+  source_flags = os.statvfs(qemu).f_flag
+  for st_flag, ms_flag in ((os.ST_NOSUID, glibc.MS_NOSUID),
+                           (os.ST_NODEV, glibc.MS_NODEV),
+                           (getattr(os, 'ST_NOEXEC', 8), glibc.MS_NOEXEC)):
+    if source_flags & st_flag:
+      flags |= ms_flag
+  result = glibc.mount(null_ptr, rootfs_dest.encode("utf-8"), null_ptr,
+                       flags, null_ptr)
+  if result == -1:
+    err = ctypes.get_errno()
+    logger.debug('Failed to remount %s read-only [%s](%d) %s', rootfs_dest,
+                 errno.errorcode.get(err, '??'), err, os.strerror(err))
+  return True
+
+
+def install_qemu(glibc, rootfs, qemu, qemu_mode=None):
+  """Make the qemu binary available at the same path within the rootfs."""
+  qemu_mode = get_default(qemu_mode, 'bind')
+  if qemu_mode not in QEMU_MODES:
+    raise ValueError("qemu_mode must be one of {}, not {}".format(
+        ", ".join(QEMU_MODES), qemu_mode))
+
+  rootfs_dest = os.path.join(rootfs, qemu.lstrip('/'))
+  if qemu_mode == 'bind' and bind_qemu(glibc, qemu, rootfs_dest):
+    return
+
+  make_sure_is_dir(os.path.dirname(rootfs_dest), qemu)
+  copy_qemu(qemu, rootfs_dest)
+
+
+class BindMount(object):
+  """A single, normalized, mount operation of a `MountPlan`."""
+
+  # Kinds of mount
+  BIND = 'bind'
+  PROC = 'proc'
+  DEVPTS = 'devpts'
+
+  def __init__(self, source, dest, rootfs):
+    self.source = source
+    self.dest = dest
+    self.rootfs_dest = os.path.join(rootfs, dest)
+    self.is_dir = os.path.isdir(source)
+
+    if source.lstrip('/') == 'proc':
+      self.kind = self.PROC
+    elif source.lstrip('/') == 'dev/pts':
+      self.kind = self.DEVPTS
+    else:
+      self.kind = self.BIND
+
+    # Path of the mountpoint as seen before any of the plan's mounts are done
+    # (see MountPlan.prepare()).
+    self.host_dest = self.rootfs_dest
+
+  def __repr__(self):
+    return "{}:{}".format(self.source, self.dest)
+
+  def get_mount_args(self, glibc):
+    """Return the (source, target, fstype, flags) arguments to mount()."""
+    null_ptr = ctypes.POINTER(ctypes.c_char)()
+    if self.kind == self.PROC:
+      # NOTE(josh): user isn't allowed to mount proc without MS_REC, see
+      # https://stackoverflow.com/a/23435317
+      return (self.source.encode("utf-8"), self.rootfs_dest.encode("utf-8"),
+              b"proc", glibc.MS_REC | glibc.MS_BIND)
+    if self.kind == self.DEVPTS:
+      return (b"/dev/pts", self.rootfs_dest.encode("utf-8"), b"devpts", 0)
+
+    # NOTE(josh): MS_REC is needed if the source to bind contains mounted
+    # filesystems somewhere in it's subtree. Otherwise our unpriviledged
+    # mount namespace would be able to see tree's outside of it's
+    # namespace without permission.
+    # TODO(josh): we should probably warn if this is required. It is
+    # rather odd.
+    return (self.source.encode("utf-8"), self.rootfs_dest.encode("utf-8"),
+            null_ptr, glibc.MS_BIND | glibc.MS_REC)
+
+
+# Syscall numbers (the same on all architectures since linux 5.1) and flags
+# of the mount API of linux 5.2, from <asm-generic/unistd.h>,
+# <linux/mount.h> and <fcntl.h>
+SYS_OPEN_TREE = 428
+SYS_MOVE_MOUNT = 429
+OPEN_TREE_CLONE = 0x1
+OPEN_TREE_CLOEXEC = 0o2000000
+MOVE_MOUNT_F_EMPTY_PATH = 0x4
+AT_FDCWD = -100
+AT_RECURSIVE = 0x8000
+
+# Supported values for the `mount_api` of a `MountPlan`:
+#  * "mount": bind each path with mount(MS_BIND)
+#  * "open_tree": clone the bound trees, detached, with open_tree(), then
+#    attach them with move_mount() (linux >= 5.2, otherwise falls back to
+#    "mount"). NOTE: this is not faster on the kernels measured so far (see
+#    `python -m uchroot.benchmark binds`).
+MOUNT_APIS = ['mount', 'open_tree']
+
+# Number of detached trees held open at once by MountPlan.execute(), to stay
+# well within the open file limit
+OPEN_TREE_BATCH_SIZE = 256
+
+
+def prepare_mountpoint(mount):
+  """Create the mountpoint of a `BindMount` if it is missing."""
+  if mount.is_dir:
+    make_sure_is_dir(mount.host_dest, mount.source)
+  else:
+    make_sure_is_file(mount.host_dest, mount.source)
+
+
+def parse_bind_spec(bind_spec):
+  """
+  Return the (source, dest) pair for a bind spec, which may be a
+  (source, dest) pair, a "source:dest" string, or a single path to bind at
+  the same location in the rootfs.
+  """
+  if isinstance(bind_spec, (list, tuple)):
+    source, dest = bind_spec
+  elif ':' in bind_spec:
+    source, dest = bind_spec.split(':')
+  else:
+    source = bind_spec
+    dest = bind_spec
+  return source, dest
+
+
+class MountPlan(object):
+  """
+  The list of mounts to perform when entering a jail, compiled once from the
+  `binds` configuration. Bind specs are normalized, validated and
+  de-duplicated (if two binds target the same location, the later one wins)
+  and ordered so that parents are mounted before their children.
+  `prepare()` creates any missing mountpoints, after which `execute()` is
+  just a sequence of mount() calls, or of move_mount() calls depending on
+  the `mount_api` (see `MOUNT_APIS`).
+  """
+
+  def __init__(self, rootfs, binds=None, mount_api=None):
+    self.rootfs = rootfs
+    self.prepared = False
+    self.mount_api = get_default(mount_api, 'mount')
+    if self.mount_api not in MOUNT_APIS:
+      raise ValueError("mount_api must be one of {}, not {}".format(
+          ", ".join(MOUNT_APIS), self.mount_api))
+
+    by_dest = collections.OrderedDict()
+    for bind_spec in get_default(binds, []):
+      source, dest = parse_bind_spec(bind_spec)
+      if not os.path.exists(source):
+        raise ValueError(
+            "source directory to bind does not exist {}".format(source))
+      source = os.path.normpath(source)
+      dest = os.path.normpath('/' + dest).lstrip('/')
+      if dest in by_dest and by_dest[dest].source != source:
+        logger.warning("Bind of %s to %s replaces bind of %s", source, dest,
+                       by_dest[dest].source)
+      by_dest.pop(dest, None)
+      by_dest[dest] = BindMount(source, dest, rootfs)
+
+    # NOTE: sort is stable, so siblings remain in the configured order
+    self.mounts = sorted(by_dest.values(), key=lambda mount: (
+        len([part for part in mount.dest.split('/') if part])))
+
+    for idx, mount in enumerate(self.mounts):
+      # If the mountpoint lies within an earlier bind, then it must exist
+      # within the source of that bind.
+      for parent in reversed(self.mounts[:idx]):
+        if parent.kind == BindMount.BIND and mount.dest.startswith(
+            parent.dest.rstrip('/') + '/'):
+          mount.host_dest = os.path.join(
+              parent.source, os.path.relpath(mount.dest, parent.dest))
+          break
+
+  def __iter__(self):
+    return iter(self.mounts)
+
+  def __len__(self):
+    return len(self.mounts)
+
+  def prepare(self, jobs=None):
+    """
+    Create any missing mountpoints. This only needs to be done once, not on
+    every entry into the jail. If `jobs` is greater than one, the mountpoints
+    are checked (and created) by that many threads, which pays off when the
+    rootfs is on a high latency (e.g. network) filesystem.
+    """
+    if jobs is None or jobs <= 1:
+      for mount in self.mounts:
+        prepare_mountpoint(mount)
+    else:
+      import concurrent.futures
+
+      with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        for _ in executor.map(prepare_mountpoint, self.mounts):
+          pass
+    self.prepared = True
+
+  def open_trees(self, glibc, indices):
+    """
+    Clone the source trees of the bind mounts at `indices` of the plan with
+    open_tree(). Returns a dictionary mapping each index to the file
+    descriptor of its detached tree. Mounts which can't be cloned are left
+    out. Returns None if the kernel doesn't support open_tree().
+    """
+    flags = OPEN_TREE_CLONE | OPEN_TREE_CLOEXEC | AT_RECURSIVE
+    trees = {}
+    for idx in indices:
+      mount = self.mounts[idx]
+      if mount.kind != BindMount.BIND:
+        continue
+      tree_fd = glibc.syscall(ctypes.c_long(SYS_OPEN_TREE),
+                              ctypes.c_int(AT_FDCWD),
+                              ctypes.c_char_p(mount.source.encode("utf-8")),
+                              ctypes.c_uint(flags))
+      if tree_fd >= 0:
+        trees[idx] = tree_fd
+        continue
+      err = ctypes.get_errno()
+      # NOTE: seccomp filters (e.g. in containers) often deny unknown
+      # syscalls with EPERM rather than ENOSYS.
+      if err in (errno.ENOSYS, errno.EPERM):
+        for tree_fd in trees.values():
+          os.close(tree_fd)
+        return None
+      logger.debug("open_tree(%s) failed [%s], using mount()", mount.source,
+                   errno.errorcode.get(err, '??'))
+    return trees
+
+  def attach_tree(self, glibc, tree_fd, mount):
+    """Attach a tree detached by `open_trees()` at its mountpoint."""
+    try:
+      return glibc.syscall(ctypes.c_long(SYS_MOVE_MOUNT),
+                           ctypes.c_int(tree_fd), ctypes.c_char_p(b""),
+                           ctypes.c_int(AT_FDCWD),
+                           ctypes.c_char_p(mount.rootfs_dest.encode("utf-8")),
+                           ctypes.c_uint(MOVE_MOUNT_F_EMPTY_PATH))
+    finally:
+      os.close(tree_fd)
+
+  def execute(self, glibc, tracer=None):
+    """
+    Perform the mounts. Must be called from within the jail's mount
+    namespace, after `prepare()`. Each mount is traced to `tracer`. Bind
+    mounts which can't be attached with move_mount() fall back to mount().
+    """
+    tracer = get_default(tracer, NULL_TRACER)
+    timed = logger.isEnabledFor(logging.DEBUG)
+    null_ptr = ctypes.POINTER(ctypes.c_char)()
+    trees = {}
+    use_open_tree = self.mount_api == 'open_tree'
+    for idx, mount in enumerate(self.mounts):
+      if use_open_tree and idx % OPEN_TREE_BATCH_SIZE == 0:
+        # NOTE: the trees of a batch are cloned before any of them is
+        # attached. Sources are host paths, so this doesn't change what
+        # they resolve to.
+        batch = range(idx, min(idx + OPEN_TREE_BATCH_SIZE, len(self.mounts)))
+        with tracer.span("open_trees", {"count": len(batch)}):
+          trees = self.open_trees(glibc, batch)
+        if trees is None:
+          logger.debug("open_tree() is not supported, using mount()")
+          trees = {}
+          use_open_tree = False
+
+      if timed:
+        start = time.time()
+      with tracer.span("mount", {"dest": mount.dest}) as span:
+        tree_fd = trees.pop(idx, None)
+        if tree_fd is not None:
+          result = self.attach_tree(glibc, tree_fd, mount)
+        else:
+          source, target, fstype, flags = mount.get_mount_args(glibc)
+          result = glibc.mount(source, target, fstype, flags, null_ptr)
+        if result == -1:
+          span.fail(ctypes.get_errno())
+      if result == -1:
+        err = span.err
+        logger.warning('Failed to mount %s -> %s [%s](%d) %s',
+                       mount.source, mount.rootfs_dest,
+                       errno.errorcode.get(err, '??'), err,
+                       os.strerror(err))
+      elif timed:
+        logger.debug('Bound %s -> %s in %.1fus', mount.source,
+                     mount.rootfs_dest, (time.time() - start) * 1e6)
+
+
+def get_overlay_dirs(overlay):
+  """
+  Return the (upperdir, workdir) pair for a persistent `overlay` directory,
+  creating them if needed.
+  """
+  upperdir = os.path.join(overlay, 'upper')
+  workdir = os.path.join(overlay, 'work')
+  for need_dir in (upperdir, workdir):
+    if not os.path.isdir(need_dir):
+      os.makedirs(need_dir)
+  return upperdir, workdir
+
+
+def mount_overlay(glibc, rootfs, overlay):
+  """
+  Stack a writable layer over `rootfs`, which becomes the read-only lower
+  layer of an overlay mounted at the same location. Must be called from within
+  the jail's mount namespace.
+
+  If `overlay` is "tmpfs" the writable layer lives in a tmpfs that only
+  exists in the mount namespace, and changes are discarded when the jail
+  exits. Otherwise `overlay` is a directory in which the changes are
+  persisted (in the `upper` subdirectory).
+  """
+  import tempfile
+
+  null_ptr = ctypes.POINTER(ctypes.c_char)()
+  scratch = None
+  if overlay == 'tmpfs':
+    scratch = tempfile.mkdtemp(prefix='uchroot-overlay-')
+    result = glibc.mount(b"tmpfs", scratch.encode("utf-8"), b"tmpfs", 0,
+                         null_ptr)
+    if result == -1:
+      err = ctypes.get_errno()
+      os.rmdir(scratch)
+      raise OSError(err, "Failed to mount overlay tmpfs", scratch)
+    overlay = scratch
+
+  try:
+    upperdir, workdir = get_overlay_dirs(overlay)
+    for path in (rootfs, upperdir, workdir):
+      if ',' in path or ':' in path:
+        raise ValueError("overlay paths may not contain ',' or ':' ({})"
+                         .format(path))
+
+    options = "lowerdir={},upperdir={},workdir={}".format(
+        rootfs, upperdir, workdir)
+    logger.debug("Mounting overlay %s", options)
+    # NOTE: unprivileged overlay mounts need the userxattr option in order to
+    # store their metadata (e.g. that a directory was deleted and created
+    # again) in the user.* xattr namespace. Without it, a mount may succeed
+    # but fail to remove directories of the rootfs (EIO). Older kernels don't
+    # know the option.
+    for extra_options in (",userxattr", ""):
+      result = glibc.mount(b"overlay", rootfs.encode("utf-8"), b"overlay", 0,
+                           (options + extra_options).encode("utf-8"))
+      if result == 0:
+        break
+      err = ctypes.get_errno()
+    if result == -1:
+      raise OSError(err, "Failed to mount overlay", rootfs)
+  finally:
+    if scratch is not None:
+      # The overlay holds its own reference to the tmpfs. Detach it from the
+      # scratch directory so that the directory can be removed.
+      glibc.umount2(scratch.encode("utf-8"), glibc.MNT_DETACH)
+      os.rmdir(scratch)
+
+
+def get_mount_plan(rootfs, binds):
+  """
+  Return `binds` if it is already a `MountPlan`, otherwise compile and
+  prepare a plan for it.
+  """
+  if isinstance(binds, MountPlan):
+    return binds
+  plan = MountPlan(rootfs, binds)
+  plan.prepare()
+  return plan
+
+
 def enter(read_fd, write_fd, rootfs=None, binds=None, qemu=None, identity=None,
-          cwd=None):
+          cwd=None, qemu_mode=None, overlay=None, pid_namespace=False,
+          tracer=None):
   """
   Chroot into rootfs with a new user and mount namespace, then execute
-  the desired command.
+  the desired command. `read_fd` and `write_fd` (which may be the same
+  socket) connect us to the helper which writes our uid/gid map. If they are
+  None then there is no helper and we map our own (single) uid/gid. `binds`
+  may be a list of bind specs or a prepared `MountPlan`. If `overlay` is
+  given, the rootfs is mounted copy-on-write (see `mount_overlay()`). If
+  `pid_namespace` is true, a pid namespace is unshared for the children of
+  the calling process (see `start_pid_namespace()`). Each step is traced to
+  `tracer`.
   """
   # pylint: disable=too-many-locals,too-many-statements
 
-  if not binds:
+  if binds is None:
     binds = []
   if not identity:
     identity = [0, 0]
   if not cwd:
     cwd = '/'
+  tracer = get_default(tracer, NULL_TRACER)
 
   glibc = get_glibc()
   uid = glibc.getuid()
@@ -226,115 +1036,88 @@ def enter(read_fd, write_fd, rootfs=None, binds=None, qemu=None, identity=None,
 
   # First, unshare the user namespace and assume admin capability in the
   # new namespace
-  err = glibc.unshare(glibc.CLONE_NEWUSER)
-  if err != 0:
-    raise OSError(err, "Failed to unshared user namespace", None)
+  with tracer.span("unshare_user") as span:
+    err = glibc.unshare(glibc.CLONE_NEWUSER)
+    if err != 0:
+      span.fail(ctypes.get_errno())
+      raise OSError(err, "Failed to unshared user namespace", None)
 
   # write a uid/pid map
   pid = glibc.getpid()
   logger.debug("My pid: %d", pid)
 
-  # Notify the helper that we have created the new namespace, and we need
-  # it to set our uid/gid map
-  logger.debug("Waiting for helper to set my uid/gid map")
-  os.write(write_fd, b"#")
+  if write_fd is None:
+    # Identity-only jail, we can write our own map
+    with tracer.span("set_self_idmap"):
+      set_self_idmap(uid, gid)
+  else:
+    # Notify the helper that we have created the new namespace, and we need
+    # it to set our uid/gid map
+    logger.debug("Waiting for helper to set my uid/gid map")
+    with tracer.span("wait_for_helper"):
+      os.write(write_fd, b"#")
 
-  # Wait for the helper to finish setting our uid/gid map
-  os.read(read_fd, 1)
-  logger.debug("Helper has finished setting my uid/gid map")
+      # Wait for the helper to finish setting our uid/gid map
+      if not os.read(read_fd, 1):
+        raise OSError(errno.ECHILD, "Helper failed to set my uid/gid map")
+    logger.debug("Helper has finished setting my uid/gid map")
 
   # ---------------------------------------------------------------------
   #                     Create Mount Namespace
   # ---------------------------------------------------------------------
-  err = glibc.unshare(glibc.CLONE_NEWNS)
-  if err != 0:
-    logger.error('Failed to unshare mount namespace')
-
-  null_ptr = ctypes.POINTER(ctypes.c_char)()
-  for bind_spec in binds:
-    if isinstance(bind_spec, (list, tuple)):
-      source, dest = bind_spec
-    elif ':' in bind_spec:
-      source, dest = bind_spec.split(':')
-    else:
-      source = bind_spec
-      dest = bind_spec
-
-    dest = dest.lstrip('/')
-    rootfs_dest = os.path.join(rootfs, dest)
-    logger.debug('Binding: %s -> %s', source, rootfs_dest)
-    assert os.path.exists(source),\
-        "source directory to bind does not exist {}".format(source)
-
-    # Create the mountpoint if it is not already in the rootfs
-    if os.path.isdir(source):
-      make_sure_is_dir(rootfs_dest, source)
-    else:
-      make_sure_is_file(rootfs_dest, source)
-
-    if source.lstrip('/') == 'proc':
-      # NOTE(josh): user isn't allowed to mount proc without MS_REC, see
-      # https://stackoverflow.com/a/23435317
-      result = glibc.mount(source.encode("utf-8"),
-                           rootfs_dest.encode("utf-8"), b"proc",
-                           glibc.MS_REC | glibc.MS_BIND, null_ptr)
-    elif source.lstrip("/") == "dev/pts":
-      result = glibc.mount(b"/dev/pts",
-                           rootfs_dest.encode("utf-8"), b"devpts",
-                           0, null_ptr)
-    else:
-      # NOTE(josh): MS_REC is needed if the source to bind contains mounted
-      # filesystems somewhere in it's subtree. Otherwise our unpriviledged
-      # mount namespace would be able to see tree's outside of it's
-      # namespace without permission.
-      # TODO(josh): we should probably warn if this is required. It is
-      # rather odd.
-      result = glibc.mount(source.encode("utf-8"),
-                           rootfs_dest.encode("utf-8"), null_ptr,
-                           glibc.MS_BIND | glibc.MS_REC, null_ptr)
-    if result == -1:
-      err = ctypes.get_errno()
-      logger.warning('Failed to mount %s -> %s [%s](%d) %s',
-                     source, rootfs_dest,
-                     errno.errorcode.get(err, '??'), err,
-                     os.strerror(err))
+  with tracer.span("unshare_mount") as span:
+    err = glibc.unshare(glibc.CLONE_NEWNS)
+    if err != 0:
+      span.fail(ctypes.get_errno())
+      logger.error('Failed to unshare mount namespace')
+
+  # NOTE: this needs admin capability in the namespace, so it is done before
+  # assuming `identity`.
+  if pid_namespace:
+    with tracer.span("unshare_pid") as span:
+      err = glibc.unshare(glibc.CLONE_NEWPID)
+      if err != 0:
+        span.fail(ctypes.get_errno())
+        raise OSError(ctypes.get_errno(), "Failed to unshare pid namespace")
+
+  if overlay:
+    with tracer.span("mount_overlay"):
+      mount_overlay(glibc, rootfs, overlay)
+
+  get_mount_plan(rootfs, binds).execute(glibc, tracer)
 
   if qemu:
-    dest = qemu.lstrip('/')
-    rootfs_dest = os.path.join(rootfs, dest)
-    make_sure_is_dir(os.path.dirname(rootfs_dest), qemu)
-    logger.debug("Installing %s", qemu)
-    with open(rootfs_dest, 'wb') as outfile:
-      with open(qemu, 'rb') as infile:
-        chunk = infile.read(1024 * 4)
-        while chunk:
-          outfile.write(chunk)
-          chunk = infile.read(1024 * 4)
-
-    os.chmod(rootfs_dest, 0o755)
+    with tracer.span("install_qemu"):
+      install_qemu(glibc, rootfs, qemu, qemu_mode)
 
   # ---------------------------------------------------------------------
   #                             Chroot
   # ---------------------------------------------------------------------
 
   # Now chroot into the desired directory
-  err = glibc.chroot(rootfs.encode("utf-8"))
-  if err != 0:
-    logger.error("Failed to chroot")
-    raise OSError(err, "Failed to chroot", rootfs)
+  with tracer.span("chroot") as span:
+    err = glibc.chroot(rootfs.encode("utf-8"))
+    if err != 0:
+      span.fail(ctypes.get_errno())
+      logger.error("Failed to chroot")
+      raise OSError(err, "Failed to chroot", rootfs)
 
-  # Set the cwd
-  os.chdir(cwd)
+    # Set the cwd
+    os.chdir(cwd)
 
   # Now drop admin in our namespace. Drop gid first, since losing UID privelidge
   # will prevent us from dropping it second.
-  err = glibc.setresgid(identity[1], identity[1], identity[1])
-  if err:
-    logger.error("Failed to set gid")
+  with tracer.span("setresgid") as span:
+    err = glibc.setresgid(identity[1], identity[1], identity[1])
+    if err:
+      span.fail(ctypes.get_errno())
+      logger.error("Failed to set gid")
 
-  err = glibc.setresuid(identity[0], identity[0], identity[0])
-  if err != 0:
-    logger.error("Failed to set uid")
+  with tracer.span("setresuid") as span:
+    err = glibc.setresuid(identity[0], identity[0], identity[0])
+    if err != 0:
+      span.fail(ctypes.get_errno())
+      logger.error("Failed to set uid")
 
 
 def validate_id_range(requested_range, allowed_range):
@@ -355,67 +1138,300 @@ def validate_id_range(requested_range, allowed_range):
           allowed_range[1])
 
 
-def set_userns_idmap(chroot_pid, uid_range, gid_range):
-  """Writes uid/gid maps for the chroot process."""
+def set_userns_idmap(chroot_pid, uid_range, gid_range, subid_ranges=None,
+                     tracer=None):
+  """
+  Writes uid/gid maps for the chroot process. `subid_ranges` is the
+  (subuid_range, subgid_range) pair allowed for the current user. If it is not
+  provided it is looked up. Each step is traced to `tracer`.
+  """
+  tracer = get_default(tracer, NULL_TRACER)
   uid = os.getuid()
   gid = os.getgid()
-  username = pwd.getpwuid(uid)[0]
 
-  subuid_range = get_subid_range('/etc/subuid', username, uid)
+  if subid_ranges is None:
+    with tracer.span("get_subid_ranges"):
+      subid_ranges = get_subid_ranges(uid)
+  subuid_range, subgid_range = subid_ranges
+
   if uid_range:
     validate_id_range(uid_range, subuid_range)
   else:
     uid_range = subuid_range
 
-  subgid_range = get_subid_range('/etc/subgid', username, uid)
   if gid_range:
     validate_id_range(gid_range, subgid_range)
   else:
     gid_range = subgid_range
 
-  set_id_map('newuidmap', chroot_pid, uid, uid_range)
-  try:
-    write_setgroups(chroot_pid)
-  except IOError:
-    logger.exception("Failed to write setgroups")
-  set_id_map('newgidmap', chroot_pid, gid, gid_range)
+  with tracer.span("newuidmap"):
+    set_id_map('newuidmap', chroot_pid, uid, uid_range)
+  with tracer.span("setgroups"):
+    try:
+      write_setgroups(chroot_pid)
+    except IOError:
+      logger.exception("Failed to write setgroups")
+  with tracer.span("newgidmap"):
+    set_id_map('newgidmap', chroot_pid, gid, gid_range)
 
 
 def main(rootfs, binds=None, qemu=None, identity=None, uid_range=None,
-         gid_range=None, cwd=None):
+         gid_range=None, cwd=None, idmap=None, qemu_mode=None, overlay=None,
+         pid_namespace=False, subid_ranges=None, tracer=None):
   """Fork off a helper subprocess, enter the chroot jail. Wait for the helper
      to  call the setuid-root helper programs and configure the uid map of the
-     jail, then return."""
-
-  for idmap_bin in ['newuidmap', 'newgidmap']:
+     jail, then return. If the caller has already resolved the user's
+     (subuid_range, subgid_range) it may pass them as `subid_ranges`.
+
+     If `idmap` resolves to "single" then no helper is forked and the jail maps
+     only the current user to root. If `tracer` is given, it receives an event
+     at the beginning and end of each step (see `Tracer`). If `pid_namespace`
+     is true, the caller must then call `start_pid_namespace()`."""
+
+  tracer = get_default(tracer, NULL_TRACER)
+  if resolve_idmap(idmap) == 'single':
+    if identity and tuple(identity) != (0, 0):
+      raise ValueError("identity {} is not mapped when idmap is 'single'"
+                       .format(identity))
+    with tracer.span("enter"):
+      enter(None, None, rootfs, binds, qemu, identity, cwd, qemu_mode,
+            overlay, pid_namespace, tracer)
+    return
+
+  for idmap_bin in IDMAP_BINS:
     assert os.path.exists('/usr/bin/{}'.format(idmap_bin)), \
         "Missing required binary '{}'".format(idmap_bin)
 
-  # Pipes used to synchronize between the helper process and the chroot
-  # process. Could also use eventfd, but this is simpler because python
-  # already has os.pipe()
-  helper_read_fd, primary_write_fd = os.pipe()
-  primary_read_fd, helper_write_fd = os.pipe()
+  import socket
+
+  # A single (close-on-exec) socket pair is used to synchronize between the
+  # helper process and the chroot process. Each process closes the other's
+  # end, so a process which dies also wakes its peer.
+  primary_sock, helper_sock = socket.socketpair()
 
   parent_pid = os.getpid()
+  # NOTE: not a span, since both processes return from fork()
+  tracer.begin("fork_helper", time.monotonic(), parent_pid)
   child_pid = os.fork()
 
   if child_pid == 0:
-    # Wait for the primary to create its new namespace
-    os.read(helper_read_fd, 1)
-
-    # Set the uid/gid map using the setuid helper programs
-    set_userns_idmap(parent_pid, uid_range, gid_range)
-    # Inform the primary that we have finished setting its uid/gid map.
-    os.write(helper_write_fd, b'#')
+    exit_code = 1
+    try:
+      primary_sock.close()
+      # Wait for the primary to create its new namespace. If it went away
+      # instead, there is nothing to do.
+      if helper_sock.recv(1):
+        # Set the uid/gid map using the setuid helper programs
+        with tracer.span("set_userns_idmap"):
+          set_userns_idmap(parent_pid, uid_range, gid_range, subid_ranges,
+                           tracer)
+        # Inform the primary that we have finished setting its uid/gid map.
+        helper_sock.sendall(b'#')
+        exit_code = 0
+    except Exception:  # pylint: disable=broad-except
+      logger.exception("Failed to set the uid/gid map")
 
     # NOTE(josh): using sys.exit() will interfere with the interpreter in the
     # parent process.
     # see: https://docs.python.org/3/library/os.html#os._exit
-    os._exit(0)  # pylint: disable=protected-access
+    os._exit(exit_code)  # pylint: disable=protected-access
   else:
-    enter(primary_read_fd, primary_write_fd, rootfs, binds, qemu,
-          identity, cwd)
+    helper_sock.close()
+    helper_pidfd = open_pidfd(child_pid)
+    tracer.end("fork_helper", time.monotonic(), parent_pid)
+    try:
+      with tracer.span("enter"):
+        primary_fd = primary_sock.fileno()
+        enter(primary_fd, primary_fd, rootfs, binds, qemu,
+              identity, cwd, qemu_mode, overlay, pid_namespace, tracer)
+    finally:
+      primary_sock.close()
+      with tracer.span("reap_helper"):
+        reap_child(child_pid, helper_pidfd)
+
+
+def open_pidfd(pid):
+  """
+  Return a pidfd (which is close-on-exec) referring to the child `pid`, or
+  None if pidfds are not supported.
+  """
+  if not hasattr(os, "pidfd_open") or not hasattr(os, "P_PIDFD"):
+    return None
+  try:
+    return os.pidfd_open(pid)
+  except OSError:
+    return None
+
+
+def reap_child(pid, pidfd=None):
+  """
+  Wait for the child `pid` to exit. If `pidfd` (see `open_pidfd()`) is not
+  None then it is used to wait, and closed.
+  """
+  if pidfd is None:
+    os.waitpid(pid, 0)
+    return
+
+  try:
+    os.waitid(os.P_PIDFD, pidfd, os.WEXITED)
+  finally:
+    os.close(pidfd)
+
+
+# Signals which a supervisor passes on to the command it supervises. Signals
+# sent by the kernel (e.g. SIGINT from the terminal) are not passed on, since
+# they are sent to the whole process group, including the command.
+FORWARD_SIGNALS = ("SIGHUP", "SIGINT", "SIGQUIT", "SIGTERM", "SIGUSR1",
+                   "SIGUSR2", "SIGWINCH", "SIGALRM", "SIGCONT")
+
+
+class SignalfdSiginfo(ctypes.Structure):
+  """The beginning of a struct signalfd_siginfo (128 bytes in total)."""
+  _fields_ = [("ssi_signo", ctypes.c_uint32),
+              ("ssi_errno", ctypes.c_int32),
+              ("ssi_code", ctypes.c_int32)]
+
+
+# Size of a struct signalfd_siginfo
+SIGNALFD_SIGINFO_SIZE = 128
+
+
+def make_sigset(signums):
+  """Return a (glibc layout, 1024 bit) sigset_t containing `signums`."""
+  bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+  sigset = (ctypes.c_ulong * (1024 // bits))()
+  for signum in signums:
+    sigset[(signum - 1) // bits] |= 1 << ((signum - 1) % bits)
+  return sigset
+
+
+def get_supervised_signals():
+  """Return the signal numbers handled by `supervise()`."""
+  import signal
+
+  return [signal.SIGCHLD] + [getattr(signal, name) for name in FORWARD_SIGNALS]
+
+
+def block_signals(glibc, signums):
+  """Block `signums` and return the previous signal mask."""
+  old_mask = make_sigset([])
+  if glibc.sigprocmask(glibc.SIG_BLOCK, make_sigset(signums), old_mask) != 0:
+    raise OSError(ctypes.get_errno(), "Failed to block signals")
+  return old_mask
+
+
+def set_signal_mask(glibc, mask):
+  if glibc.sigprocmask(glibc.SIG_SETMASK, mask, None) != 0:
+    raise OSError(ctypes.get_errno(), "Failed to set signal mask")
+
+
+def set_child_subreaper(glibc):
+  """
+  Become the reaper of orphaned descendants, so that `supervise()` reaps them
+  instead of leaving them to the init process.
+  """
+  if glibc.prctl(glibc.PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) != 0:
+    raise OSError(ctypes.get_errno(), "Failed to become a child subreaper")
+
+
+def reap_children(pid):
+  """
+  Reap every child which has exited, without blocking. Returns the wait
+  status of `pid` if it is one of them, otherwise None.
+  """
+  status = None
+  while True:
+    try:
+      child_pid, child_status = os.waitpid(-1, os.WNOHANG)
+    except OSError as err:
+      if err.errno == errno.ECHILD:
+        return status
+      raise
+    if child_pid == 0:
+      return status
+    if child_pid == pid:
+      status = child_status
+
+
+def supervise(pid, glibc=None):
+  """
+  Forward signals to the child `pid` and reap it, and any other child (e.g.
+  orphaned descendants, see `set_child_subreaper()`), until `pid` exits.
+  Returns its exit code, or 128 + the signal number if it was killed. The
+  signals of `get_supervised_signals()` must have been blocked (see
+  `block_signals()`) since before `pid` was started, so that none are missed.
+  Waits on a signalfd, so it doesn't poll.
+  """
+  import signal
+
+  glibc = get_default(glibc, get_glibc())
+  signal_fd = glibc.signalfd(-1, make_sigset(get_supervised_signals()),
+                             glibc.SFD_CLOEXEC)
+  if signal_fd == -1:
+    raise OSError(ctypes.get_errno(), "Failed to create signalfd")
+
+  try:
+    while True:
+      data = os.read(signal_fd, 16 * SIGNALFD_SIGINFO_SIZE)
+      for offset in range(0, len(data), SIGNALFD_SIGINFO_SIZE):
+        siginfo = SignalfdSiginfo.from_buffer_copy(data, offset)
+        signum = siginfo.ssi_signo
+        if signum == signal.SIGCHLD:
+          # NOTE: SIGCHLD is not queued, one signal may stand for any number
+          # of exited children.
+          status = reap_children(pid)
+          if status is not None:
+            exit_code = os.waitstatus_to_exitcode(status)
+            if exit_code < 0:
+              return 128 - exit_code
+            return exit_code
+        elif siginfo.ssi_code != glibc.SI_KERNEL:
+          logger.debug("Forwarding signal %d to %d", signum, pid)
+          try:
+            os.kill(pid, signum)
+          except OSError as err:
+            if err.errno != errno.ESRCH:
+              raise
+  finally:
+    os.close(signal_fd)
+
+
+def fork_supervised(glibc):
+  """
+  Fork. The parent supervises the child (see `supervise()`) and exits with
+  its status. Returns in the child only.
+  """
+  pid = os.fork()
+  if pid == 0:
+    return
+
+  # NOTE: the supervisor never execs, so it would otherwise keep every
+  # descriptor it inherited open until the child exits, such as the exec
+  # status pipe of a subprocess.Popen() which is then blocked until then.
+  os.closerange(3, os.sysconf("SC_OPEN_MAX"))
+  exit_code = 1
+  try:
+    exit_code = supervise(pid, glibc)
+  except Exception:  # pylint: disable=broad-except
+    logger.exception("Failed to supervise %d", pid)
+  finally:
+    os._exit(exit_code)  # pylint: disable=protected-access
+
+
+def start_pid_namespace(glibc=None):
+  """
+  Start the init process of the pid namespace unshared by `enter()`, and
+  return in its child. The init process reaps every orphan of the namespace,
+  and it and the calling process forward signals to the child and exit with
+  its status. When it exits, the kernel kills whatever is left in the
+  namespace.
+  """
+  glibc = get_default(glibc, get_glibc())
+  old_mask = block_signals(glibc, get_supervised_signals())
+  # the first child is the init process of the namespace
+  fork_supervised(glibc)
+  fork_supervised(glibc)
+  set_signal_mask(glibc, old_mask)
 
 
 def process_environment(env_dict):
@@ -456,22 +1472,20 @@ def serialize(obj):
 class ConfigObject(object):
   """
   Provides simple serialization to a dictionary based on the assumption that
-  all args in the __init__() function are fields of this object.
+  all args in the __init__() function are fields of this object. Subclasses
+  list those args, in order, in `FIELDS`.
   """
 
+  FIELDS = ()
+
   @classmethod
   def get_field_names(cls):
     """
-    Return a list of field names, extracted from kwargs to __init__().
+    Return a list of field names, the kwargs to __init__().
     The order of fields in the tuple representation is the same as the order
     of the fields in the __init__ function
     """
-    # NOTE(josh): args[0] is `self`
-    if sys.version_info >= (3, 5, 0):
-      sig = getattr(inspect, 'signature')(cls.__init__)
-      return [field for field, _ in list(sig.parameters.items())[1:-1]]
-
-    return getattr(inspect, 'getargspec')(cls.__init__).args[1:]
+    return list(cls.FIELDS)
 
   def as_dict(self):
     """
@@ -492,12 +1506,38 @@ def get_default(obj, default):
   return obj
 
 
+def is_snapshot_id(string):
+  """
+  Return true if `string` looks like the id (or an unambiguous prefix of the
+  id) of a snapshot in a `uchroot.snapshot.SnapshotStore`.
+  """
+  return (12 <= len(string) <= 64
+          and all(char in "0123456789abcdef" for char in string))
+
+
+def resolve_rootfs(rootfs, overlay):
+  """
+  If `rootfs` is not a path but the id of a snapshot in the default snapshot
+  store, return the path of the snapshot and the overlay to mount over it:
+  "tmpfs" unless `overlay` is given, since a snapshot must not be modified.
+  Otherwise return `rootfs` and `overlay` unchanged.
+  """
+  if (rootfs is None or os.path.exists(rootfs)
+      or not is_snapshot_id(rootfs)):
+    return rootfs, overlay
+
+  from uchroot import snapshot
+  return snapshot.SnapshotStore().open(rootfs), get_default(overlay, 'tmpfs')
+
+
 class Exec(ConfigObject):
   """
   Simple object to hold together the path, argument vector, and environment
   of an exec call.
   """
 
+  FIELDS = ("exbin", "argv", "env")
+
   def __init__(self, exbin=None, argv=None, env=None,
                **_):  # pylint: disable=W0613
     logger.debug("Exec({}, {}, {})".format(exbin, argv, env))
@@ -529,10 +1569,44 @@ class Exec(ConfigObject):
 
     return os.execvpe(self.exbin, self.argv, self.env)
 
-  def subprocess(self, preexec_fn=None):
+  def subprocess(self, preexec_fn=None, supervisor=False):
+    """
+    Run the command in a subprocess and return its exit code, or 128 + the
+    signal number if it was killed.
+
+    If `supervisor` is true, this process becomes the reaper of orphaned
+    descendants and `supervise()`s the command until it exits. This reaps
+    every child of this process, and the subreaper setting is kept, so it is
+    meant for a process which does nothing else (the command line tool).
+    """
+    import subprocess
+
     logger.debug('Subprocessing %s', self.exbin)
-    return subprocess.call(self.argv, executable=self.exbin, env=self.env,
-                           preexec_fn=preexec_fn)
+    if not supervisor:
+      proc = subprocess.Popen(self.argv, executable=self.exbin, env=self.env,
+                              preexec_fn=preexec_fn)
+      exit_code = proc.wait()
+      if exit_code < 0:
+        return 128 - exit_code
+      return exit_code
+
+    glibc = get_glibc()
+    set_child_subreaper(glibc)
+    old_mask = block_signals(glibc, get_supervised_signals())
+
+    def child_preexec_fn():
+      if preexec_fn is not None:
+        preexec_fn()
+      set_signal_mask(glibc, old_mask)
+
+    try:
+      proc = subprocess.Popen(self.argv, executable=self.exbin, env=self.env,
+                              preexec_fn=child_preexec_fn)
+      # NOTE: the child is reaped by supervise(), not by Popen
+      proc.returncode = supervise(proc.pid, glibc)
+    finally:
+      set_signal_mask(glibc, old_mask)
+    return proc.returncode
 
 
 class Main(ConfigObject):
@@ -540,6 +1614,10 @@ class Main(ConfigObject):
   Simple bind for subprocess prexec_fn.
   """
 
+  FIELDS = ("rootfs", "binds", "qemu", "identity", "uid_range", "gid_range",
+            "cwd", "idmap", "qemu_mode", "overlay", "pid_namespace",
+            "extra_preexec_fn")
+
   def __init__(self,
                rootfs=None,
                binds=None,
@@ -548,36 +1626,369 @@ class Main(ConfigObject):
                uid_range=None,
                gid_range=None,
                cwd=None,
+               idmap=None,
+               qemu_mode=None,
+               overlay=None,
+               pid_namespace=None,
                extra_preexec_fn=None,
+               tracer=None,
                **_):  # pylint: disable=W0613
-    self.rootfs = rootfs
+    self.rootfs, self.overlay = resolve_rootfs(rootfs, overlay)
     self.binds = get_default(binds, [])
     self.qemu = qemu
+    self.qemu_mode = get_default(qemu_mode, 'bind')
     self.identity = get_default(identity, (0, 0))
 
-    uid = os.getuid()
-    username = pwd.getpwuid(uid)[0]
-    self.uid_range = get_default(
-        uid_range, get_subid_range('/etc/subuid', username, uid))
-    self.gid_range = get_default(
-        gid_range, get_subid_range('/etc/subgid', username, uid))
+    self.idmap = get_default(idmap, 'auto')
+    self.uid_range = uid_range
+    self.gid_range = gid_range
+    self.subid_ranges = None
     self.cwd = get_default(cwd, '/')
+    self.pid_namespace = get_default(pid_namespace, False)
     self.extra_preexec_fn = extra_preexec_fn
+    self.tracer = tracer
+
+  def resolve_ids(self):
+    """
+    Resolve the idmap mode and the default uid/gid ranges. This may read the
+    subordinate id files so it is deferred until the ids are needed.
+    """
+    if self.subid_ranges is None and self.idmap != "single":
+      self.idmap = resolve_idmap(self.idmap)
+      self.subid_ranges, self.uid_range, self.gid_range = resolve_id_ranges(
+          self.idmap, self.uid_range, self.gid_range)
 
   def __call__(self):
+    self.resolve_ids()
     kwargs = self.as_dict()
     kwargs.pop("extra_preexec_fn", None)
+    kwargs["subid_ranges"] = self.subid_ranges
+    kwargs["tracer"] = self.tracer
+    if self.pid_namespace:
+      # NOTE: the supervisors run in the jail, where the python standard
+      # library may not be available, so import what they need now.
+      get_supervised_signals()
     main(**kwargs)
+    if self.pid_namespace:
+      start_pid_namespace()
     if self.extra_preexec_fn is not None:
       self.extra_preexec_fn()
 
 
+# Supported values for the `spawn_mode` option of a `Container`:
+#  * "preexec": the jail is built (or a zygote joined) by a python preexec_fn
+#    in the forked child.
+#  * "nsenter": the child execs nsenter to join the container's zygote. There
+#    is no preexec_fn, so python can spawn the child with vfork(), and the
+#    cost of a spawn does not grow with the size of the parent process.
+SPAWN_MODES = ['preexec', 'nsenter']
+
+# The program used to join a zygote in the "nsenter" spawn mode
+NSENTER_BIN = 'nsenter'
+
+
+def find_program(name):
+  """
+  Return the absolute path of the program `name` found in the PATH of this
+  process.
+  """
+  for dirpath in os.get_exec_path():
+    path = os.path.join(dirpath, name)
+    if os.access(path, os.X_OK):
+      return path
+  raise OSError(errno.ENOENT, "Missing required binary", name)
+
+
+class Zygote(object):
+  """
+  A long-lived process that builds the jail (user namespace, id maps, mount
+  namespace, binds and chroot) exactly once and then parks. Subsequent
+  commands join the prepared jail with setns() instead of rebuilding it.
+
+  The zygote itself remains root within the namespace. Each joining process
+  assumes the requested identity on its own.
+  """
+
+  # NOTE: the hold pipes of all live zygotes. A forked zygote inherits them
+  # and must close them, otherwise it keeps its siblings alive after they are
+  # released. Forks are serialized so that no pipe escapes this set.
+  _hold_fds = set()
+  _spawn_lock = threading.Lock()
+
+  def __init__(self, main_kwargs):
+    self.main_kwargs = dict(main_kwargs)
+    self.main_kwargs["identity"] = (0, 0)
+    self.pid = None
+    self.userns_fd = None
+    self.mntns_fd = None
+    self.root_fd = None
+    self._hold_fd = None
+
+  def start(self):
+    """Fork the zygote process and wait for it to finish building the jail."""
+    self.attach(self.spawn())
+
+  def spawn(self):
+    """
+    Fork the zygote process and return a file descriptor which becomes
+    readable when the zygote has finished building the jail. Pass it to
+    `attach()` to complete startup.
+    """
+    with Zygote._spawn_lock:
+      ready_read_fd, ready_write_fd = os.pipe()
+      hold_read_fd, hold_write_fd = os.pipe()
+      child_pid = os.fork()
+      if child_pid == 0:
+        self._run_child(ready_read_fd, ready_write_fd, hold_read_fd,
+                        hold_write_fd)
+
+      os.close(ready_write_fd)
+      os.close(hold_read_fd)
+      Zygote._hold_fds.add(hold_write_fd)
+    self.pid = child_pid
+    self._hold_fd = hold_write_fd
+    return ready_read_fd
+
+  def _run_child(self, ready_read_fd, ready_write_fd, hold_read_fd,
+                 hold_write_fd):
+    """Body of the forked zygote process. Does not return."""
+    exit_code = 1
+    try:
+      for fd in Zygote._hold_fds | set([ready_read_fd, hold_write_fd]):
+        os.close(fd)
+      main(**self.main_kwargs)
+      os.write(ready_write_fd, b"#")
+      os.close(ready_write_fd)
+
+      # Park until the owner closes its end of the hold pipe (or dies)
+      os.read(hold_read_fd, 1)
+      exit_code = 0
+    except Exception:  # pylint: disable=broad-except
+      logger.exception("Zygote failed to prepare the jail")
+    os._exit(exit_code)  # pylint: disable=protected-access
+
+  def attach(self, ready_fd):
+    """
+    Wait for the zygote to signal `ready_fd` (returned by `spawn()`), then
+    open its namespaces and root directory.
+    """
+    try:
+      ready = os.read(ready_fd, 1)
+    finally:
+      os.close(ready_fd)
+    if not ready:
+      self.stop()
+      raise OSError(errno.ECHILD, "Zygote failed to prepare the jail")
+
+    proc_dir = "/proc/{}".format(self.pid)
+    self.userns_fd = os.open(os.path.join(proc_dir, "ns/user"), os.O_RDONLY)
+    self.mntns_fd = os.open(os.path.join(proc_dir, "ns/mnt"), os.O_RDONLY)
+    self.root_fd = os.open(os.path.join(proc_dir, "root"), os.O_RDONLY)
+    logger.debug("Zygote %d is ready", self.pid)
+
+  def stop(self):
+    """Release the zygote and wait for it to exit."""
+    self.release()
+    self.wait()
+
+  def release(self):
+    """
+    Close our handles on the zygote, which tells it to exit. Processes that
+    have already joined the jail are not affected.
+    """
+    for attrname in ("userns_fd", "mntns_fd", "root_fd", "_hold_fd"):
+      fd = getattr(self, attrname)
+      if fd is not None:
+        with Zygote._spawn_lock:
+          Zygote._hold_fds.discard(fd)
+          os.close(fd)
+        setattr(self, attrname, None)
+
+  def wait(self):
+    """Wait for a released zygote to exit."""
+    if self.pid is not None:
+      os.waitpid(self.pid, 0)
+      self.pid = None
+
+  def is_running(self):
+    return self.pid is not None
+
+  def get_nsenter_argv(self, identity, cwd):
+    """
+    Return the prefix of a command line which runs a command in the zygote's
+    jail with `identity` and working directory `cwd` using nsenter.
+    """
+    # NOTE: nsenter opens the --wd directory before it enters the jail, so we
+    # name it through the zygote's root.
+    workdir = os.path.join("/proc/{}/root".format(self.pid), cwd.lstrip("/"))
+    return [find_program(NSENTER_BIN), "--target", str(self.pid), "--user",
+            "--mount", "--root", "--wd=" + workdir,
+            "--setuid", str(identity[0]), "--setgid", str(identity[1]), "--"]
+
+  def join(self, identity, cwd, tracer=None):
+    """
+    Join the zygote's namespaces and root directory, then assume `identity`.
+    Must be called from a single-threaded process (e.g. as a preexec_fn).
+    Each step is traced to `tracer`.
+    """
+    tracer = get_default(tracer, NULL_TRACER)
+    glibc = get_glibc()
+
+    with tracer.span("setns_user"):
+      if glibc.setns(self.userns_fd, glibc.CLONE_NEWUSER) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, "Failed to join user namespace", None)
+    with tracer.span("setns_mount"):
+      if glibc.setns(self.mntns_fd, glibc.CLONE_NEWNS) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, "Failed to join mount namespace", None)
+
+    with tracer.span("chroot"):
+      os.fchdir(self.root_fd)
+      if glibc.chroot(b".") != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, "Failed to chroot", None)
+      os.chdir(cwd)
+
+    with tracer.span("setresgid") as span:
+      err = glibc.setresgid(identity[1], identity[1], identity[1])
+      if err:
+        span.fail(ctypes.get_errno())
+        logger.error("Failed to set gid")
+
+    with tracer.span("setresuid") as span:
+      err = glibc.setresuid(identity[0], identity[0], identity[0])
+      if err != 0:
+        span.fail(ctypes.get_errno())
+        logger.error("Failed to set uid")
+
+
+class Join(object):
+  """
+  Simple bind for subprocess preexec_fn which enters the jail held by a
+  `Zygote`.
+  """
+
+  def __init__(self, zygote, identity, cwd, extra_preexec_fn=None,
+               tracer=None):
+    self.zygote = zygote
+    self.identity = identity
+    self.cwd = cwd
+    self.extra_preexec_fn = extra_preexec_fn
+    self.tracer = get_default(tracer, NULL_TRACER)
+
+  def __call__(self):
+    with self.tracer.span("join"):
+      self.zygote.join(self.identity, self.cwd, self.tracer)
+    if self.extra_preexec_fn is not None:
+      self.extra_preexec_fn()
+
+
+# Result of one command of a batch run by Container.run_many()
+# (`usage` is None unless the container accounts usage)
+CommandResult = collections.namedtuple(
+    "CommandResult",
+    ["index", "args", "returncode", "stdout", "stderr", "usage"])
+
+
+def run_captured(start_next, release=None):
+  """
+  Run a batch of commands with their stdout and stderr captured.
+  `start_next(num_running)` starts the next command and returns its `Popen`
+  (with stdout and stderr piped) and some `data`, or returns None if no
+  command can start yet. The batch ends when nothing is running and
+  `start_next()` returns None.
+
+  Yields (proc, data, returncode, stdout, stderr) for each command as it
+  finishes. `release(data)` is called once a command has been reaped,
+  including the commands killed when the generator is closed early.
+  """
+  import selectors
+
+  running = {}
+  selector = selectors.DefaultSelector()
+  try:
+    while True:
+      started = start_next(len(running))
+      while started is not None:
+        proc, data = started
+        running[proc] = (data, [], [])
+        selector.register(proc.stdout, selectors.EVENT_READ,
+                          (proc, running[proc][1]))
+        selector.register(proc.stderr, selectors.EVENT_READ,
+                          (proc, running[proc][2]))
+        started = start_next(len(running))
+      if not running:
+        return
+
+      for key, _ in selector.select():
+        proc, chunks = key.data
+        chunk = os.read(key.fd, 0x10000)
+        if chunk:
+          chunks.append(chunk)
+          continue
+
+        selector.unregister(key.fileobj)
+        key.fileobj.close()
+        if proc.stdout.closed and proc.stderr.closed:
+          data, stdout_chunks, stderr_chunks = running.pop(proc)
+          returncode = proc.wait()
+          if release is not None:
+            release(data)
+          yield (proc, data, returncode, b"".join(stdout_chunks),
+                 b"".join(stderr_chunks))
+  finally:
+    for proc, (data, _, _) in running.items():
+      proc.kill()
+      proc.wait()
+      if release is not None:
+        release(data)
+    selector.close()
+
+
 class Container(ConfigObject):
   """
   Simple object to maintain the configuration of a chroot between subprocess
   calls. Has the same interface as the subprocess module.
+
+  If `zygote` is true, the jail is built once by a long-lived `Zygote` process
+  and each command joins it rather than rebuilding it. Note that in this mode
+  all commands share one mount namespace. Call `close()` (or use the container
+  as a context manager) to release the zygote.
+
+  If `tracer` is given, it receives an event at the beginning and end of each
+  step of entering the jail (see `Tracer` and `ChromeTracer`).
+
+  `rootfs` may also be the id of a snapshot (see `uchroot.snapshot`), which is
+  entered through a copy-on-write `overlay` ("tmpfs" by default).
+
+  `spawn_mode` selects how a command enters the jail (see `SPAWN_MODES`).
+  The "nsenter" mode implies `zygote`. In this mode `preexec_fn` and
+  `executable` are not supported.
+
+  If `track_changes` is true, the files of the rootfs which each `call()`,
+  `check_call()` or `check_output()` created, modified or deleted are stored
+  in `last_changes` as a `uchroot.changes.ChangeSet`. Tracked commands run
+  one at a time. Commands started otherwise are not tracked. This requires
+  no overlay or a persistent one.
+
+  If `track_usage` is true, or `cgroup` is given, the resources used by each
+  command are stored as a `uchroot.usage.Usage` in the `usage` of its Popen
+  (and of its `run_many()` result) and in `last_usage`, once it is reaped.
+  With `cgroup`, the path of a delegated cgroup v2 directory, the commands
+  run in a cgroup created for the container, limited by `cgroup_limits`,
+  each in a cgroup of its own. Commands started with asyncio are not
+  accounted.
   """
 
+  FIELDS = ("rootfs", "binds", "qemu", "identity", "uid_range", "gid_range",
+            "cwd", "idmap", "qemu_mode", "overlay", "zygote", "spawn_mode",
+            "track_changes", "track_usage", "cgroup", "cgroup_limits")
+
+  # Fields which configure the container rather than the jail
+  CONTAINER_FIELDS = ("zygote", "spawn_mode", "track_changes", "track_usage",
+                      "cgroup", "cgroup_limits")
+
   def __init__(self,
                rootfs=None,
                binds=None,
@@ -586,27 +1997,243 @@ class Container(ConfigObject):
                uid_range=None,
                gid_range=None,
                cwd=None,
+               idmap=None,
+               qemu_mode=None,
+               overlay=None,
+               zygote=False,
+               spawn_mode=None,
+               track_changes=False,
+               track_usage=False,
+               cgroup=None,
+               cgroup_limits=None,
+               tracer=None,
                **_):  # pylint: disable=W0613
-    self.rootfs = rootfs
+    self.rootfs, self.overlay = resolve_rootfs(rootfs, overlay)
     self.binds = get_default(binds, [])
     self.qemu = qemu
+    self.qemu_mode = get_default(qemu_mode, 'bind')
     self.identity = get_default(identity, (0, 0))
 
-    uid = os.getuid()
-    username = pwd.getpwuid(uid)[0]
-    self.uid_range = get_default(
-        uid_range, get_subid_range('/etc/subuid', username, uid))
-    self.gid_range = get_default(
-        gid_range, get_subid_range('/etc/subgid', username, uid))
+    self.idmap = get_default(idmap, 'auto')
+    self.uid_range = uid_range
+    self.gid_range = gid_range
+    self.subid_ranges = None
     self.cwd = get_default(cwd, '/')
+    self.spawn_mode = get_default(spawn_mode, 'preexec')
+    if self.spawn_mode not in SPAWN_MODES:
+      raise ValueError("spawn_mode must be one of {}, not {}".format(
+          ", ".join(SPAWN_MODES), self.spawn_mode))
+    self.zygote = zygote or self.spawn_mode == 'nsenter'
+    if track_changes and self.overlay == 'tmpfs':
+      raise ValueError("track_changes is not supported with overlay='tmpfs'")
+    self.track_changes = track_changes
+    self.last_changes = None
+    if cgroup is not None and self.spawn_mode == 'nsenter':
+      raise ValueError("cgroup is not supported with spawn_mode='nsenter'")
+    self.track_usage = track_usage or cgroup is not None
+    self.cgroup = cgroup
+    self.cgroup_limits = cgroup_limits
+    self.last_usage = None
+    self.tracer = tracer
+    self._zygote = None
+    self._zygote_lock = threading.Lock()
+    self._mount_plan = None
+    self._mount_plan_lock = threading.Lock()
+    self._change_tracker = None
+    self._change_tracker_lock = threading.Lock()
+    self._jail_cgroup = None
+    self._jail_cgroup_lock = threading.Lock()
+
+  def resolve_ids(self):
+    """
+    Resolve the idmap mode and the default uid/gid ranges. This may read the
+    subordinate id files so it is deferred until the ids are needed.
+    """
+    if self.subid_ranges is None and self.idmap != "single":
+      self.idmap = resolve_idmap(self.idmap)
+      self.subid_ranges, self.uid_range, self.gid_range = resolve_id_ranges(
+          self.idmap, self.uid_range, self.gid_range)
+
+  def get_mount_plan(self):
+    """
+    Return the `MountPlan` for this container's binds, compiling and
+    preparing it on first use.
+    """
+    with self._mount_plan_lock:
+      if self._mount_plan is None:
+        self._mount_plan = get_mount_plan(self.rootfs, self.binds)
+      return self._mount_plan
+
+  def get_jail_cgroup(self):
+    """
+    Return the `uchroot.usage.JailCgroup` of this container (created with
+    the first command), or None if `cgroup` is not set.
+    """
+    if self.cgroup is None:
+      return None
+    from uchroot import usage
+
+    with self._jail_cgroup_lock:
+      if self._jail_cgroup is None:
+        self._jail_cgroup = usage.JailCgroup(self.cgroup, self.cgroup_limits)
+      return self._jail_cgroup
+
+  def _get_jail_args(self):
+    """Return the configuration of the jail, without the container fields."""
+    kwargs = self.as_dict()
+    for key in self.CONTAINER_FIELDS:
+      kwargs.pop(key, None)
+    return kwargs
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def make_zygote(self, start=True):
+    """
+    Return a new zygote for this container's configuration, started unless
+    `start` is false.
+    """
+    self.resolve_ids()
+    kwargs = self._get_jail_args()
+    kwargs["binds"] = self.get_mount_plan()
+    kwargs["subid_ranges"] = self.subid_ranges
+    kwargs["tracer"] = self.tracer
+    zygote = Zygote(kwargs)
+    if start:
+      zygote.start()
+    return zygote
+
+  def get_zygote(self):
+    """Return the running zygote for this container, starting it if needed."""
+    with self._zygote_lock:
+      if self._zygote is None:
+        self._zygote = self.make_zygote()
+      return self._zygote
+
+  def peek_zygote(self):
+    """Return the running zygote for this container, or None if it has none."""
+    with self._zygote_lock:
+      return self._zygote
+
+  def adopt_zygote(self, zygote):
+    """
+    Use the started `zygote` as this container's zygote, unless it already
+    has one. Returns the container's zygote. If `zygote` was not adopted, it
+    is the caller's responsibility to stop it.
+    """
+    with self._zygote_lock:
+      if self._zygote is None:
+        self._zygote = zygote
+      return self._zygote
+
+  def close(self):
+    """
+    Stop the zygote, if one is running, and the change tracker, and remove
+    the container's cgroup.
+    """
+    with self._zygote_lock:
+      if self._zygote is not None:
+        self._zygote.stop()
+        self._zygote = None
+    with self._change_tracker_lock:
+      if self._change_tracker is not None:
+        self._change_tracker.close()
+        self._change_tracker = None
+    with self._jail_cgroup_lock:
+      if self._jail_cgroup is not None and self._jail_cgroup.remove():
+        self._jail_cgroup = None
 
   def _callfun(self, funname, *args, **kwargs):
-    uchroot_args = self.as_dict()
-    uchroot_args["extra_preexec_fn"] = kwargs.pop("preexec_fn", None)
-    uchroot_args["cwd"] = kwargs.pop("cwd", "/")
+    return self._callfun_with(None, funname, *args, **kwargs)
 
-    kwargs["preexec_fn"] = Main(**uchroot_args)
-    return getattr(subprocess, funname)(*args, **kwargs)
+  def _callfun_with(self, zygote, funname, *args, **kwargs):
+    """
+    Call the subprocess function `funname` with a preexec_fn that enters the
+    jail. If `zygote` is not None, join it rather than building a new jail.
+    """
+    import subprocess
+
+    if zygote is None and self.zygote:
+      zygote = self.get_zygote()
+    command, kwargs = self.get_spawn_args(args[0], zygote, **kwargs)
+    args = (command,) + tuple(args[1:])
+
+    runner = subprocess
+    if self.track_usage:
+      from uchroot import usage
+
+      runner = usage
+      kwargs["jail_cgroup"] = self.get_jail_cgroup()
+      kwargs["on_usage"] = self._set_last_usage
+    if not self.track_changes or funname == "Popen":
+      return getattr(runner, funname)(*args, **kwargs)
+
+    from uchroot import changes
+
+    # NOTE: the lock is held for the whole command so that the changes of
+    # concurrent commands are not mixed up.
+    with self._change_tracker_lock:
+      if self._change_tracker is None:
+        self.get_mount_plan()
+        self._change_tracker = changes.make_tracker(self.rootfs, self.overlay)
+      else:
+        # discard changes made outside of tracked commands
+        self._change_tracker.checkpoint()
+      try:
+        return getattr(runner, funname)(*args, **kwargs)
+      finally:
+        self.last_changes = self._change_tracker.checkpoint()
+
+  def _set_last_usage(self, usage):
+    self.last_usage = usage
+
+  def get_preexec_fn(self, zygote=None, cwd="/", extra_preexec_fn=None):
+    """
+    Return a preexec_fn which enters the jail, joining `zygote` if it is not
+    None and building a new jail otherwise, changes to `cwd` and then calls
+    `extra_preexec_fn`.
+    """
+    # NOTE: construct the glibc wrapper before the preexec_fn is called so
+    # that the forked child inherits it rather than building its own.
+    get_glibc()
+    if zygote is not None:
+      return Join(zygote, self.identity, cwd, extra_preexec_fn, self.tracer)
+
+    uchroot_args = self._get_jail_args()
+    uchroot_args["extra_preexec_fn"] = extra_preexec_fn
+    uchroot_args["cwd"] = cwd
+    uchroot_args["binds"] = self.get_mount_plan()
+    uchroot_args["tracer"] = self.tracer
+    main_fn = Main(**uchroot_args)
+    main_fn.subid_ranges = self.subid_ranges
+    return main_fn
+
+  def get_spawn_args(self, command, zygote=None, **kwargs):
+    """
+    Return the command and the subprocess keyword arguments which run
+    `command` with the subprocess `kwargs` in the jail, joining `zygote` if
+    it is not None. With spawn_mode='nsenter' the command is run by nsenter
+    (and `shell` by an explicit /bin/sh), otherwise the preexec_fn enters the
+    jail (see `get_preexec_fn()`).
+    """
+    if self.spawn_mode != 'nsenter':
+      kwargs["preexec_fn"] = self.get_preexec_fn(
+          zygote, kwargs.pop("cwd", "/"), kwargs.pop("preexec_fn", None))
+      return command, kwargs
+
+    for key in ("preexec_fn", "executable"):
+      if kwargs.get(key) is not None:
+        raise ValueError(
+            "{} is not supported with spawn_mode='nsenter'".format(key))
+    if isinstance(command, STRING_TYPES):
+      command = [command]
+    if kwargs.pop("shell", False):
+      command = ["/bin/sh", "-c"] + list(command)
+    cwd = kwargs.pop("cwd", "/")
+    return zygote.get_nsenter_argv(self.identity, cwd) + list(command), kwargs
 
   def Popen(self, *args, **kwargs):  # pylint: disable=C0103
     return self._callfun("Popen", *args, **kwargs)
@@ -620,28 +2247,113 @@ class Container(ConfigObject):
   def check_output(self, *args, **kwargs):
     return self._callfun("check_output", *args, **kwargs)
 
+  def run_many(self, argvs, jobs=None, **kwargs):
+    """
+    Run each argument vector in `argvs` in the jail with up to `jobs`
+    (default: the number of cpus) running concurrently. Yields a
+    `CommandResult` for each command as it finishes. Stdout and stderr of
+    each command are captured, stdin is /dev/null. Other keyword arguments
+    are passed to `Popen()` for every command.
+
+    All commands in the batch share one jail. If this container does not
+    already have a zygote then a temporary one is used for the batch.
+    """
+    if jobs is None:
+      jobs = os.cpu_count() or 1
+    for key in ("stdin", "stdout", "stderr"):
+      if key in kwargs:
+        raise ValueError("run_many() does not accept {}".format(key))
+
+    pending = collections.deque(enumerate(argvs))
+    if not pending:
+      return
+
+    import subprocess
+
+    if self.zygote:
+      zygote = self.get_zygote()
+      owns_zygote = False
+    else:
+      zygote = self.make_zygote()
+      owns_zygote = True
+
+    def start_next(num_running):
+      if not pending or num_running >= jobs:
+        return None
+      index, argv = pending.popleft()
+      proc = self._callfun_with(
+          zygote, "Popen", argv, stdin=subprocess.DEVNULL,
+          stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+      return proc, index
+
+    results = run_captured(start_next)
+    try:
+      for proc, index, returncode, stdout, stderr in results:
+        yield CommandResult(index, proc.args, returncode, stdout, stderr,
+                            getattr(proc, "usage", None))
+    finally:
+      results.close()
+      if owns_zygote:
+        zygote.stop()
+
+  def create_subprocess_exec(self, program, *args, **kwargs):
+    """
+    Coroutine with the same interface as asyncio.create_subprocess_exec()
+    returning an asyncio Process running in the jail. See `uchroot.aio`.
+    """
+    from uchroot import aio  # pylint: disable=import-outside-toplevel
+    return aio.create_subprocess_exec(self, program, *args, **kwargs)
+
+  def create_subprocess_shell(self, cmd, **kwargs):
+    """
+    Coroutine with the same interface as asyncio.create_subprocess_shell()
+    returning an asyncio Process running in the jail. See `uchroot.aio`.
+    """
+    from uchroot import aio  # pylint: disable=import-outside-toplevel
+    return aio.create_subprocess_shell(self, cmd, **kwargs)
+
+  def stream(self, args, **kwargs):
+    """
+    Start `args` in the jail and return a `uchroot.stream.OutputStream`
+    which yields its stdout and stderr as they arrive, without buffering all
+    of it. See `uchroot.stream.open_stream()` for the arguments.
+    """
+    from uchroot import stream  # pylint: disable=import-outside-toplevel
+    return stream.open_stream(self, args, **kwargs)
+
+  def stream_async(self, args, **kwargs):
+    """
+    Like `stream()` but return a `uchroot.stream.AsyncOutputStream`, which
+    is used with ``async with`` and ``async for``.
+    """
+    from uchroot import stream  # pylint: disable=import-outside-toplevel
+    return stream.AsyncOutputStream(self, args, **kwargs)
+
+  def map(self, argvs, jobs=None, **kwargs):
+    """
+    Like `run_many()` but return the list of results in the same order as
+    `argvs`.
+    """
+    argvs = list(argvs)
+    results = [None] * len(argvs)
+    for result in self.run_many(argvs, jobs, **kwargs):
+      results[result.index] = result
+    return results
+
+
+# Names of the config files which are loaded from a rootfs directory if no
+# config is given (the first one found)
+AUTOLOAD_CONFIG_NAMES = (".uchroot.py", ".uchroot.cfg")
+
 
 def parse_config(config_path):
   """
   Open the config file as json, strip comments, load it and return the
   resulting dictionary.
   """
+  from uchroot import config
 
-  stripped_json_str = ''
-
-  # NOTE(josh): strip comments out of the config file.
-  with open(config_path, 'rb') as infile:
-    for line in infile:
-      line = re.sub('//.*$', '', line).rstrip()
-      if line:
-        stripped_json_str += line
-        stripped_json_str += '\n'
-
-  try:
-    return json.loads(stripped_json_str)
-  except (ValueError, KeyError):
-    logger.error('Failed to decode json:%s', stripped_json_str)
-    raise
+  return config.parse_json_config(config_path)
 
 
 VARDOCS = {
@@ -656,6 +2368,14 @@ the process tree started by the script.
     """
 If specified, indicates the path to a qemu instance that should be bound
 into the mount namespace of the jail
+""",
+    "qemu_mode":
+    """
+How to make `qemu` available in the jail. "bind" bind-mounts it read-only
+(nothing is copied into the rootfs, but an empty mountpoint file is created
+there if missing, and left behind), falling back to "copy" if that fails.
+"copy" copies it into the rootfs, unless an identical copy is already there.
+With overlay="tmpfs" neither leaves anything behind in the rootfs.
 """,
     "identity":
     "After entering the jail, assume this [uid, gid]. (0, 0) for root.",
@@ -670,6 +2390,26 @@ available to your user.
     "gid_range":
     "Same as uid_map above, but for gids.",
     "cwd": "Set the current working directory to this inside the jail",
+    "overlay":
+    """
+If specified, rootfs is mounted read-only as the lower layer of an overlay
+and all changes go to a writable upper layer. Use "tmpfs" for a throwaway
+upper layer that is discarded when the jail exits, or a directory path to
+persist the changes (in its `upper` subdirectory).
+""",
+    "pid_namespace":
+    """
+If true, the command runs in a new pid namespace, whose init process
+forwards signals to it and reaps orphaned processes.
+""",
+    "idmap":
+    """
+How to write the uid/gid map of the jail. "subid" maps root to the current
+user and ids starting at 1 to the ranges above, using the setuid-root
+newuidmap/newgidmap helpers. "single" maps only root to the current user
+without any helper process (faster, but `identity` must be root). "auto"
+uses "subid" if it is available, otherwise "single".
+""",
     "excbin": "The path of the program to execute",
     "argv": "The argument vector to expose as argv,argc to the called process",
     "env":
@@ -686,6 +2426,9 @@ def dump_config(outfile):
   """
   Dump the default configuration to ``outfile``.
   """
+  import json
+  import pprint
+  import textwrap
 
   config = Main().as_dict()
   config.update(Exec().as_dict())
@@ -7,11 +7,13 @@ entirely a no-root solution because it requires the newuidmap and newgidmap
 set-uid-root helper functions (on ubuntu, installed with the uidmap package).
 This requirement is not necessary if you only need to enter the chroot
 jail with a single user id mapped.
+
+Other tools are available as subcommands: uchroot fleet --help,
+uchroot manifest --help, uchroot serve --help
 """
 
 import argparse
-import inspect
-import io
+import importlib
 import logging
 import os
 import sys
@@ -37,9 +39,31 @@ def parse_bool(string):
   return False
 
 
+# Example value for each config variable that can be set from the command
+# line. The type of the example determines the type (and count) of the
+# command line argument. These are fixed here, rather than taken from the
+# default config, so that the defaults can be resolved lazily.
+ARG_EXAMPLES = [
+    ("binds", []),
+    ("qemu", None),
+    ("identity", (0, 0)),
+    ("uid_range", (0, 0)),
+    ("gid_range", (0, 0)),
+    ("cwd", "/"),
+    ("idmap", "auto"),
+    ("qemu_mode", "bind"),
+    ("overlay", None),
+    ("pid_namespace", False),
+    ("exbin", None),
+    ("argv", None),
+    ("env", None),
+]
+
+
 def setup_parser(parser, config):
   """
-  Configure argparse object
+  Configure argparse object. `config` is a sequence of (key, example_value)
+  pairs.
   """
   parser.add_argument('-v', '--version', action='version',
                       version=uchroot.VERSION)
@@ -47,12 +71,20 @@ def setup_parser(parser, config):
                       choices=['debug', 'info', 'warning', 'error'],
                       help='Set the verbosity of messages')
   parser.add_argument('-s', '--subprocess', action='store_true',
-                      help='use subprocess instead of exec')
+                      help='run the command in a subprocess, forwarding '
+                           'signals to it and reaping orphans, instead of '
+                           'exec')
   parser.add_argument('-c', '--config', help='Path to config file')
   parser.add_argument('--dump-config', action='store_true',
                       help='Dump default config and exit')
-
-  for key, value in config.items():
+  parser.add_argument('--trace',
+                      help='Append chrome trace events for each step of '
+                           'entering the jail to this file')
+  parser.add_argument('--no-daemon', action='store_true',
+                      help='run the command here even if `uchroot serve` is '
+                           'running (always the case if stdin is a terminal)')
+
+  for key, value in config:
     helpstr = uchroot.VARDOCS.get(key, None)
     if key == 'rootfs':
       continue
@@ -89,19 +121,43 @@ def setup_parser(parser, config):
                       help='command and arguments')
 
 
+def can_forward(args):
+  """
+  Return true if the command line `args` can be forwarded to `uchroot serve`,
+  which uses the config file of the rootfs: only the rootfs and command are
+  given. Commands attached to a terminal are not forwarded, since they would
+  lose it as their controlling terminal (and job control), nor are those
+  run with --subprocess, which this process must supervise.
+  """
+  if args.no_daemon or args.subprocess or args.rootfs is None:
+    return False
+  if os.isatty(0):
+    return False
+  if args.config or args.dump_config or args.trace:
+    return False
+  return all(getattr(args, key) is None for key, _ in ARG_EXAMPLES)
+
+
 def reusable_main(argv):
   config = uchroot.Main().as_dict()
   config.update({"exbin": None, "argv": None, "env": None})
   parser = argparse.ArgumentParser(description=__doc__)
-  setup_parser(parser, config)
+  setup_parser(parser, ARG_EXAMPLES)
   args = parser.parse_args(argv)
   logger.setLevel(getattr(logging, args.log_level.upper()))
 
+  if can_forward(args):
+    from uchroot import serve
+
+    returncode = serve.forward(args.rootfs, args.remainder)
+    if returncode is not None:
+      return returncode
+
   configpath = None
   if args.config:
     configpath = args.config
   elif args.rootfs is not None:
-    for tryfile in [".uchroot.py", ".uchroot.cfg"]:
+    for tryfile in uchroot.AUTOLOAD_CONFIG_NAMES:
       trypath = os.path.join(args.rootfs, tryfile)
       if os.path.exists(trypath):
         configpath = trypath
@@ -109,9 +165,9 @@ def reusable_main(argv):
         break
 
   if configpath:
-    with io.open(configpath, encoding='utf8') as infile:
-      # pylint: disable=W0122
-      exec(infile.read(), config)
+    from uchroot import config as config_loader
+
+    config_loader.load_config(configpath, config)
 
   if args.dump_config:
     uchroot.dump_config(sys.stdout)
@@ -126,45 +182,44 @@ def reusable_main(argv):
     if value is not None and key in config:
       config[key] = value
 
-  knownkeys = uchroot.Main.get_field_names() + uchroot.Exec.get_field_names()
-  unknownkeys = []
-  for key, value in config.items():
-    if key.startswith('_'):
-      continue
-
-    if key in knownkeys:
-      continue
-
-    if inspect.ismodule(value):
-      continue
-
-    unknownkeys.append(key)
-
-  if unknownkeys:
-    logger.warning("Unrecognized config variables: %s", ", ".join(unknownkeys))
-
-  mainobj = uchroot.Main(**config)
+  tracer = None
+  if args.trace:
+    tracer = uchroot.ChromeTracer(args.trace)
+  mainobj = uchroot.Main(tracer=tracer, **config)
   execobj = uchroot.Exec(**config)
 
   if args.subprocess:
-    execobj.subprocess(preexec_fn=mainobj)
-  else:
-    # enter the jail
-    mainobj()
-    # and start the requested program
-    execobj()
-    logger.error("Failed to start a shell")
+    return execobj.subprocess(preexec_fn=mainobj, supervisor=True)
 
+  # enter the jail
+  mainobj()
+  # and start the requested program
+  execobj()
+  logger.error("Failed to start a shell")
   return 1
 
 
+# Subcommands of the command line tool and the module implementing each of
+# them, with a `main(argv)` function. The modules are only imported when
+# used. Any other first argument is the rootfs to enter (use ./manifest to
+# enter a rootfs which is named like a subcommand).
+SUBCOMMANDS = {
+    "fleet": "uchroot.fleet",
+    "manifest": "uchroot.manifest",
+    "serve": "uchroot.serve",
+}
+
+
 def main():
   format_str = '%(levelname)-4s %(filename)s[%(lineno)-3s] : %(message)s'
   logging.basicConfig(level=logging.INFO,
                       format=format_str,
                       datefmt='%Y-%m-%d %H:%M:%S',
                       filemode='w')
-  return reusable_main(sys.argv[1:])
+  argv = sys.argv[1:]
+  if argv and argv[0] in SUBCOMMANDS:
+    return importlib.import_module(SUBCOMMANDS[argv[0]]).main(argv[1:])
+  return reusable_main(argv)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,128 @@
+"""
+asyncio support for uchroot containers.
+
+The jail of each process is prepared by a `uchroot.Zygote` whose startup is
+awaited on the event loop, so that the helper handshake and id-map setup
+don't block it. The subordinate ids are resolved and the mount plan is
+prepared in the default executor. Spawning the process itself then only
+needs to join the prepared jail, which is cheap.
+"""
+
+import asyncio
+import os
+
+import uchroot
+
+
+async def wait_readable(fd):
+  """Wait until `fd` is readable without blocking the event loop."""
+  loop = asyncio.get_running_loop()
+  future = loop.create_future()
+
+  def on_readable():
+    if not future.done():
+      future.set_result(None)
+
+  loop.add_reader(fd, on_readable)
+  try:
+    await future
+  finally:
+    loop.remove_reader(fd)
+
+
+async def make_zygote(container):
+  """
+  Return a new zygote of `container`, not started. Resolving its ids and
+  preparing its mount plan read (and may write) the filesystem, so this
+  runs in the default executor.
+  """
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(None, container.make_zygote, False)
+
+
+async def start_zygote(zygote):
+  """Start `zygote`, awaiting the construction of its jail."""
+  ready_fd = zygote.spawn()
+  try:
+    await wait_readable(ready_fd)
+  except BaseException:
+    os.close(ready_fd)
+    await stop_zygote(zygote)
+    raise
+  zygote.attach(ready_fd)
+
+
+async def stop_zygote(zygote):
+  """Release `zygote` and await its exit."""
+  zygote.release()
+  if zygote.pid is None:
+    return
+
+  if hasattr(os, "pidfd_open"):
+    pidfd = os.pidfd_open(zygote.pid)
+    try:
+      await wait_readable(pidfd)
+    finally:
+      os.close(pidfd)
+    zygote.wait()
+  else:
+    await asyncio.get_running_loop().run_in_executor(None, zygote.wait)
+
+
+async def get_zygote(container):
+  """Return the container's zygote, starting it if needed."""
+  zygote = container.peek_zygote()
+  if zygote is not None:
+    return zygote
+
+  zygote = await make_zygote(container)
+  await start_zygote(zygote)
+  adopted = container.adopt_zygote(zygote)
+  if adopted is not zygote:
+    # Another task started one concurrently
+    await stop_zygote(zygote)
+  return adopted
+
+
+async def _create_subprocess(container, create_fn, *args, **kwargs):
+  """
+  Call `create_fn` (an asyncio subprocess factory) with a preexec_fn that
+  joins the container's jail. If the container doesn't keep a zygote then a
+  temporary one is built for this process and released once it has joined.
+  """
+  if container.zygote:
+    zygote = await get_zygote(container)
+    owns_zygote = False
+  else:
+    zygote = await make_zygote(container)
+    await start_zygote(zygote)
+    owns_zygote = True
+
+  try:
+    shell = create_fn is asyncio.create_subprocess_shell
+    command, kwargs = container.get_spawn_args(
+        args[0] if shell else list(args), zygote, shell=shell, **kwargs)
+    if kwargs.pop("shell", False):
+      return await asyncio.create_subprocess_shell(command, **kwargs)
+    return await asyncio.create_subprocess_exec(*command, **kwargs)
+  finally:
+    if owns_zygote:
+      await stop_zygote(zygote)
+
+
+async def create_subprocess_exec(container, program, *args, **kwargs):
+  """
+  Like asyncio.create_subprocess_exec(), but the process runs in the jail of
+  `container`.
+  """
+  return await _create_subprocess(
+      container, asyncio.create_subprocess_exec, program, *args, **kwargs)
+
+
+async def create_subprocess_shell(container, cmd, **kwargs):
+  """
+  Like asyncio.create_subprocess_shell(), but the process runs in the jail of
+  `container`.
+  """
+  return await _create_subprocess(
+      container, asyncio.create_subprocess_shell, cmd, **kwargs)
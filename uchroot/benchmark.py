@@ -0,0 +1,579 @@
+"""
+Micro-benchmarks for the uchroot jail setup path.
+
+Usage::
+
+  python -m uchroot.benchmark [--json] <benchmark> [options]
+
+The jail benchmarks run against a generated fake rootfs (host directories bound
+into an empty directory) so they only require user namespaces to be enabled.
+All durations are reported in microseconds.
+"""
+
+import argparse
+import ctypes
+import json
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import uchroot
+
+logger = logging.getLogger(__name__)
+
+
+def time_calls(fun, count):
+  """Call `fun` `count` times and return a list of durations (seconds)."""
+  samples = []
+  timer = timeit.default_timer
+  for _ in range(count):
+    start = timer()
+    fun()
+    samples.append(timer() - start)
+  return samples
+
+
+def summarize(samples):
+  """
+  Return a dictionary of summary statistics (in microseconds) for a list of
+  durations (in seconds).
+  """
+  ordered = sorted(samples)
+  count = len(ordered)
+
+  def percentile(fraction):
+    return ordered[min(count - 1, int(fraction * count))] * 1e6
+
+  return {
+      "count": count,
+      "mean_us": sum(ordered) / count * 1e6,
+      "min_us": ordered[0] * 1e6,
+      "p50_us": percentile(0.5),
+      "p99_us": percentile(0.99),
+      "max_us": ordered[-1] * 1e6,
+  }
+
+
+def bench_glibc(args):
+  """
+  Compare the cost of constructing the glibc wrapper (the per-spawn cost
+  before it was shared) with fetching the shared instance.
+  """
+  return {
+      "make_glibc": summarize(time_calls(uchroot.make_glibc, args.count)),
+      "get_glibc": summarize(time_calls(uchroot.get_glibc, args.count)),
+  }
+
+
+def setup_glibc_parser(parser):
+  parser.add_argument("-n", "--count", type=int, default=1000,
+                      help="number of samples")
+
+
+# Host directories bound into the fake rootfs so that it contains a working
+# userspace without copying anything.
+FAKE_ROOTFS_BINDS = ["/bin", "/lib", "/lib64", "/sbin", "/usr"]
+
+
+def make_fake_rootfs(parent_dir, extra_binds=0, create_mountpoints=True):
+  """
+  Create an empty rootfs directory under `parent_dir`. Return the pair
+  (rootfs, binds) where `binds` exposes the host userspace within it. If
+  `extra_binds` is nonzero, that many (empty) host directories are created
+  and added to the binds as well. If `create_mountpoints` is false, the
+  mountpoints are left for `MountPlan.prepare()` to create.
+  """
+  rootfs = tempfile.mkdtemp(prefix="rootfs-", dir=parent_dir)
+  binds = [path for path in FAKE_ROOTFS_BINDS if os.path.exists(path)]
+  if create_mountpoints:
+    for bind in binds:
+      os.makedirs(os.path.join(rootfs, bind.lstrip("/")))
+
+  if extra_binds:
+    host_dir = tempfile.mkdtemp(prefix="binds-", dir=parent_dir)
+    for idx in range(extra_binds):
+      name = "{:04d}".format(idx)
+      os.mkdir(os.path.join(host_dir, name))
+      if create_mountpoints:
+        os.makedirs(os.path.join(rootfs, "mnt", name))
+      binds.append("{}:/mnt/{}".format(os.path.join(host_dir, name), name))
+  return rootfs, binds
+
+
+def check_idmap(idmap):
+  """
+  Return true if jails can be created with the `idmap` mode on this host,
+  otherwise log a warning and return false.
+  """
+  if idmap == "subid" and uchroot.resolve_idmap("auto") != "subid":
+    logger.warning("Skipping idmap=subid, no helpers or subordinate ids")
+    return False
+  return True
+
+
+def make_ballast(size_mb):
+  """
+  Return a buffer of `size_mb` megabytes with every page touched, to inflate
+  the resident size (and page tables) of this process.
+  """
+  ballast = bytearray(size_mb << 20)
+  for offset in range(0, len(ballast), 4096):
+    ballast[offset] = 1
+  return ballast
+
+
+def bench_spawn(args):
+  """
+  Measure the latency of Container.call(["true"]) with each idmap mode (and
+  optionally with a zygote, each spawn mode, and an inflated parent).
+  """
+  ballast = make_ballast(args.rss_mb)  # pylint: disable=unused-variable
+  tmpdir = tempfile.mkdtemp(prefix="uchroot-bench-")
+  results = {}
+  try:
+    rootfs, binds = make_fake_rootfs(tmpdir, args.extra_binds)
+    for idmap in args.idmap:
+      if not check_idmap(idmap):
+        continue
+      for spawn_mode in args.spawn_mode:
+        for zygote in args.zygote:
+          container = uchroot.Container(
+              rootfs=rootfs, binds=binds, idmap=idmap, zygote=zygote,
+              spawn_mode=spawn_mode)
+          key = idmap
+          if container.zygote:
+            key += "-zygote"
+          if spawn_mode != "preexec":
+            key += "-" + spawn_mode
+          if key in results:
+            continue
+          with container:
+            samples = time_calls(lambda: container.check_call(["true"]),
+                                 args.count)
+          result = summarize(samples)
+          result["commands_per_sec"] = len(samples) / sum(samples)
+          results[key] = result
+  finally:
+    shutil.rmtree(tmpdir)
+  return results
+
+
+def parse_bool(string):
+  return string.lower() in ("1", "y", "yes", "t", "true")
+
+
+def setup_spawn_parser(parser):
+  parser.add_argument("-n", "--count", type=int, default=100,
+                      help="number of samples")
+  parser.add_argument("--idmap", nargs="*", default=["single", "subid"],
+                      choices=["single", "subid"],
+                      help="which idmap modes to measure")
+  parser.add_argument("--zygote", nargs="*", type=parse_bool,
+                      default=[False], help="measure with/without a zygote")
+  parser.add_argument("--spawn-mode", nargs="*", default=["preexec"],
+                      choices=uchroot.SPAWN_MODES,
+                      help="which spawn modes to measure")
+  parser.add_argument("--rss-mb", type=int, default=0,
+                      help="grow this process by this many megabytes first")
+  parser.add_argument("--extra-binds", type=int, default=0,
+                      help="number of additional (empty) directories to bind")
+
+
+def bench_throughput(args):
+  """
+  Measure how many commands per second Container.run_many() completes.
+  """
+  tmpdir = tempfile.mkdtemp(prefix="uchroot-bench-")
+  results = {}
+  try:
+    rootfs, binds = make_fake_rootfs(tmpdir, args.extra_binds)
+    argvs = [["true"]] * args.count
+    for idmap in args.idmap:
+      if not check_idmap(idmap):
+        continue
+      container = uchroot.Container(rootfs=rootfs, binds=binds, idmap=idmap)
+      start = timeit.default_timer()
+      for result in container.run_many(argvs, jobs=args.jobs):
+        if result.returncode != 0:
+          raise RuntimeError("Command failed: {}".format(result))
+      elapsed = timeit.default_timer() - start
+      results[idmap] = {
+          "count": args.count,
+          "jobs": args.jobs or os.cpu_count(),
+          "elapsed_us": elapsed * 1e6,
+          "commands_per_sec": args.count / elapsed,
+      }
+  finally:
+    shutil.rmtree(tmpdir)
+  return results
+
+
+def setup_throughput_parser(parser):
+  parser.add_argument("-n", "--count", type=int, default=1000,
+                      help="number of commands")
+  parser.add_argument("-j", "--jobs", type=int, default=None,
+                      help="number of concurrent commands (default: #cpus)")
+  parser.add_argument("--idmap", nargs="*", default=["single", "subid"],
+                      choices=["single", "subid"],
+                      help="which idmap modes to measure")
+  parser.add_argument("--extra-binds", type=int, default=0,
+                      help="number of additional (empty) directories to bind")
+
+
+def bench_pool(args):
+  """
+  Measure the latency of JailPool.run(["true"]), compared to
+  Container.call(["true"]), when commands arrive every `interval` seconds.
+  """
+  from uchroot.pool import JailPool
+
+  def paced(fun):
+    def paced_fun():
+      time.sleep(args.interval)
+      start = timeit.default_timer()
+      fun()
+      return timeit.default_timer() - start
+    return paced_fun
+
+  tmpdir = tempfile.mkdtemp(prefix="uchroot-bench-")
+  results = {}
+  try:
+    rootfs, binds = make_fake_rootfs(tmpdir, args.extra_binds)
+    for idmap in args.idmap:
+      if not check_idmap(idmap):
+        continue
+      with uchroot.Container(rootfs=rootfs, binds=binds, idmap=idmap,
+                             zygote=args.zygote) as container:
+        run_call = paced(lambda: container.check_call(["true"]))
+        results[idmap + "-call"] = summarize(
+            [run_call() for _ in range(args.count)])
+        with JailPool(container, args.size) as pool:
+          run_pool = paced(lambda: pool.run(["true"], check=True))
+          results[idmap + "-pool"] = summarize(
+              [run_pool() for _ in range(args.count)])
+  finally:
+    shutil.rmtree(tmpdir)
+  return results
+
+
+def setup_pool_parser(parser):
+  parser.add_argument("-n", "--count", type=int, default=100,
+                      help="number of samples")
+  parser.add_argument("--size", type=int, default=4,
+                      help="number of parked jails")
+  parser.add_argument("--interval", type=float, default=0.05,
+                      help="seconds between commands")
+  parser.add_argument("--zygote", action="store_true",
+                      help="parked jails join a zygote")
+  parser.add_argument("--idmap", nargs="*", default=["single", "subid"],
+                      choices=["single", "subid"],
+                      help="which idmap modes to measure")
+  parser.add_argument("--extra-binds", type=int, default=0,
+                      help="number of additional (empty) directories to bind")
+
+
+def check_errno(result, what):
+  if result != 0:
+    err = ctypes.get_errno()
+    raise OSError(err, "{} failed".format(what))
+
+
+def read_trace_spans(path, end):
+  """
+  Parse the trace file at `path` (see `uchroot.ChromeTracer`) into a list of
+  (name, args, begin, end) for each step, with timestamps in seconds. Steps
+  which never ended (e.g. the exec) end at `end`.
+  """
+  with open(path, "r") as infile:
+    events = json.loads(infile.read().rstrip().rstrip(",") + "]")
+
+  stacks = {}
+  spans = []
+  for event in events:
+    stack = stacks.setdefault(event["pid"], [])
+    if event["ph"] == "B":
+      stack.append(event)
+      continue
+    begin = stack.pop()
+    spans.append((begin["name"], begin.get("args", {}), begin["ts"] / 1e6,
+                  event["ts"] / 1e6))
+  for stack in stacks.values():
+    spans.extend((begin["name"], begin.get("args", {}), begin["ts"] / 1e6, end)
+                 for begin in stack)
+  return spans
+
+
+def sample_phases(args, rootfs, plan, trace_path):
+  """
+  Fork a child which enters the jail with `uchroot.main()` and execs `true` in
+  it, tracing each step to `trace_path`. Return a dictionary mapping step name
+  to duration (seconds). Steps which contain others (e.g. "enter") include
+  their duration.
+  """
+  if os.path.exists(trace_path):
+    os.unlink(trace_path)
+  start = time.monotonic()
+  child_pid = os.fork()
+  if child_pid == 0:
+    exit_code = 1
+    try:
+      tracer = uchroot.ChromeTracer(trace_path)
+      uchroot.main(rootfs, binds=plan, qemu=args.qemu,
+                   qemu_mode=args.qemu_mode, overlay=args.overlay,
+                   idmap=args.idmap, tracer=tracer)
+      # NOTE: ended by the parent, once `true` exited
+      tracer.begin("exec", time.monotonic(), os.getpid())
+      os.execv("/bin/true", ["true"])
+    except Exception:  # pylint: disable=broad-except
+      logger.exception("Failed to build jail")
+    os._exit(exit_code)  # pylint: disable=protected-access
+
+  _, status = os.waitpid(child_pid, 0)
+  end = time.monotonic()
+  if status != 0:
+    raise RuntimeError("Jail process failed with status {}".format(status))
+
+  spans = read_trace_spans(trace_path, end)
+  phases = {"fork": min(begin for _, _, begin, _ in spans) - start,
+            "total": end - start}
+  for name, span_args, begin, span_end in spans:
+    if name == "mount":
+      name = "mount:" + span_args.get("dest", "?")
+    phases[name] = phases.get(name, 0.0) + span_end - begin
+  return phases
+
+
+def bench_phases(args):
+  """
+  Break the latency of entering a jail and running `true` down by the steps
+  traced by `uchroot.main()` (see `uchroot.Tracer`), plus the fork and exec.
+  """
+  if not check_idmap(args.idmap):
+    return {}
+  for bind in FAKE_ROOTFS_BINDS:
+    if args.qemu and args.qemu.startswith(bind + "/"):
+      raise ValueError("qemu {} must not be under {}, which is bound into the "
+                       "fake rootfs".format(args.qemu, bind))
+
+  tmpdir = tempfile.mkdtemp(prefix="uchroot-bench-")
+  samples = {}
+  try:
+    rootfs, binds = make_fake_rootfs(tmpdir, args.extra_binds)
+    start = timeit.default_timer()
+    plan = uchroot.get_mount_plan(rootfs, binds)
+    prepare = timeit.default_timer() - start
+
+    trace_path = os.path.join(tmpdir, "trace.json")
+    for _ in range(args.count):
+      for name, duration in sample_phases(args, rootfs, plan,
+                                          trace_path).items():
+        samples.setdefault(name, []).append(duration)
+  finally:
+    shutil.rmtree(tmpdir)
+
+  results = {name: summarize(values) for name, values in samples.items()}
+  results["mount_plan_prepare"] = summarize([prepare])
+  return results
+
+
+def setup_phases_parser(parser):
+  parser.add_argument("-n", "--count", type=int, default=100,
+                      help="number of samples")
+  parser.add_argument("--idmap", default="single", choices=["single", "subid"],
+                      help="which idmap mode to measure")
+  parser.add_argument("--extra-binds", type=int, default=0,
+                      help="number of additional (empty) directories to bind")
+  parser.add_argument("--overlay",
+                      help="mount the rootfs copy-on-write (see VARDOCS)")
+  parser.add_argument("--qemu", help="path of a binary to install as qemu")
+  parser.add_argument("--qemu-mode", choices=uchroot.QEMU_MODES,
+                      default="bind", help="how to install qemu")
+
+
+def sample_execute(rootfs, plan):
+  """
+  Fork a child which enters new user and mount namespaces and executes the
+  mount `plan`. Return the duration (seconds) of `plan.execute()`.
+  """
+  report_read_fd, report_write_fd = os.pipe()
+  uid = os.getuid()
+  gid = os.getgid()
+  child_pid = os.fork()
+  if child_pid == 0:
+    exit_code = 1
+    try:
+      os.close(report_read_fd)
+      glibc = uchroot.get_glibc()
+      check_errno(glibc.unshare(glibc.CLONE_NEWUSER), "unshare(CLONE_NEWUSER)")
+      uchroot.set_self_idmap(uid, gid)
+      check_errno(glibc.unshare(glibc.CLONE_NEWNS), "unshare(CLONE_NEWNS)")
+      start = timeit.default_timer()
+      plan.execute(glibc)
+      duration = timeit.default_timer() - start
+      # NOTE: os.path.ismount() doesn't detect binds within one filesystem
+      with open("/proc/self/mountinfo") as infile:
+        mountpoints = set(line.split()[4] for line in infile)
+      for mount in plan.mounts:
+        if mount.rootfs_dest not in mountpoints:
+          raise RuntimeError("{} was not mounted".format(mount.rootfs_dest))
+      os.write(report_write_fd, struct.pack("d", duration))
+      exit_code = 0
+    except Exception:  # pylint: disable=broad-except
+      logger.exception("Failed to execute the mount plan")
+    os._exit(exit_code)  # pylint: disable=protected-access
+
+  os.close(report_write_fd)
+  report = os.read(report_read_fd, struct.calcsize("d"))
+  os.close(report_read_fd)
+  _, status = os.waitpid(child_pid, 0)
+  if status != 0:
+    raise RuntimeError("Mount process failed with status {}".format(status))
+  return struct.unpack("d", report)[0]
+
+
+def bench_binds(args):
+  """
+  Measure the cost of preparing (serially and with a thread pool) and of
+  executing (with each mount API) mount plans with many binds.
+  """
+  # NOTE: prepare() warns about each mountpoint that it creates
+  logging.getLogger("uchroot").setLevel(logging.ERROR)
+  tmpdir = tempfile.mkdtemp(prefix="uchroot-bench-")
+  results = {}
+  try:
+    for count in args.binds:
+      result = results.setdefault(str(count), {})
+      for name, jobs in (("prepare_serial", 1), ("prepare_threads", None)):
+        samples = []
+        for _ in range(args.count):
+          rootfs, binds = make_fake_rootfs(tmpdir, count,
+                                           create_mountpoints=False)
+          start = timeit.default_timer()
+          uchroot.MountPlan(rootfs, binds).prepare(jobs)
+          samples.append(timeit.default_timer() - start)
+        result[name] = summarize(samples)
+
+      rootfs, binds = make_fake_rootfs(tmpdir, count)
+      for mount_api in args.mount_api:
+        plan = uchroot.MountPlan(rootfs, binds, mount_api=mount_api)
+        plan.prepare()
+        result[mount_api] = summarize(
+            [sample_execute(rootfs, plan) for _ in range(args.count)])
+  finally:
+    shutil.rmtree(tmpdir)
+  return results
+
+
+def setup_binds_parser(parser):
+  parser.add_argument("-n", "--count", type=int, default=10,
+                      help="number of samples")
+  parser.add_argument("--binds", type=int, nargs="*", default=[10, 100, 1000],
+                      help="numbers of additional (empty) directories to bind")
+  parser.add_argument("--mount-api", nargs="*", default=uchroot.MOUNT_APIS,
+                      choices=uchroot.MOUNT_APIS,
+                      help="which mount APIs to measure")
+
+
+def parse_importtime(text):
+  """
+  Parse the stderr of ``python -X importtime`` and return a dictionary mapping
+  module name to (self_us, cumulative_us).
+  """
+  result = {}
+  for line in text.splitlines():
+    if not line.startswith("import time:"):
+      continue
+    parts = line[len("import time:"):].split("|")
+    if len(parts) != 3 or not parts[0].strip().isdigit():
+      continue
+    result[parts[2].strip()] = (int(parts[0]), int(parts[1]))
+  return result
+
+
+def bench_startup(args):
+  """
+  Measure the wall time of starting the command line tool, and which imports
+  it spends that time on.
+  """
+  version_cmd = [sys.executable, "-m", "uchroot", "--version"]
+  samples = time_calls(
+      lambda: subprocess.check_call(version_cmd, stdout=subprocess.DEVNULL),
+      args.count)
+
+  imports = {}
+  for _ in range(args.count):
+    stderr = subprocess.check_output(
+        [sys.executable, "-X", "importtime", "-c", "import uchroot.__main__"],
+        stderr=subprocess.STDOUT).decode("utf-8")
+    for name, (_, cumulative) in parse_importtime(stderr).items():
+      imports.setdefault(name, []).append(cumulative / 1e6)
+
+  top_imports = sorted(imports.items(), key=lambda item: -min(item[1]))
+  return {
+      "version": summarize(samples),
+      "imports": {name: summarize(values)
+                  for name, values in top_imports[:args.top]},
+  }
+
+
+def setup_startup_parser(parser):
+  parser.add_argument("-n", "--count", type=int, default=20,
+                      help="number of samples")
+  parser.add_argument("--top", type=int, default=10,
+                      help="number of imports (by cumulative time) to report")
+
+
+# Map of benchmark name to (setup_parser_fn, run_fn)
+BENCHMARKS = {
+    "binds": (setup_binds_parser, bench_binds),
+    "glibc": (setup_glibc_parser, bench_glibc),
+    "phases": (setup_phases_parser, bench_phases),
+    "pool": (setup_pool_parser, bench_pool),
+    "spawn": (setup_spawn_parser, bench_spawn),
+    "startup": (setup_startup_parser, bench_startup),
+    "throughput": (setup_throughput_parser, bench_throughput),
+}
+
+
+def format_results(results, outfile, indent=""):
+  """Write a human readable representation of the results."""
+  for key, value in sorted(results.items()):
+    if isinstance(value, dict):
+      outfile.write("{}{}:\n".format(indent, key))
+      format_results(value, outfile, indent + "  ")
+    elif isinstance(value, float):
+      outfile.write("{}{:10s}: {:.2f}\n".format(indent, key, value))
+    else:
+      outfile.write("{}{:10s}: {}\n".format(indent, key, value))
+
+
+def main():
+  logging.basicConfig(level=logging.WARNING)
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--json", action="store_true",
+                      help="write results as json")
+  subparsers = parser.add_subparsers(dest="benchmark")
+  for name, (setup_fn, run_fn) in sorted(BENCHMARKS.items()):
+    setup_fn(subparsers.add_parser(name, help=run_fn.__doc__.strip()))
+  args = parser.parse_args()
+  if args.benchmark is None:
+    parser.print_help()
+    return 1
+
+  results = BENCHMARKS[args.benchmark][1](args)
+  if args.json:
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+  else:
+    format_results(results, sys.stdout)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
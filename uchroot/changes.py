@@ -0,0 +1,385 @@
+"""
+Record which files of a rootfs the commands run in a jail create, modify or
+delete.
+
+Without an overlay, every directory of the rootfs is watched with inotify.
+The tree is scanned once, when tracking starts, and afterwards each change
+set only costs the events that the commands produced. With a persistent
+overlay directory, all changes land in its upper layer (which is usually
+small) so it is compared before and after each command instead.
+"""
+
+import collections
+import ctypes
+import errno
+import os
+import selectors
+import stat
+import struct
+import threading
+
+import uchroot
+from uchroot import manifest
+
+# The paths (absolute, within the jail) which were created, modified or
+# deleted, each sorted.
+ChangeSet = collections.namedtuple(
+    "ChangeSet", ["created", "modified", "deleted"])
+
+# struct inotify_event, without the variable length name which follows it
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# xattrs which mark an overlay directory as opaque (hiding the lower one)
+OPAQUE_XATTRS = ("user.overlay.opaque", "trusted.overlay.opaque")
+
+
+def make_change_set(changes):
+  """
+  Return the `ChangeSet` for a dictionary mapping relative paths to "created",
+  "modified" or "deleted".
+  """
+  kinds = {"created": [], "modified": [], "deleted": []}
+  for relpath, kind in changes.items():
+    kinds[kind].append("/" + relpath)
+  return ChangeSet(sorted(kinds["created"]), sorted(kinds["modified"]),
+                   sorted(kinds["deleted"]))
+
+
+class InotifyTracker(object):
+  """
+  Watch every directory below `rootfs` with inotify. Events are drained by a
+  background thread so that the kernel queue doesn't overflow during long
+  commands. Call `checkpoint()` to get the changes since the previous call.
+  """
+
+  def __init__(self, rootfs, glibc=None):
+    self.rootfs = rootfs
+    self.glibc = uchroot.get_default(glibc, uchroot.get_glibc())
+    self.watch_mask = (self.glibc.IN_CREATE | self.glibc.IN_DELETE
+                       | self.glibc.IN_MODIFY | self.glibc.IN_ATTRIB
+                       | self.glibc.IN_MOVED_FROM | self.glibc.IN_MOVED_TO
+                       | self.glibc.IN_ONLYDIR | self.glibc.IN_DONT_FOLLOW)
+    self.fd = None
+    self.watches = {}
+    self.existing = set()
+    self.changes = {}
+    self.overflowed = False
+    self.lock = threading.Lock()
+    self._stop_pipe = None
+    self._thread = None
+
+  def start(self):
+    """Watch the tree and start draining events."""
+    self.fd = self.glibc.inotify_init1(self.glibc.IN_CLOEXEC
+                                       | self.glibc.IN_NONBLOCK)
+    if self.fd == -1:
+      err = ctypes.get_errno()
+      raise OSError(err, "Failed to create inotify instance")
+
+    self._add_watch("")
+    for entry in manifest.scan(self.rootfs):
+      self.existing.add(entry.path)
+      if stat.S_ISDIR(entry.mode):
+        self._add_watch(entry.path)
+
+    self._stop_pipe = os.pipe()
+    self._thread = threading.Thread(target=self._drain_loop)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def close(self):
+    """Stop watching."""
+    if self._thread is not None:
+      os.write(self._stop_pipe[1], b"#")
+      self._thread.join()
+      self._thread = None
+      for pipe_fd in self._stop_pipe:
+        os.close(pipe_fd)
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+  def _add_watch(self, relpath):
+    path = os.path.join(self.rootfs, relpath)
+    wd = self.glibc.inotify_add_watch(self.fd, os.fsencode(path),
+                                      self.watch_mask)
+    if wd == -1:
+      err = ctypes.get_errno()
+      if err == errno.ENOENT:
+        # removed since it was listed
+        return
+      if err == errno.ENOSPC:
+        raise OSError(err, "Out of inotify watches (see "
+                      "/proc/sys/fs/inotify/max_user_watches)", path)
+      raise OSError(err, "Failed to watch", path)
+    self.watches[wd] = relpath
+
+  def _add_tree(self, relpath):
+    """Watch a directory which appeared, and record its contents as new."""
+    # NOTE: the directory is watched before it is listed so that entries
+    # created in between are not missed.
+    self._add_watch(relpath)
+    for entry in manifest.scan(os.path.join(self.rootfs, relpath)):
+      child = os.path.join(relpath, entry.path)
+      self._record_created(child)
+      if stat.S_ISDIR(entry.mode):
+        self._add_watch(child)
+
+  def _remove_tree(self, relpath):
+    """Stop watching a directory which disappeared, and its contents."""
+    prefix = relpath + "/"
+    for wd, path in list(self.watches.items()):
+      if path == relpath or path.startswith(prefix):
+        self.glibc.inotify_rm_watch(self.fd, wd)
+        del self.watches[wd]
+    children = set(path for path in self.existing if path.startswith(prefix))
+    children.update(path for path in self.changes if path.startswith(prefix))
+    for child in children:
+      self._record_deleted(child)
+
+  def _record_created(self, relpath):
+    if relpath in self.existing:
+      # replaced
+      self.changes[relpath] = "modified"
+    else:
+      self.changes[relpath] = "created"
+
+  def _record_deleted(self, relpath):
+    if relpath in self.existing:
+      self.changes[relpath] = "deleted"
+    else:
+      self.changes.pop(relpath, None)
+
+  def _record_modified(self, relpath):
+    if relpath not in self.changes:
+      if relpath in self.existing:
+        self.changes[relpath] = "modified"
+      else:
+        self.changes[relpath] = "created"
+
+  def _handle_event(self, wd, mask, name):
+    if mask & self.glibc.IN_Q_OVERFLOW:
+      self.overflowed = True
+      return
+    if mask & self.glibc.IN_IGNORED:
+      self.watches.pop(wd, None)
+      return
+    parent = self.watches.get(wd)
+    if parent is None:
+      return
+    if not name:
+      # an event on the watched directory itself
+      if parent and mask & self.glibc.IN_ATTRIB:
+        self._record_modified(parent)
+      return
+
+    relpath = os.path.join(parent, name)
+    if relpath == manifest.MANIFEST_NAME:
+      return
+    if mask & (self.glibc.IN_CREATE | self.glibc.IN_MOVED_TO):
+      self._record_created(relpath)
+      if mask & self.glibc.IN_ISDIR:
+        self._add_tree(relpath)
+    elif mask & (self.glibc.IN_DELETE | self.glibc.IN_MOVED_FROM):
+      # NOTE: a deleted directory was empty, and its watch is dropped with
+      # IN_IGNORED, but a moved one takes its contents along.
+      if mask & self.glibc.IN_ISDIR and mask & self.glibc.IN_MOVED_FROM:
+        self._remove_tree(relpath)
+      self._record_deleted(relpath)
+    elif mask & (self.glibc.IN_MODIFY | self.glibc.IN_ATTRIB):
+      self._record_modified(relpath)
+
+  def _read_events(self):
+    """Read and handle all queued events. Must hold the lock."""
+    while True:
+      try:
+        buf = os.read(self.fd, 64 * 1024)
+      except BlockingIOError:
+        return
+      offset = 0
+      while offset < len(buf):
+        wd, mask, _, length = INOTIFY_EVENT.unpack_from(buf, offset)
+        offset += INOTIFY_EVENT.size
+        name = buf[offset:offset + length].rstrip(b"\0")
+        offset += length
+        self._handle_event(wd, mask, os.fsdecode(name))
+
+  def _drain_loop(self):
+    selector = selectors.DefaultSelector()
+    selector.register(self.fd, selectors.EVENT_READ)
+    selector.register(self._stop_pipe[0], selectors.EVENT_READ)
+    while True:
+      ready = [key.fd for key, _ in selector.select()]
+      if self._stop_pipe[0] in ready:
+        break
+      with self.lock:
+        self._read_events()
+    selector.close()
+
+  def checkpoint(self):
+    """
+    Return the `ChangeSet` since the previous checkpoint (or the start).
+    Raises OSError if events were lost because the kernel queue overflowed.
+    """
+    with self.lock:
+      self._read_events()
+      changes = self.changes
+      self.changes = {}
+      overflowed = self.overflowed
+      self.overflowed = False
+
+    for relpath, kind in changes.items():
+      if kind == "deleted":
+        self.existing.discard(relpath)
+      else:
+        self.existing.add(relpath)
+    if overflowed:
+      raise OSError(errno.EOVERFLOW, "inotify event queue overflowed, "
+                    "changes were lost (see "
+                    "/proc/sys/fs/inotify/max_queued_events)")
+    return make_change_set(changes)
+
+
+class OverlayTracker(object):
+  """
+  Compare the upper layer of a persistent `overlay` directory over `rootfs`
+  at each `checkpoint()` with the previous one.
+  """
+
+  def __init__(self, rootfs, overlay):
+    self.rootfs = rootfs
+    self.upperdir = uchroot.get_overlay_dirs(overlay)[0]
+    self.entries = {}
+    self.whiteouts = set()
+    self.opaques = set()
+
+  def start(self):
+    self.entries, self.whiteouts, self.opaques = self._scan()
+
+  def close(self):
+    pass
+
+  def _scan(self):
+    """
+    Return the entries of the upper layer, by path, the set of paths which
+    are whiteouts (i.e. deleted from the lower layer) and the set of opaque
+    directories (which hide the lower contents).
+    """
+    entries = {entry.path: entry for entry in manifest.scan(self.upperdir)}
+    whiteouts = set()
+    opaques = set()
+    for relpath, entry in entries.items():
+      if stat.S_ISCHR(entry.mode):
+        path = os.path.join(self.upperdir, relpath)
+        if os.lstat(path).st_rdev == 0:
+          whiteouts.add(relpath)
+      elif stat.S_ISDIR(entry.mode) and self._is_opaque(relpath):
+        opaques.add(relpath)
+    return entries, whiteouts, opaques
+
+  def _is_opaque(self, relpath):
+    path = os.path.join(self.upperdir, relpath)
+    for xattr in OPAQUE_XATTRS:
+      try:
+        if os.getxattr(path, xattr, follow_symlinks=False) == b"y":
+          return True
+      except OSError:
+        pass
+    return False
+
+  def _in_lower(self, relpath):
+    return os.path.lexists(os.path.join(self.rootfs, relpath))
+
+  def _is_hidden(self, relpath):
+    """
+    Return true if the lower `relpath` was hidden at the previous checkpoint:
+    it or one of its parents was a whiteout, or a parent was opaque.
+    """
+    if relpath in self.whiteouts:
+      return True
+    parent = os.path.dirname(relpath)
+    while parent:
+      if parent in self.whiteouts or parent in self.opaques:
+        return True
+      parent = os.path.dirname(parent)
+    return False
+
+  def _visible_lower(self, relpath):
+    """
+    Return the paths under the lower directory `relpath` which were visible
+    at the previous checkpoint.
+    """
+    lower_path = os.path.join(self.rootfs, relpath)
+    if not os.path.isdir(lower_path):
+      return []
+    children = (os.path.join(relpath, lower.path)
+                for lower in manifest.scan(lower_path))
+    return [child for child in children if not self._is_hidden(child)]
+
+  def checkpoint(self):
+    """Return the `ChangeSet` since the previous checkpoint (or the start)."""
+    entries, whiteouts, opaques = self._scan()
+    changes = {}
+    for relpath, entry in entries.items():
+      old = self.entries.get(relpath)
+      if old is not None and old[1:5] == entry[1:5]:
+        continue
+      # NOTE: the lower file only counts if it wasn't deleted (or hidden by a
+      # directory created again) at an earlier checkpoint.
+      if relpath in self.whiteouts:
+        existed = False
+      else:
+        existed = old is not None or (not self._is_hidden(relpath)
+                                      and self._in_lower(relpath))
+
+      if relpath in whiteouts:
+        if existed:
+          changes[relpath] = "deleted"
+          for child in self._visible_lower(relpath):
+            changes[child] = "deleted"
+        continue
+
+      if stat.S_ISDIR(entry.mode) and existed:
+        if (relpath in opaques and relpath not in self.opaques
+            and not self._is_hidden(relpath) and self._in_lower(relpath)):
+          # a directory of the rootfs which was deleted and created again
+          # hides the lower contents
+          changes[relpath] = "modified"
+          for child in self._visible_lower(relpath):
+            if child not in entries:
+              changes[child] = "deleted"
+          continue
+        # NOTE: a directory is copied up, and its mtime changes, whenever its
+        # contents change. It only changes itself with its mode.
+        if old is None:
+          old_mode = os.lstat(os.path.join(self.rootfs, relpath)).st_mode
+        else:
+          old_mode = old.mode
+        if old_mode != entry.mode:
+          changes[relpath] = "modified"
+        continue
+      changes[relpath] = "modified" if existed else "created"
+
+    for relpath in self.entries:
+      if relpath not in entries and relpath not in self.whiteouts:
+        changes[relpath] = "deleted"
+
+    self.entries = entries
+    self.whiteouts = whiteouts
+    self.opaques = opaques
+    return make_change_set(changes)
+
+
+def make_tracker(rootfs, overlay=None):
+  """
+  Return a started change tracker for commands run in a jail of `rootfs`
+  with the given `overlay` option.
+  """
+  if overlay == 'tmpfs':
+    raise ValueError("track_changes is not supported with overlay='tmpfs'")
+  if overlay:
+    tracker = OverlayTracker(rootfs, overlay)
+  else:
+    tracker = InotifyTracker(rootfs)
+  tracker.start()
+  return tracker
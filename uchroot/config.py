@@ -0,0 +1,147 @@
+"""
+Loading of uchroot config files.
+
+A config file is either python (e.g. ``.uchroot.py`` or ``.uchroot.cfg``),
+which is executed with the default configuration as its globals, or json
+with ``//`` and ``/* */`` comments (``*.json``). The compiled code of a
+python config, or the parsed content of a json config, is cached by path
+and invalidated when the file's mtime, size or inode changes, so that a
+long-lived process (e.g. ``uchroot serve``) loads each config only once.
+"""
+
+import copy
+import io
+import json
+import logging
+import os
+import re
+import types
+
+logger = logging.getLogger(__name__)
+
+# One token of json with comments: a string, a line comment, a block
+# comment, a run of other characters, or any other single character (e.g.
+# the "/" of an unterminated comment, left for the json parser to reject).
+JSON_TOKEN = re.compile(r'"(?:[^"\\\n]|\\.)*"|//[^\n]*|/\*.*?\*/|[^"/]+|.',
+                        re.DOTALL)
+
+# Cache of loaded config files, keyed by path. Each entry is a pair of the
+# (mtime, size, inode) stamp of the file and its code object (python) or
+# content (json).
+_CONFIG_CACHE = {}
+
+
+def strip_json_comments(text):
+  """
+  Return `text` with the comments removed in a single pass. Block comments
+  are replaced by their newlines so that the json parser reports the right
+  line numbers. Comment markers within strings are left alone.
+  """
+  chunks = []
+  for match in JSON_TOKEN.finditer(text):
+    token = match.group()
+    if token.startswith("//"):
+      continue
+    if token.startswith("/*"):
+      chunks.append("\n" * token.count("\n"))
+      continue
+    chunks.append(token)
+  return "".join(chunks)
+
+
+def parse_json_config(config_path):
+  """Parse the json (with comments) file at `config_path`."""
+  with io.open(config_path, encoding="utf-8") as infile:
+    stripped = strip_json_comments(infile.read())
+  try:
+    return json.loads(stripped)
+  except ValueError as err:
+    logger.error("Failed to decode json config %s: %s", config_path, err)
+    raise
+
+
+def compile_python_config(config_path):
+  """Compile the python file at `config_path`."""
+  with io.open(config_path, encoding="utf-8") as infile:
+    return compile(infile.read(), config_path, "exec")
+
+
+def get_cached(config_path, load_fn):
+  """Return `load_fn(config_path)`, cached until the file changes."""
+  stat = os.stat(config_path)
+  stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+  cached = _CONFIG_CACHE.get(config_path)
+  if cached is not None and cached[0] == stamp:
+    return cached[1]
+  loaded = load_fn(config_path)
+  # NOTE: a racing load stores the same content, so no lock is needed.
+  _CONFIG_CACHE[config_path] = (stamp, loaded)
+  return loaded
+
+
+_KNOWN_KEYS = None
+
+
+def get_known_keys():
+  """
+  Return the set of config variables known to `Main`, `Exec` and
+  `Container`.
+  """
+  global _KNOWN_KEYS  # pylint: disable=global-statement
+  if _KNOWN_KEYS is None:
+    import uchroot
+
+    _KNOWN_KEYS = frozenset(uchroot.Main.get_field_names()
+                            + uchroot.Exec.get_field_names()
+                            + uchroot.Container.get_field_names())
+  return _KNOWN_KEYS
+
+
+def get_unknown_keys(config):
+  """
+  Return the sorted variables of `config` which are not config variables,
+  ignoring private names and imported modules.
+  """
+  known_keys = get_known_keys()
+  return sorted(
+      key for key, value in config.items()
+      if not (key.startswith("_") or key in known_keys
+              or isinstance(value, types.ModuleType)))
+
+
+def find_config(rootfs):
+  """
+  Return the path of the config file autoloaded for the directory `rootfs`,
+  or None if it has none.
+  """
+  import uchroot
+
+  for name in uchroot.AUTOLOAD_CONFIG_NAMES:
+    config_path = os.path.join(rootfs, name)
+    if os.path.exists(config_path):
+      return config_path
+  return None
+
+
+def load_config(config_path, config=None):
+  """
+  Load the config file at `config_path` into the dictionary `config` (the
+  defaults, which a python config can refer to), and return it. Warns about
+  variables which are not config variables.
+  """
+  config = {} if config is None else config
+  if config_path.endswith(".json"):
+    loaded = get_cached(config_path, parse_json_config)
+    if not isinstance(loaded, dict):
+      raise ValueError("{} must contain a json object".format(config_path))
+    # NOTE: copied so that the caller can't modify the cached content
+    config.update(copy.deepcopy(loaded))
+  else:
+    # pylint: disable=W0122
+    exec(get_cached(config_path, compile_python_config), config)
+
+  unknown_keys = get_unknown_keys(config)
+  if unknown_keys:
+    logger.warning("Unrecognized config variables in %s: %s", config_path,
+                   ", ".join(unknown_keys))
+  return config
@@ -10,6 +10,8 @@ import subprocess
 import sys
 import tempfile
 
+import uchroot
+
 # A very simple c-program to print the value of certain glibc
 # constants for the current system.
 GET_CONSTANTS_PROGRAM = r"""
@@ -18,59 +20,41 @@ GET_CONSTANTS_PROGRAM = r"""
 #include <stdio.h>
 #include <sys/inotify.h>
 #include <sys/mount.h>
+#include <sys/prctl.h>
 #include <sys/signalfd.h>
 
 #define PRINT_CONST(X) printf("  \"%s\" : \"0x%x\",\n", #X, X)
 
-
-
-
 int main(int argc, char** argv) {
     printf("{\n");
-    PRINT_CONST(CLONE_NEWUSER);
-    PRINT_CONST(CLONE_NEWNS);
-    PRINT_CONST(IN_NONBLOCK);
-    PRINT_CONST(IN_CLOEXEC);
-
-    PRINT_CONST(IN_ACCESS);
-    PRINT_CONST(IN_ATTRIB);
-    PRINT_CONST(IN_CLOSE_WRITE);
-    PRINT_CONST(IN_CLOSE_NOWRITE  );
-    PRINT_CONST(IN_CREATE);
-    PRINT_CONST(IN_DELETE);
-    PRINT_CONST(IN_DELETE_SELF);
-    PRINT_CONST(IN_MODIFY);
-    PRINT_CONST(IN_MOVE_SELF);
-    PRINT_CONST(IN_MOVED_FROM);
-    PRINT_CONST(IN_MOVED_TO);
-    PRINT_CONST(IN_OPEN);
-
-    PRINT_CONST(MS_BIND);
-    PRINT_CONST(MS_REC);
-
-    PRINT_CONST(SFD_NONBLOCK);
-    PRINT_CONST(SFD_CLOEXEC);
-
-    PRINT_CONST(SIG_BLOCK);
-    PRINT_CONST(SIG_UNBLOCK);
-    PRINT_CONST(SIG_SETMASK);
-
+@PRINT_LINES@
     printf("  \"dummy\" : 0\n");
     printf("}\n");
 }
 """
 
 
+def get_program_source():
+  """
+  Return the source of the c-program, printing each of the constants in
+  uchroot.GLIBC_CONSTANTS.
+  """
+  print_lines = "\n".join("    PRINT_CONST({});".format(key)
+                          for key in sorted(uchroot.GLIBC_CONSTANTS))
+  return GET_CONSTANTS_PROGRAM.replace("@PRINT_LINES@", print_lines)
+
+
 def get_constants():
   """
   Write out the source for, compile, and run a simple c-program that prints
   the value of needed glibc constants. Read the output of that program and
-  store the value of constants in a Constants object. Return that object.
+  return a dictionary mapping constant names to values. If the program can't
+  be built, return the baked-in uchroot.GLIBC_CONSTANTS.
   """
-  with tempfile.NamedTemporaryFile(mode='wb', prefix='print_constants',
+  with tempfile.NamedTemporaryFile(mode='w', prefix='print_constants',
                                    suffix='.cc', delete=False) as outfile:
     src_path = outfile.name
-    outfile.write(GET_CONSTANTS_PROGRAM)
+    outfile.write(get_program_source())
 
   with tempfile.NamedTemporaryFile(mode='wb', prefix='print_constants',
                                    suffix='.cc', delete=False) as binfile:
@@ -83,13 +67,14 @@ def get_constants():
 
     constants_str = subprocess.check_output([bin_path])
     os.remove(bin_path)
-    result = json.loads(constants_str)
+    result = json.loads(constants_str.decode('utf-8'))
     result.pop('dummy')
 
-    return result
-  except subprocess.CalledProcessError:
+    return {key: int(value, 16) for key, value in result.items()}
+  except (OSError, subprocess.CalledProcessError):
     logging.warning('Failed to compile/execute program to get glibc constants.'
                     ' Using baked-in values.')
+    return dict(uchroot.GLIBC_CONSTANTS)
 
 
 def dump_constants(outfile, which_format):
@@ -99,10 +84,10 @@ def dump_constants(outfile, which_format):
               indent=2, sort_keys=True)
   elif which_format == "glibc":
     for key, value in sorted(constants.items()):
-      sys.stdout.write("glibc.{} = {}\n".format(key, value))
+      outfile.write("glibc.{} = 0x{:x}\n".format(key, value))
   else:
     for key, value in sorted(constants.items()):
-      sys.stdout.write("{} = {}\n".format(key, value))
+      outfile.write("{} = 0x{:x}\n".format(key, value))
 
   outfile.write('\n')
 
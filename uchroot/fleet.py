@@ -0,0 +1,402 @@
+"""
+Run jobs across many rootfs trees.
+
+A `Fleet` is a registry of rootfs directories, each with its config file
+(``.uchroot.py`` or ``.uchroot.cfg``). It keeps a warm `uchroot.Container`
+for each of them: the loaded config, the prepared mount plan, the resolved
+subordinate id ranges and (by default) a zygote, so that this setup is paid
+once per rootfs rather than by every command. A list of jobs is scheduled
+across the rootfs trees with a limit on the number of jobs running at once,
+in total and in each rootfs.
+
+Usage::
+
+  uchroot fleet [options] <path> [<path> ...] [-- <command> ...]
+
+Each path is either a rootfs directory with a config file, or a directory of
+them. The command is run in every rootfs. Jobs can also be read from a file
+(``-f``) in which each line is ``<rootfs> <command> ...``, where ``<rootfs>``
+is the name (or path) of a rootfs or ``*`` for all of them. Without any job,
+the rootfs trees are listed.
+"""
+
+import argparse
+import collections
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+import uchroot
+from uchroot import config
+
+logger = logging.getLogger(__name__)
+
+# One job: the rootfs (its name or path) and the command to run in it
+Job = collections.namedtuple("Job", ["rootfs", "args"])
+
+# Result of one job run by Fleet.run(). `rootfs` is the path of the rootfs.
+JobResult = collections.namedtuple(
+    "JobResult", ["index", "rootfs", "args", "returncode", "stdout", "stderr"])
+
+
+def discover(paths):
+  """
+  Return the sorted (real) paths of the rootfs directories found at `paths`:
+  each path which has a config file, otherwise each of its subdirectories
+  which has one.
+  """
+  found = set()
+  for path in paths:
+    if config.find_config(path) is not None:
+      found.add(os.path.realpath(path))
+      continue
+    try:
+      entries = list(os.scandir(path))
+    except OSError as err:
+      logger.warning("Failed to scan %s: %s", path, err)
+      continue
+    for entry in entries:
+      if entry.is_dir() and config.find_config(entry.path) is not None:
+        found.add(os.path.realpath(entry.path))
+  return sorted(found)
+
+
+def get_config_stamp(rootfs):
+  """
+  Return the path and (mtime, size, inode) of the config file of `rootfs`,
+  which change when it has to be reloaded.
+  """
+  config_path = config.find_config(rootfs)
+  if config_path is None:
+    return None
+  stat = os.stat(config_path)
+  return (config_path, stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+class FleetMember(object):
+  """
+  A rootfs of a `Fleet` and its `uchroot.Container`, built from the config
+  file of the rootfs. At most `jobs` of the fleet's jobs run in it at once.
+  """
+
+  def __init__(self, rootfs, jobs=1, zygote=True):
+    self.rootfs = rootfs
+    self.name = os.path.basename(rootfs)
+    self.jobs = jobs
+    self.running = 0
+    self.stamp = get_config_stamp(rootfs)
+
+    self.config = uchroot.Main().as_dict()
+    self.config["rootfs"] = rootfs
+    if self.stamp is not None:
+      config.load_config(self.stamp[0], self.config)
+    field_names = uchroot.Container.get_field_names()
+    kwargs = dict((key, value) for key, value in self.config.items()
+                  if key in field_names)
+    kwargs.setdefault("zygote", zygote)
+    self.container = uchroot.Container(**kwargs)
+    # NOTE: not an option of the container, see `needs_own_jail()`
+    self.pid_namespace = bool(self.config.get("pid_namespace"))
+
+  def needs_own_jail(self):
+    """
+    Return true if each command must get a jail of its own rather than join
+    a shared one: with a tmpfs overlay (whose changes are discarded with the
+    jail) or a pid namespace.
+    """
+    return self.container.overlay == "tmpfs" or self.pid_namespace
+
+  def is_stale(self):
+    """Return true if the config file of the rootfs changed since loaded."""
+    return get_config_stamp(self.rootfs) != self.stamp
+
+  def warm(self):
+    """
+    Resolve the subordinate ids, prepare the mount plan and start the
+    zygote, unless that is already done.
+    """
+    self.container.resolve_ids()
+    self.container.get_mount_plan()
+    if self.container.zygote:
+      self.container.get_zygote()
+
+  def close(self):
+    self.container.close()
+
+
+class Fleet(object):
+  """
+  A registry of the rootfs trees found at `paths` (see `discover()`). At most
+  `jobs` jobs (default: the number of cpus) run at once in the whole fleet,
+  and at most `jobs_per_rootfs` in each rootfs, across all calls of `run()`.
+  If `zygote` is true (and the config of a rootfs doesn't say otherwise), the
+  jobs of a rootfs join a long-lived zygote. Call `close()` (or use the fleet
+  as a context manager) to release them.
+  """
+
+  def __init__(self, paths=(), jobs=None, jobs_per_rootfs=1, zygote=True):
+    self.paths = list(paths)
+    self.jobs = uchroot.get_default(jobs, os.cpu_count() or 1)
+    self.jobs_per_rootfs = jobs_per_rootfs
+    self.zygote = zygote
+    self.members = {}
+    # number of jobs running in the fleet
+    self.running = 0
+    # NOTE: notified whenever a job finishes
+    self.lock = threading.Condition()
+    self.refresh()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def _load(self, rootfs):
+    try:
+      return FleetMember(rootfs, self.jobs_per_rootfs, self.zygote)
+    except Exception:  # pylint: disable=broad-except
+      logger.exception("Failed to load the config of %s", rootfs)
+      return None
+
+  def refresh(self):
+    """
+    Discover the rootfs trees at `paths` again, and reload those whose
+    config file changed. A rootfs whose config fails to load is skipped.
+    """
+    found = discover(self.paths)
+    with self.lock:
+      stale = [self.members.pop(rootfs) for rootfs in list(self.members)
+               if rootfs not in found or self.members[rootfs].is_stale()]
+    for member in stale:
+      member.close()
+    for rootfs in found:
+      if rootfs not in self.members:
+        self.add(rootfs)
+
+  def add(self, rootfs):
+    """Add (or return) the member for the directory `rootfs`."""
+    rootfs = os.path.realpath(rootfs)
+    with self.lock:
+      member = self.members.get(rootfs)
+    if member is None:
+      member = self._load(rootfs)
+      if member is None:
+        return None
+      with self.lock:
+        member = self.members.setdefault(rootfs, member)
+    return member
+
+  def reload(self, member):
+    """
+    Replace `member` with a new one loaded from the current config file of
+    its rootfs, and return it (None if the config fails to load).
+    """
+    with self.lock:
+      if self.members.get(member.rootfs) is member:
+        del self.members[member.rootfs]
+    member.close()
+    return self.add(member.rootfs)
+
+  def get(self, name):
+    """
+    Return the member for the rootfs at path `name`, or with the basename
+    `name`. Raises KeyError if there isn't exactly one.
+    """
+    with self.lock:
+      member = self.members.get(os.path.realpath(name))
+      if member is not None:
+        return member
+      matches = [member for member in self.members.values()
+                 if member.name == name]
+    if len(matches) != 1:
+      raise KeyError("{} rootfs match {}".format(len(matches), name))
+    return matches[0]
+
+  def list(self):
+    """Return the members, sorted by rootfs."""
+    with self.lock:
+      return [self.members[rootfs] for rootfs in sorted(self.members)]
+
+  def warm(self):
+    """Warm up every member concurrently (see `FleetMember.warm()`)."""
+    import concurrent.futures
+
+    members = self.list()
+    with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+      for member, error in zip(members, executor.map(warm_member, members)):
+        if error is not None:
+          logger.error("Failed to warm up %s: %s", member.rootfs, error)
+
+  def _start(self, member):
+    """
+    Reserve a slot in the fleet and in `member`, returning false if either
+    has none left.
+    """
+    with self.lock:
+      if self.running >= self.jobs or member.running >= member.jobs:
+        return False
+      self.running += 1
+      member.running += 1
+      return True
+
+  def _finish(self, member):
+    with self.lock:
+      self.running -= 1
+      member.running -= 1
+      self.lock.notify_all()
+
+  def run(self, jobs, **kwargs):
+    """
+    Run each `Job` (or (rootfs, args) pair) in `jobs`. Yields a `JobResult`
+    for each job as it finishes. Stdout and stderr of each job are captured,
+    stdin is /dev/null. Other keyword arguments are passed to `Popen()` for
+    every job. The jobs of one rootfs start in order, and the rootfs trees
+    take turns.
+    """
+    for key in ("stdin", "stdout", "stderr"):
+      if key in kwargs:
+        raise ValueError("run() does not accept {}".format(key))
+
+    # NOTE: all names are resolved first so that a typo fails the batch
+    # before anything runs.
+    queues = collections.OrderedDict()
+    for index, (name, args) in enumerate(jobs):
+      member = self.get(name)
+      queues.setdefault(member, collections.deque()).append((index, args))
+
+    def start_next(num_running):
+      while queues:
+        for member in list(queues):
+          if not self._start(member):
+            continue
+          queue = queues[member]
+          index, args = queue.popleft()
+          # let the other rootfs trees take their turn
+          queues.move_to_end(member)
+          if not queue:
+            del queues[member]
+          try:
+            member.warm()
+            proc = member.container.Popen(
+                args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, **kwargs)
+          except BaseException:
+            self._finish(member)
+            raise
+          return proc, (index, member)
+        if num_running:
+          return None
+        # every free slot is taken by the jobs of another run()
+        with self.lock:
+          self.lock.wait(1.0)
+      return None
+
+    def release(data):
+      self._finish(data[1])
+
+    results = uchroot.run_captured(start_next, release)
+    try:
+      for proc, (index, member), returncode, stdout, stderr in results:
+        yield JobResult(index, member.rootfs, proc.args, returncode, stdout,
+                        stderr)
+    finally:
+      results.close()
+
+  def close(self):
+    """Release the zygotes of all members."""
+    with self.lock:
+      members = list(self.members.values())
+      self.members = {}
+    for member in members:
+      member.close()
+
+
+def warm_member(member):
+  """Warm up `member`, returning the exception if it fails."""
+  try:
+    member.warm()
+  except Exception as err:  # pylint: disable=broad-except
+    return err
+  return None
+
+
+def read_jobs_file(path, fleet):
+  """
+  Return the list of `Job` in the file at `path`, expanding ``*`` to every
+  rootfs of `fleet`.
+  """
+  jobs = []
+  with open(path, "r") as infile:
+    for line in infile:
+      parts = shlex.split(line, comments=True)
+      if len(parts) < 2:
+        continue
+      if parts[0] == "*":
+        jobs.extend(Job(member.rootfs, parts[1:]) for member in fleet.list())
+      else:
+        jobs.append(Job(parts[0], parts[1:]))
+  return jobs
+
+
+def main(argv):
+  command = []
+  if "--" in argv:
+    command = argv[argv.index("--") + 1:]
+    argv = argv[:argv.index("--")]
+
+  parser = argparse.ArgumentParser(prog="uchroot fleet", description=__doc__)
+  parser.add_argument("-j", "--jobs", type=int, default=None,
+                      help="number of jobs to run at once (default: #cpus)")
+  parser.add_argument("-p", "--jobs-per-rootfs", type=int, default=1,
+                      help="number of jobs to run at once in each rootfs")
+  parser.add_argument("-f", "--jobs-file",
+                      help="file of jobs to run, one per line")
+  parser.add_argument("--no-zygote", action="store_true",
+                      help="build a jail for each job instead of joining a "
+                           "zygote for each rootfs")
+  parser.add_argument("paths", nargs="+",
+                      help="rootfs directories, or directories of them")
+  args = parser.parse_args(argv)
+
+  with Fleet(args.paths, args.jobs, args.jobs_per_rootfs,
+             zygote=not args.no_zygote) as fleet:
+    jobs = []
+    if command:
+      jobs.extend(Job(member.rootfs, command) for member in fleet.list())
+    if args.jobs_file:
+      jobs.extend(read_jobs_file(args.jobs_file, fleet))
+    if not jobs:
+      for member in fleet.list():
+        sys.stdout.write("{}\t{}\t{}\n".format(
+            member.name, member.rootfs,
+            member.stamp[0] if member.stamp else "-"))
+      return 0
+
+    start = time.time()
+    failed = 0
+    for result in fleet.run(jobs):
+      if result.returncode != 0:
+        failed += 1
+      sys.stdout.write("==> {} [{}] {} (exit {})\n".format(
+          os.path.basename(result.rootfs), result.index,
+          " ".join(shlex.quote(arg) for arg in result.args),
+          result.returncode))
+      sys.stdout.flush()
+      getattr(sys.stdout, "buffer", sys.stdout).write(result.stdout)
+      getattr(sys.stderr, "buffer", sys.stderr).write(result.stderr)
+      sys.stdout.flush()
+      sys.stderr.flush()
+    logger.info("%d jobs in %d rootfs, %d failed (%.2fs)", len(jobs),
+                len(set(fleet.get(job.rootfs) for job in jobs)), failed,
+                time.time() - start)
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  sys.exit(main(sys.argv[1:]))
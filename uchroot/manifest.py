@@ -0,0 +1,367 @@
+"""
+Incremental manifests of a rootfs tree.
+
+A manifest lists every entry below a rootfs, sorted by path, with its mode,
+size, mtime, inode and (optionally) a hash of its content. It is stored in the
+rootfs itself, next to the ``.uchroot.py`` autoload config, and is used on the
+next scan so that only entries whose stat data changed are hashed again.
+
+Usage::
+
+  uchroot manifest [options] <rootfs>
+
+prints the entries which were added (A), removed (D) or modified (M) since the
+stored manifest, and stores the new one.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import os
+import queue
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Name of the manifest file stored in the root of a rootfs. It is not itself
+# part of the manifest.
+MANIFEST_NAME = ".uchroot.manifest"
+
+# First word of the header line of a manifest file, followed by the format
+# version and the time (ns) at which the scan started
+MANIFEST_MAGIC = "#uchroot-manifest"
+MANIFEST_VERSION = 1
+
+# Margin (ns) by which the clock which stamps the mtime of files may lag
+# behind time.time_ns(), if the rootfs can't be written to ask it: more than
+# a kernel tick at HZ=100
+CLOCK_MARGIN_NS = 20000000
+
+# One entry of a manifest. `mode` is the full st_mode (file type and
+# permissions), and `digest` is the sha256 of the content of a regular file
+# or of the target of a symlink, or None if it wasn't hashed.
+Entry = collections.namedtuple(
+    "Entry", ["path", "mode", "size", "mtime_ns", "inode", "digest"])
+
+# A list of entries sorted by path, and the time (ns) at which the scan that
+# produced them started.
+Manifest = collections.namedtuple("Manifest", ["entries", "timestamp_ns"])
+
+# Sorted lists of the paths which were added, removed or modified between two
+# manifests.
+ManifestDiff = collections.namedtuple(
+    "ManifestDiff", ["added", "removed", "changed"])
+
+
+def get_manifest_path(rootfs):
+  return os.path.join(rootfs, MANIFEST_NAME)
+
+
+def hash_file(path):
+  """Return the hex sha256 digest of the contents of the file at `path`."""
+  digest = hashlib.sha256()
+  with open(path, "rb") as infile:
+    chunk = infile.read(1024 * 1024)
+    while chunk:
+      digest.update(chunk)
+      chunk = infile.read(1024 * 1024)
+  return digest.hexdigest()
+
+
+def hash_entry(rootfs, entry):
+  """
+  Return the digest of a regular file or symlink entry, or None for other
+  entries or if the entry can no longer be read.
+  """
+  path = os.path.join(rootfs, entry.path)
+  try:
+    if stat.S_ISREG(entry.mode):
+      return hash_file(path)
+    if stat.S_ISLNK(entry.mode):
+      return hashlib.sha256(os.fsencode(os.readlink(path))).hexdigest()
+  except (IOError, OSError) as err:
+    logger.warning("Failed to hash %s: %s", path, err)
+  return None
+
+
+def scan_dir(rootfs, relpath):
+  """
+  Return the entries of the directory `relpath` of `rootfs` (unhashed) and
+  the paths of its subdirectories.
+  """
+  entries = []
+  subdirs = []
+  try:
+    dirents = list(os.scandir(os.path.join(rootfs, relpath)))
+  except OSError as err:
+    logger.warning("Failed to scan %s: %s",
+                   os.path.join(rootfs, relpath), err)
+    return entries, subdirs
+
+  for dirent in dirents:
+    path = os.path.join(relpath, dirent.name)
+    if path == MANIFEST_NAME:
+      continue
+    try:
+      dirent_stat = dirent.stat(follow_symlinks=False)
+    except OSError:
+      # removed since it was listed
+      continue
+    entries.append(Entry(path, dirent_stat.st_mode, dirent_stat.st_size,
+                         dirent_stat.st_mtime_ns, dirent_stat.st_ino, None))
+    if stat.S_ISDIR(dirent_stat.st_mode):
+      subdirs.append(path)
+  return entries, subdirs
+
+
+def get_jobs(jobs):
+  """Return the number of threads to use by default for IO bound work."""
+  if jobs is None:
+    return min(32, (os.cpu_count() or 1) + 4)
+  return jobs
+
+
+def scan(rootfs, jobs=None):
+  """
+  Return the (unhashed) entries of the tree at `rootfs`, sorted by path. The
+  directories are scanned by `jobs` threads. Symlinks are not followed.
+  """
+  entries = []
+  dirs = queue.Queue()
+
+  def scan_dirs():
+    relpath = dirs.get()
+    while relpath is not None:
+      try:
+        dir_entries, subdirs = scan_dir(rootfs, relpath)
+        entries.extend(dir_entries)
+        for subdir in subdirs:
+          dirs.put(subdir)
+      finally:
+        dirs.task_done()
+      relpath = dirs.get()
+
+  threads = [threading.Thread(target=scan_dirs)
+             for _ in range(get_jobs(jobs))]
+  for thread in threads:
+    thread.start()
+  dirs.put("")
+  # NOTE: a directory is only done once its subdirectories are queued, so
+  # the queue is only drained once the whole tree has been scanned.
+  dirs.join()
+  for thread in threads:
+    dirs.put(None)
+  for thread in threads:
+    thread.join()
+
+  entries.sort(key=lambda entry: entry.path)
+  return entries
+
+
+def get_timestamp_ns(rootfs):
+  """
+  Return the current time as the filesystem of `rootfs` would stamp a
+  modified file: the mtime of a new file. File mtimes come from the coarse
+  kernel clock (and have the granularity of the filesystem), which lags
+  time.time_ns(). If the rootfs can't be written, return time.time_ns()
+  minus `CLOCK_MARGIN_NS`.
+  """
+  try:
+    fd, path = tempfile.mkstemp(prefix=MANIFEST_NAME + ".stamp-", dir=rootfs)
+  except OSError:
+    return time.time_ns() - CLOCK_MARGIN_NS
+  try:
+    return os.fstat(fd).st_mtime_ns
+  finally:
+    os.close(fd)
+    os.unlink(path)
+
+
+def build_manifest(rootfs, previous=None, hash_contents=True, jobs=None):
+  """
+  Scan the tree at `rootfs` and return its `Manifest`. If `hash_contents` is
+  true, regular files and symlinks are hashed, except those whose stat data
+  is unchanged since the `previous` manifest, which keep their digest.
+  """
+  timestamp_ns = get_timestamp_ns(rootfs)
+  entries = scan(rootfs, jobs)
+  if not hash_contents:
+    return Manifest(entries, timestamp_ns)
+
+  previous_entries = {}
+  if previous is not None:
+    previous_entries = {entry.path: entry for entry in previous.entries}
+
+  to_hash = []
+  for idx, entry in enumerate(entries):
+    if not (stat.S_ISREG(entry.mode) or stat.S_ISLNK(entry.mode)):
+      continue
+    old = previous_entries.get(entry.path)
+    # NOTE: an entry modified within the same mtime tick as (but after) the
+    # previous scan has an unchanged mtime, so entries which are not older
+    # than the previous scan are always hashed again.
+    if (old is not None and old.digest is not None
+        and old[1:5] == entry[1:5]
+        and entry.mtime_ns < previous.timestamp_ns):
+      entries[idx] = entry._replace(digest=old.digest)
+    else:
+      to_hash.append(idx)
+
+  logger.debug("Hashing %d of %d entries", len(to_hash), len(entries))
+  with concurrent.futures.ThreadPoolExecutor(get_jobs(jobs)) as executor:
+    digests = executor.map(lambda idx: hash_entry(rootfs, entries[idx]),
+                           to_hash)
+    for idx, digest in zip(to_hash, digests):
+      entries[idx] = entries[idx]._replace(digest=digest)
+  return Manifest(entries, timestamp_ns)
+
+
+def escape_path(path):
+  return (path.replace("\\", "\\\\").replace("\t", "\\t")
+          .replace("\n", "\\n"))
+
+
+def unescape_path(escaped):
+  out = []
+  chars = iter(escaped)
+  for char in chars:
+    if char == "\\":
+      char = {"t": "\t", "n": "\n"}.get(next(chars), "\\")
+    out.append(char)
+  return "".join(out)
+
+
+def write_manifest(path, manifest):
+  """Atomically write `manifest` to the file at `path`."""
+  tmp_path = "{}.tmp-{}".format(path, os.getpid())
+  with open(tmp_path, "w", encoding="utf-8",
+            errors="surrogateescape") as outfile:
+    outfile.write("{} {} {}\n".format(
+        MANIFEST_MAGIC, MANIFEST_VERSION, manifest.timestamp_ns))
+    for entry in manifest.entries:
+      outfile.write("{:o}\t{}\t{}\t{}\t{}\t{}\n".format(
+          entry.mode, entry.size, entry.mtime_ns, entry.inode,
+          entry.digest or "-", escape_path(entry.path)))
+  os.rename(tmp_path, path)
+
+
+def read_manifest(path):
+  """Read the `Manifest` stored in the file at `path`."""
+  with open(path, "r", encoding="utf-8",
+            errors="surrogateescape") as infile:
+    header = infile.readline().split()
+    if len(header) != 3 or header[0] != MANIFEST_MAGIC:
+      raise ValueError("{} is not a uchroot manifest".format(path))
+    if int(header[1]) != MANIFEST_VERSION:
+      raise ValueError("{} has unsupported manifest version {}"
+                       .format(path, header[1]))
+
+    entries = []
+    for line in infile:
+      mode, size, mtime_ns, inode, digest, entry_path = (
+          line.rstrip("\n").split("\t", 5))
+      entries.append(Entry(unescape_path(entry_path), int(mode, 8), int(size),
+                           int(mtime_ns), int(inode),
+                           None if digest == "-" else digest))
+  return Manifest(entries, int(header[2]))
+
+
+def load_manifest(rootfs, manifest_path=None):
+  """
+  Return the `Manifest` stored for `rootfs` (by default in the rootfs
+  itself), or None if there is none or it can't be read.
+  """
+  manifest_path = manifest_path or get_manifest_path(rootfs)
+  if not os.path.exists(manifest_path):
+    return None
+  try:
+    return read_manifest(manifest_path)
+  except (ValueError, IOError, OSError) as err:
+    logger.warning("Ignoring manifest %s: %s", manifest_path, err)
+    return None
+
+
+def entry_changed(old, new):
+  """
+  Return true if `new` differs from `old`. Entries which both have a digest
+  are compared by content, others by their stat data. A directory only
+  changes with its mode.
+  """
+  if old.mode != new.mode:
+    return True
+  if stat.S_ISDIR(new.mode):
+    return False
+  if old.digest is not None and new.digest is not None:
+    return old.digest != new.digest
+  return old[2:5] != new[2:5]
+
+
+def diff_manifests(old, new):
+  """Return the `ManifestDiff` from manifest `old` to manifest `new`."""
+  old_entries = {entry.path: entry for entry in old.entries}
+  new_entries = {entry.path: entry for entry in new.entries}
+  added = sorted(set(new_entries) - set(old_entries))
+  removed = sorted(set(old_entries) - set(new_entries))
+  changed = sorted(
+      path for path, entry in new_entries.items()
+      if path in old_entries and entry_changed(old_entries[path], entry))
+  return ManifestDiff(added, removed, changed)
+
+
+def update_manifest(rootfs, manifest_path=None, hash_contents=True,
+                    jobs=None, store=True):
+  """
+  Scan `rootfs`, re-using the digests of unchanged entries from its stored
+  manifest, and store the new manifest unless `store` is false. Returns the
+  new manifest and its `ManifestDiff` from the stored one (everything is
+  added if there was none).
+  """
+  manifest_path = manifest_path or get_manifest_path(rootfs)
+  previous = load_manifest(rootfs, manifest_path)
+  manifest = build_manifest(rootfs, previous, hash_contents, jobs)
+  if previous is None:
+    previous = Manifest([], 0)
+  diff = diff_manifests(previous, manifest)
+  if store:
+    write_manifest(manifest_path, manifest)
+  return manifest, diff
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(prog="uchroot manifest",
+                                   description=__doc__)
+  parser.add_argument("-j", "--jobs", type=int, default=None,
+                      help="number of scanning/hashing threads")
+  parser.add_argument("--no-hash", action="store_true",
+                      help="compare stat data only, don't hash contents")
+  parser.add_argument("-m", "--manifest",
+                      help="path of the manifest file (default: {} in the "
+                           "rootfs)".format(MANIFEST_NAME))
+  parser.add_argument("-n", "--dry-run", action="store_true",
+                      help="print the changes but don't store the manifest")
+  parser.add_argument("rootfs", help="path of the rootfs")
+  args = parser.parse_args(argv)
+
+  start = time.time()
+  manifest, diff = update_manifest(
+      args.rootfs, args.manifest, hash_contents=not args.no_hash,
+      jobs=args.jobs, store=not args.dry_run)
+  for tag, paths in (("A", diff.added), ("D", diff.removed),
+                     ("M", diff.changed)):
+    for path in paths:
+      sys.stdout.write("{} {}\n".format(tag, escape_path(path)))
+  logger.info("%d entries, %d added, %d removed, %d modified (%.2fs)",
+              len(manifest.entries), len(diff.added), len(diff.removed),
+              len(diff.changed), time.time() - start)
+  return 0
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,392 @@
+"""
+A persistent uchroot daemon.
+
+``uchroot serve`` keeps a warm `uchroot.Container` (loaded config, mount
+plan, subordinate ids and zygote, see `uchroot.fleet`) for each rootfs it
+has been asked about, and runs commands in them on behalf of clients which
+connect to its unix socket. A command thus only pays for joining the warm
+jail rather than for building it. If the config of a rootfs sets a tmpfs
+``overlay`` or ``pid_namespace`` then each command gets a new jail, as it
+does when run locally.
+
+Usage::
+
+  uchroot serve [options] [<path> ...]
+
+The rootfs trees at the paths are warmed up at startup. Any other rootfs
+directory is loaded on its first request. A rootfs is reloaded when its
+config file changes.
+
+While the daemon is running, ``uchroot <rootfs> [<command> ...]`` (without
+other options) forwards the command to it. The daemon runs it with the
+client's stdin, stdout and stderr, forwards the signals received by the
+client, and the client exits with the exit code of the command. The
+command is not in the client's session, so it has no controlling terminal
+and job control does not reach it. Hence a command whose stdin is a
+terminal (e.g. an interactive shell) always runs locally, as does any
+command given ``--no-daemon``.
+
+The socket is ``$UCHROOT_SOCKET`` if set, otherwise ``uchroot-<uid>.sock``
+in ``$XDG_RUNTIME_DIR`` (or ``$TMPDIR``, or /tmp). Only processes of the
+same user may connect.
+
+Each request (see `uchroot.pool.send_request()`) has the ``rootfs``, the
+``argv`` (None for the configured command), the ``env`` and the ``cwd``
+(None for the configured ones), and carries the three stdio descriptors.
+The client may then send ``{"signal": <signum>}`` requests. The daemon
+replies ``{"returncode": <code>}`` or ``{"error": <message>}``.
+"""
+
+import argparse
+import errno
+import logging
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import threading
+
+import uchroot
+from uchroot import pool
+
+logger = logging.getLogger(__name__)
+
+# Credentials of the peer of a unix socket: pid, uid and gid
+PEERCRED = struct.Struct("3i")
+
+
+def get_socket_path():
+  """Return the path of the socket of the daemon."""
+  socket_path = os.environ.get("UCHROOT_SOCKET")
+  if socket_path:
+    return socket_path
+  runtime_dir = (os.environ.get("XDG_RUNTIME_DIR")
+                 or os.environ.get("TMPDIR") or "/tmp")
+  return os.path.join(runtime_dir, "uchroot-{}.sock".format(os.getuid()))
+
+
+def connect(socket_path=None):
+  """
+  Return a socket connected to the daemon, or None if it is not running.
+  """
+  socket_path = uchroot.get_default(socket_path, get_socket_path())
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(socket_path)
+  except OSError as err:
+    sock.close()
+    if err.errno in (errno.ENOENT, errno.ECONNREFUSED):
+      return None
+    raise
+  return sock
+
+
+def get_peer_uid(sock):
+  _, uid, _ = PEERCRED.unpack(sock.getsockopt(
+      socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED.size))
+  return uid
+
+
+def get_exit_code(returncode):
+  """Return the exit code of a shell for a subprocess `returncode`."""
+  if returncode < 0:
+    return 128 - returncode
+  return returncode
+
+
+class Server(object):
+  """
+  The daemon: serves requests on the unix socket at `socket_path` with the
+  rootfs trees of a `uchroot.fleet.Fleet` of `paths`.
+  """
+
+  def __init__(self, paths=(), socket_path=None, zygote=True):
+    # NOTE: imported here so that the client doesn't pay for it
+    from uchroot import fleet
+
+    self.socket_path = uchroot.get_default(socket_path, get_socket_path())
+    self.fleet = fleet.Fleet(paths, zygote=zygote)
+    self.sock = None
+    self._procs = set()
+    self._lock = threading.Lock()
+
+  def bind(self):
+    """
+    Listen on the socket, replacing a stale socket file. Raises OSError if
+    another daemon is listening.
+    """
+    sock = connect(self.socket_path)
+    if sock is not None:
+      sock.close()
+      raise OSError(errno.EADDRINUSE, "uchroot serve is already running",
+                    self.socket_path)
+    if os.path.exists(self.socket_path):
+      os.unlink(self.socket_path)
+
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+      self.sock.bind(self.socket_path)
+    finally:
+      os.umask(old_umask)
+    self.sock.listen(128)
+
+  def serve_forever(self):
+    """Warm up the fleet and serve requests, each in its own thread."""
+    if self.sock is None:
+      self.bind()
+    self.fleet.warm()
+    logger.info("Serving %d rootfs on %s", len(self.fleet.list()),
+                self.socket_path)
+    sock = self.sock
+    while True:
+      try:
+        conn, _ = sock.accept()
+      except OSError:
+        if self.sock is None:
+          # closed by close()
+          return
+        raise
+      thread = threading.Thread(target=self.handle, args=(conn,),
+                                name="uchroot-serve")
+      thread.daemon = True
+      thread.start()
+
+  def get_member(self, rootfs):
+    """Return the fleet member for `rootfs`, loading or reloading it."""
+    if not os.path.isdir(rootfs):
+      raise ValueError("{} is not a directory".format(rootfs))
+    member = self.fleet.add(rootfs)
+    if member is not None and member.is_stale():
+      logger.info("Reloading the config of %s", member.rootfs)
+      member = self.fleet.reload(member)
+    if member is None:
+      raise ValueError("Failed to load the config of {}".format(rootfs))
+    return member
+
+  def start(self, request, fds):
+    """Start the command of `request` with the stdio descriptors `fds`."""
+    if len(fds) != 3:
+      raise ValueError("expected 3 stdio descriptors, got {}".format(
+          len(fds)))
+    member = self.get_member(request["rootfs"])
+
+    exec_config = {"exbin": None, "argv": None, "env": None}
+    exec_config.update((key, member.config[key]) for key in exec_config
+                       if key in member.config)
+    if request.get("argv"):
+      exec_config["argv"] = request["argv"]
+    if request.get("env") is not None:
+      exec_config["env"] = request["env"]
+    execobj = uchroot.Exec(**exec_config)
+
+    cwd = request.get("cwd") or member.container.cwd
+    if member.needs_own_jail():
+      return self.start_own_jail(member, execobj, cwd, fds)
+
+    kwargs = {}
+    if execobj.exbin != execobj.argv[0]:
+      # NOTE: not supported (nor needed otherwise) with spawn_mode='nsenter'
+      kwargs["executable"] = execobj.exbin
+
+    member.warm()
+    return member.container.Popen(
+        execobj.argv, env=execobj.env, cwd=cwd,
+        stdin=fds[0], stdout=fds[1], stderr=fds[2], **kwargs)
+
+  @staticmethod
+  def start_own_jail(member, execobj, cwd, fds):
+    """
+    Start `execobj` in a new jail of `member`, like a local run would, rather
+    than in its zygote.
+    """
+    import subprocess
+
+    member.container.resolve_ids()
+    preexec_fn = member.container.get_preexec_fn(cwd=cwd)
+    preexec_fn.pid_namespace = member.pid_namespace
+    return subprocess.Popen(
+        execobj.argv, executable=execobj.exbin, env=execobj.env,
+        preexec_fn=preexec_fn, stdin=fds[0], stdout=fds[1], stderr=fds[2])
+
+  def handle(self, conn):
+    """Serve the request of one client."""
+    with conn:
+      if get_peer_uid(conn) != os.getuid():
+        logger.warning("Rejected a client of another user")
+        return
+      fds = []
+      try:
+        request, fds = pool.recv_request(conn)
+        if request is None:
+          return
+        proc = self.start(request, fds)
+      except Exception as err:  # pylint: disable=broad-except
+        logger.debug("Failed to serve a request", exc_info=True)
+        try:
+          pool.send_request(conn, {"error": str(err)}, [])
+        except OSError:
+          pass
+        return
+      finally:
+        for fd in fds:
+          os.close(fd)
+
+      with self._lock:
+        self._procs.add(proc)
+      try:
+        returncode = self.supervise(conn, proc)
+      finally:
+        with self._lock:
+          self._procs.discard(proc)
+      try:
+        pool.send_request(conn, {"returncode": returncode}, [])
+      except OSError:
+        pass
+
+  def supervise(self, conn, proc):
+    """
+    Forward the signals sent by the client on `conn` to `proc` until it
+    exits, and return its exit code. Kills `proc` if the client goes away.
+    """
+    pidfd = None
+    if hasattr(os, "pidfd_open"):
+      pidfd = os.pidfd_open(proc.pid)
+    try:
+      while proc.poll() is None:
+        watched = [conn] if pidfd is None else [conn, pidfd]
+        readable, _, _ = select.select(
+            watched, [], [], None if pidfd is not None else 0.1)
+        if conn not in readable:
+          continue
+        message, fds = pool.recv_request(conn)
+        for fd in fds:
+          os.close(fd)
+        if message is None:
+          logger.debug("Client of %d went away, killing it", proc.pid)
+          proc.kill()
+          return get_exit_code(proc.wait())
+        if "signal" in message:
+          proc.send_signal(message["signal"])
+    finally:
+      if pidfd is not None:
+        os.close(pidfd)
+    return get_exit_code(proc.returncode)
+
+  def close(self):
+    """
+    Stop listening, kill the commands which are still running and release
+    the fleet.
+    """
+    if self.sock is not None:
+      sock, self.sock = self.sock, None
+      # NOTE: shutdown() wakes up a thread blocked in accept()
+      try:
+        sock.shutdown(socket.SHUT_RDWR)
+      except OSError:
+        pass
+      sock.close()
+      os.unlink(self.socket_path)
+    with self._lock:
+      procs = list(self._procs)
+    for proc in procs:
+      proc.kill()
+      proc.wait()
+    self.fleet.close()
+
+
+def get_stdio_fds():
+  """
+  Return our stdio descriptors to send to the daemon, with /dev/null in
+  place of a closed one.
+  """
+  fds = []
+  for fd in range(3):
+    try:
+      os.fstat(fd)
+    except OSError:
+      fd = os.open(os.devnull, os.O_RDWR)
+    fds.append(fd)
+  return fds
+
+
+def forward(rootfs, argv=None, env=None, cwd=None, socket_path=None):
+  """
+  Run `argv` in `rootfs` with our stdio through the daemon, forwarding our
+  signals to it. Returns its exit code, or None if the daemon is not
+  running.
+  """
+  sock = connect(socket_path)
+  if sock is None:
+    return None
+
+  def forward_signal(signum, _):
+    pool.send_request(sock, {"signal": signum}, [])
+
+  with sock:
+    fds = get_stdio_fds()
+    request = {
+        "rootfs": os.path.realpath(rootfs),
+        "argv": argv or None,
+        "env": None if env is None else dict(env),
+        "cwd": cwd,
+    }
+    try:
+      pool.send_request(sock, request, fds)
+    finally:
+      for fd in fds:
+        if fd > 2:
+          os.close(fd)
+
+    signums = [getattr(signal, name) for name in uchroot.FORWARD_SIGNALS]
+    old_handlers = [signal.signal(signum, forward_signal)
+                    for signum in signums]
+    try:
+      reply, _ = pool.recv_request(sock)
+    finally:
+      for signum, old_handler in zip(signums, old_handlers):
+        signal.signal(signum, old_handler)
+
+  if reply is None:
+    logger.error("uchroot serve exited before the command")
+    return 1
+  if "error" in reply:
+    logger.error("uchroot serve failed to run the command: %s",
+                 reply["error"])
+    return 1
+  return reply["returncode"]
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(prog="uchroot serve", description=__doc__)
+  parser.add_argument("--socket", default=None,
+                      help="path of the unix socket (default: {})".format(
+                          get_socket_path()))
+  parser.add_argument("--no-zygote", action="store_true",
+                      help="build a jail for each command instead of joining "
+                           "a zygote for each rootfs")
+  parser.add_argument("paths", nargs="*",
+                      help="rootfs directories, or directories of them, to "
+                           "warm up at startup")
+  args = parser.parse_args(argv)
+
+  def stop(signum, _):
+    raise SystemExit(128 + signum)
+
+  signal.signal(signal.SIGTERM, stop)
+  server = Server(args.paths, args.socket, zygote=not args.no_zygote)
+  try:
+    server.bind()
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.close()
+  return 0
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,363 @@
+"""
+A local, content-addressed cache of rootfs snapshots.
+
+A snapshot is an immutable copy of a rootfs tree. The content of each
+regular file is stored once in the `objects` directory of the store and
+hardlinked (or reflinked) into every snapshot which contains it. A snapshot
+is identified by the hash of the configuration it was built from and of its
+manifest. It can be entered with ``Container(rootfs=snapshot_id)``, which
+mounts it copy-on-write (see the `overlay` option) so that it is never
+modified.
+
+Layout of the store::
+
+  <store>/objects/ab/abcdef...-755   file contents, by sha256 and mode
+  <store>/snapshots/<id>/            the snapshot trees
+  <store>/snapshots/<id>.json        metadata, the mtime is the last use
+  <store>/snapshots/<id>.manifest    one line per entry of the tree
+
+Files are owned by the current user (which is root within a jail), special
+files (devices, fifos, sockets) are not stored, and files which share
+content and mode also share, when hardlinked, the mtime of the first of them
+which was stored.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import time
+
+import uchroot
+from uchroot import manifest
+
+logger = logging.getLogger(__name__)
+
+# Supported values for the `link_mode` of a store:
+#  * "hardlink": files in a snapshot are hardlinks to the stored objects
+#  * "reflink": files in a snapshot are reflinked (or, if the filesystem
+#    doesn't support it, copied) from the stored objects
+LINK_MODES = ['hardlink', 'reflink']
+
+
+def get_default_store_path():
+  """
+  Return the path of the default store: $UCHROOT_SNAPSHOT_DIR if set,
+  otherwise `uchroot/snapshots` in the user's cache directory.
+  """
+  path = os.environ.get("UCHROOT_SNAPSHOT_DIR")
+  if path:
+    return path
+  cache_dir = (os.environ.get("XDG_CACHE_HOME")
+               or os.path.join(os.path.expanduser("~"), ".cache"))
+  return os.path.join(cache_dir, "uchroot", "snapshots")
+
+
+def get_config_key(config):
+  """Return the hex sha256 digest of the (json-serializable) `config`."""
+  serialized = json.dumps(config, sort_keys=True, default=str)
+  return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def make_writable(function, path, _):
+  """onerror handler for shutil.rmtree which makes read-only dirs writable."""
+  parent = os.path.dirname(path)
+  os.chmod(parent, stat.S_IMODE(os.lstat(parent).st_mode) | stat.S_IRWXU)
+  if os.path.isdir(path) and not os.path.islink(path):
+    os.chmod(path, stat.S_IMODE(os.lstat(path).st_mode) | stat.S_IRWXU)
+  function(path)
+
+
+def remove_tree(path):
+  """Remove the tree at `path`, including read-only directories."""
+  shutil.rmtree(path, onerror=make_writable)
+
+
+class SnapshotStore(object):
+  """
+  A directory of rootfs snapshots and the file objects they share. If
+  `budget` (bytes) is given, the least recently used snapshots are evicted
+  whenever the stored objects exceed it, except the one just created.
+  """
+
+  def __init__(self, path=None, budget=None, link_mode=None):
+    self.path = uchroot.get_default(path, get_default_store_path())
+    self.budget = budget
+    self.link_mode = uchroot.get_default(link_mode, 'hardlink')
+    if self.link_mode not in LINK_MODES:
+      raise ValueError("link_mode must be one of {}, not {}".format(
+          ", ".join(LINK_MODES), self.link_mode))
+    self.objects_dir = os.path.join(self.path, "objects")
+    self.snapshots_dir = os.path.join(self.path, "snapshots")
+
+  def get_object_path(self, key):
+    return os.path.join(self.objects_dir, key[:2], key)
+
+  def get_snapshot_path(self, snapshot_id):
+    return os.path.join(self.snapshots_dir, snapshot_id)
+
+  def get_meta_path(self, snapshot_id):
+    return os.path.join(self.snapshots_dir, snapshot_id + ".json")
+
+  def get_manifest_path(self, snapshot_id):
+    return os.path.join(self.snapshots_dir, snapshot_id + ".manifest")
+
+  def add_object(self, path, mode, digest, mtime_ns):
+    """
+    Store the contents of the file at `path`, whose sha256 is `digest`, with
+    permissions `mode` and modification time `mtime_ns`, if they are not
+    already stored. Return the key of the object.
+
+    NOTE: the mtime is not part of the key: an object keeps the mtime of the
+    first file it was stored for, which is shared by its hardlinks.
+    """
+    key = "{}-{:o}".format(digest, mode)
+    object_path = self.get_object_path(key)
+    if not os.path.exists(object_path):
+      object_dir = os.path.dirname(object_path)
+      if not os.path.isdir(object_dir):
+        os.makedirs(object_dir)
+      tmp_path = "{}.tmp-{}".format(object_path, os.getpid())
+      uchroot.copy_file_contents(path, tmp_path)
+      os.chmod(tmp_path, mode)
+      os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+      os.rename(tmp_path, object_path)
+    return key
+
+  def link_object(self, key, dest, entry):
+    """Create `dest` with the contents of the object `key`."""
+    object_path = self.get_object_path(key)
+    if self.link_mode == 'hardlink':
+      try:
+        os.link(object_path, dest)
+        return
+      except OSError:
+        # e.g. EMLINK if the object already has too many links
+        logger.debug("Failed to link %s, copying it instead", object_path)
+
+    uchroot.copy_file_contents(object_path, dest)
+    os.chmod(dest, stat.S_IMODE(entry.mode))
+    os.utime(dest, ns=(entry.mtime_ns, entry.mtime_ns))
+
+  def create(self, rootfs, config=None):
+    """
+    Store a snapshot of the tree at `rootfs`, built from `config` (any
+    json-serializable description, e.g. of the bootstrap configuration).
+    Returns the snapshot id. If an identical snapshot is already stored it
+    is reused. If the rootfs has a stored manifest (see `uchroot.manifest`),
+    only the files which changed since are hashed.
+    """
+    config_key = get_config_key(config)
+    for dirpath in (self.objects_dir, self.snapshots_dir):
+      if not os.path.isdir(dirpath):
+        os.makedirs(dirpath)
+
+    tree = manifest.build_manifest(rootfs, manifest.load_manifest(rootfs))
+    manifest_lines, size = self.get_manifest_lines(rootfs, tree.entries)
+    manifest_text = "".join(line + "\n" for line in manifest_lines)
+    manifest_digest = hashlib.sha256(
+        manifest_text.encode("utf-8", "surrogateescape")).hexdigest()
+    snapshot_id = hashlib.sha256(
+        (config_key + manifest_digest).encode("utf-8")).hexdigest()
+
+    snapshot_path = self.get_snapshot_path(snapshot_id)
+    if os.path.exists(snapshot_path):
+      logger.info("Snapshot %s already exists", snapshot_id)
+      self.touch(snapshot_id)
+      return snapshot_id
+
+    tmp_path = tempfile.mkdtemp(prefix="tmp-", dir=self.snapshots_dir)
+    try:
+      self._copy_tree(rootfs, tree.entries, tmp_path)
+      with open(self.get_manifest_path(snapshot_id), "w",
+                errors="surrogateescape") as outfile:
+        outfile.write(manifest_text)
+      with open(self.get_meta_path(snapshot_id), "w") as outfile:
+        json.dump({
+            "id": snapshot_id,
+            "config": config,
+            "config_key": config_key,
+            "manifest_digest": manifest_digest,
+            "created": time.time(),
+            "entries": len(manifest_lines),
+            "size": size,
+        }, outfile, indent=2, sort_keys=True, default=str)
+      os.rename(tmp_path, snapshot_path)
+    except BaseException:
+      if os.path.exists(tmp_path):
+        remove_tree(tmp_path)
+      raise
+
+    self.touch(snapshot_id)
+    self.evict(keep=(snapshot_id,))
+    return snapshot_id
+
+  @staticmethod
+  def get_manifest_lines(rootfs, entries):
+    """
+    Return the manifest lines of a snapshot of the manifest `entries` of
+    `rootfs`, and the total size of its files.
+    """
+    manifest_lines = []
+    size = 0
+    for entry in entries:
+      mode = stat.S_IMODE(entry.mode)
+      if stat.S_ISDIR(entry.mode):
+        manifest_lines.append("d {:o} {}".format(mode, entry.path))
+      elif stat.S_ISLNK(entry.mode):
+        target = os.readlink(os.path.join(rootfs, entry.path))
+        manifest_lines.append("l {} -> {}".format(entry.path, target))
+      elif stat.S_ISREG(entry.mode) and entry.digest is not None:
+        size += entry.size
+        manifest_lines.append("f {}-{:o} {}".format(
+            entry.digest, mode, entry.path))
+    return manifest_lines, size
+
+  def _copy_tree(self, rootfs, entries, dest):
+    """
+    Copy the manifest `entries` of `rootfs` to `dest`, storing file contents
+    as objects.
+    """
+    dirs = []
+    for entry in entries:
+      src = os.path.join(rootfs, entry.path)
+      dest_path = os.path.join(dest, entry.path)
+      mode = stat.S_IMODE(entry.mode)
+      if stat.S_ISDIR(entry.mode):
+        # NOTE: permissions are set once the directory has been filled
+        os.mkdir(dest_path, 0o700)
+        dirs.append((dest_path, mode, entry))
+      elif stat.S_ISLNK(entry.mode):
+        os.symlink(os.readlink(src), dest_path)
+      elif stat.S_ISREG(entry.mode) and entry.digest is not None:
+        key = self.add_object(src, mode, entry.digest, entry.mtime_ns)
+        self.link_object(key, dest_path, entry)
+      else:
+        logger.warning("Not storing %s", src)
+
+    for dest_path, mode, entry in reversed(dirs):
+      os.chmod(dest_path, mode)
+      os.utime(dest_path, ns=(entry.mtime_ns, entry.mtime_ns))
+
+  def list(self):
+    """Return the metadata of every snapshot, least recently used first."""
+    if not os.path.isdir(self.snapshots_dir):
+      return []
+    metas = []
+    for name in os.listdir(self.snapshots_dir):
+      if not name.endswith(".json"):
+        continue
+      meta_path = os.path.join(self.snapshots_dir, name)
+      with open(meta_path, "r") as infile:
+        meta = json.load(infile)
+      meta["last_used"] = os.stat(meta_path).st_mtime_ns * 1e-9
+      metas.append(meta)
+    return sorted(metas, key=lambda meta: meta["last_used"])
+
+  def lookup(self, prefix):
+    """
+    Return the id of the snapshot whose id starts with `prefix`. Raises
+    KeyError if there isn't exactly one.
+    """
+    matches = []
+    if os.path.isdir(self.snapshots_dir):
+      matches = [name[:-len(".json")]
+                 for name in os.listdir(self.snapshots_dir)
+                 if name.startswith(prefix) and name.endswith(".json")]
+    if len(matches) != 1:
+      raise KeyError("{} snapshots match {}".format(len(matches), prefix))
+    return matches[0]
+
+  def find(self, config):
+    """
+    Return the id of the most recently used snapshot built from `config`, or
+    None if there is none.
+    """
+    config_key = get_config_key(config)
+    for meta in reversed(self.list()):
+      if meta["config_key"] == config_key:
+        return meta["id"]
+    return None
+
+  def touch(self, snapshot_id):
+    """Mark the snapshot as used now."""
+    # NOTE: the implicit "now" of utime() has the (coarse) resolution of the
+    # kernel clock tick, which would make snapshots used in quick succession
+    # indistinguishable
+    now = time.time_ns()
+    os.utime(self.get_meta_path(snapshot_id), ns=(now, now))
+
+  def open(self, prefix):
+    """
+    Return the path of the snapshot whose id starts with `prefix`, and mark
+    it as used.
+    """
+    snapshot_id = self.lookup(prefix)
+    self.touch(snapshot_id)
+    return self.get_snapshot_path(snapshot_id)
+
+  def remove(self, snapshot_id):
+    """Remove a snapshot. Its objects are removed by the next `gc()`."""
+    # NOTE: remove the metadata first, so that a partially removed snapshot
+    # is not found.
+    for path in (self.get_meta_path(snapshot_id),
+                 self.get_manifest_path(snapshot_id)):
+      if os.path.exists(path):
+        os.unlink(path)
+    snapshot_path = self.get_snapshot_path(snapshot_id)
+    if os.path.exists(snapshot_path):
+      remove_tree(snapshot_path)
+
+  def gc(self):
+    """
+    Remove objects which are not used by any snapshot. Return the total
+    size (bytes) of the remaining objects.
+    """
+    used = set()
+    for meta in self.list():
+      with open(self.get_manifest_path(meta["id"]), "r",
+                errors="surrogateescape") as infile:
+        for line in infile:
+          if line.startswith("f "):
+            used.add(line.split(" ", 2)[1])
+
+    size = 0
+    if not os.path.isdir(self.objects_dir):
+      return size
+    for dirname in os.listdir(self.objects_dir):
+      dirpath = os.path.join(self.objects_dir, dirname)
+      for key in os.listdir(dirpath):
+        object_path = os.path.join(dirpath, key)
+        if key in used:
+          size += os.lstat(object_path).st_size
+        else:
+          os.unlink(object_path)
+    return size
+
+  def evict(self, budget=None, keep=()):
+    """
+    Remove least recently used snapshots, except those whose ids are in
+    `keep`, until the stored objects fit within `budget` bytes (default: the
+    budget of the store). Returns the ids of the removed snapshots.
+    """
+    budget = uchroot.get_default(budget, self.budget)
+    if budget is None:
+      return []
+
+    removed = []
+    metas = [meta for meta in self.list() if meta["id"] not in keep]
+    size = self.gc()
+    while size > budget and metas:
+      meta = metas.pop(0)
+      logger.info("Evicting snapshot %s", meta["id"])
+      self.remove(meta["id"])
+      removed.append(meta["id"])
+      size = self.gc()
+    if size > budget and keep:
+      logger.warning("Snapshots %s exceed the budget of %d bytes (%d bytes)",
+                     ", ".join(keep), budget, size)
+    return removed
+
@@ -0,0 +1,336 @@
+"""
+Streaming of the output of jailed commands.
+
+`open_stream()` starts a command in the jail of a container and returns an
+`OutputStream`, which iterates over the chunks (or lines) of its stdout and
+stderr as they arrive, rather than buffering all of the output in memory
+like ``check_output()``. `AsyncOutputStream` is the same for asyncio.
+
+Output is only read from the pipes when the consumer asks for more, so a
+slow consumer makes the command block on a full pipe rather than the output
+pile up in memory. At most `chunk_size` bytes are read from a pipe at a time
+and, in line mode, a line longer than `max_line` bytes is yielded in pieces.
+
+Each of stdout and stderr may also be copied verbatim to a file (a path or a
+binary file object) as it is read, with `stdout_tee` and `stderr_tee`.
+"""
+
+import asyncio
+import collections
+import os
+import selectors
+import subprocess
+
+# Default maximum number of bytes read from a pipe at a time
+CHUNK_SIZE = 0x10000
+
+# Default maximum length of a line, longer lines are split
+MAX_LINE = 0x100000
+
+# A piece of output: `source` is "stdout" or "stderr" and `data` the bytes.
+# In line mode, each chunk is one line including its newline (except for the
+# last line of the output if it has none, and pieces of a line longer than
+# `max_line`).
+Chunk = collections.namedtuple("Chunk", ["source", "data"])
+
+
+class OutputSource(object):
+  """
+  The state of one output pipe of a stream: the partial line (in line mode)
+  and the tee file.
+  """
+
+  def __init__(self, name, lines=False, max_line=MAX_LINE, tee=None):
+    self.name = name
+    self.lines = lines
+    self.max_line = max_line
+    self.partial = b""
+    self.tee = tee
+    self.owns_tee = False
+    if isinstance(tee, str):
+      self.tee = open(tee, "wb")
+      self.owns_tee = True
+
+  def feed(self, data):
+    """Return the list of `Chunk` for `data` read from the pipe."""
+    if self.tee is not None:
+      self.tee.write(data)
+    if not self.lines:
+      return [Chunk(self.name, data)]
+
+    pieces = (self.partial + data).split(b"\n")
+    self.partial = pieces.pop()
+    chunks = [Chunk(self.name, piece + b"\n") for piece in pieces]
+    if len(self.partial) >= self.max_line:
+      chunks.append(Chunk(self.name, self.partial))
+      self.partial = b""
+    return chunks
+
+  def finish(self):
+    """Return the list of remaining `Chunk` once the pipe reached EOF."""
+    self.close()
+    if not self.partial:
+      return []
+    chunks = [Chunk(self.name, self.partial)]
+    self.partial = b""
+    return chunks
+
+  def close(self):
+    if self.tee is None:
+      return
+    if self.owns_tee:
+      self.tee.close()
+    else:
+      self.tee.flush()
+    self.tee = None
+
+
+def make_sources(stdout, stderr, lines, max_line, stdout_tee, stderr_tee):
+  """
+  Return the list of (pipe, `OutputSource`) pairs for the `stdout` and
+  `stderr` pipes of a process, skipping those which are None.
+  """
+  sources = []
+  try:
+    for name, pipe, tee in (("stdout", stdout, stdout_tee),
+                            ("stderr", stderr, stderr_tee)):
+      if pipe is None:
+        continue
+      sources.append((pipe, OutputSource(name, lines, max_line, tee)))
+  except BaseException:
+    for _, source in sources:
+      source.close()
+    raise
+  return sources
+
+
+def get_popen_kwargs(kwargs, stderr_tee):
+  """
+  Validate the subprocess `kwargs` of a stream and set the pipes: stdout is
+  always piped, and stderr is piped unless it is given.
+  """
+  if "stdout" in kwargs:
+    raise ValueError("stdout argument not allowed, it will be overridden.")
+  kwargs["stdout"] = subprocess.PIPE
+  kwargs.setdefault("stderr", subprocess.PIPE)
+  if stderr_tee is not None and kwargs["stderr"] != subprocess.PIPE:
+    raise ValueError("stderr_tee requires stderr to be piped")
+  return kwargs
+
+
+class OutputStream(object):
+  """
+  Iterates over the output of `proc`, a `subprocess.Popen` whose stdout and
+  (optionally) stderr are pipes, yielding `Chunk` as they arrive. The process
+  is reaped when the output ends, and `returncode` is set. If `check` is
+  true, a `subprocess.CalledProcessError` is then raised if it failed.
+
+  Closing the stream (or leaving it as a context manager) before the end of
+  the output kills the process.
+  """
+
+  def __init__(self, proc, lines=False, chunk_size=CHUNK_SIZE,
+               max_line=MAX_LINE, stdout_tee=None, stderr_tee=None,
+               check=False):
+    self.proc = proc
+    self.chunk_size = chunk_size
+    self.check = check
+    self.returncode = None
+    self._ready = collections.deque()
+    self._selector = selectors.DefaultSelector()
+    for pipe, source in make_sources(proc.stdout, proc.stderr, lines,
+                                     max_line, stdout_tee, stderr_tee):
+      self._selector.register(pipe, selectors.EVENT_READ, source)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    while not self._ready:
+      if self._selector is None:
+        raise StopIteration
+      if not self._selector.get_map():
+        self._finish()
+        raise StopIteration
+      for key, _ in self._selector.select():
+        source = key.data
+        data = os.read(key.fd, self.chunk_size)
+        if data:
+          self._ready.extend(source.feed(data))
+        else:
+          self._selector.unregister(key.fileobj)
+          key.fileobj.close()
+          self._ready.extend(source.finish())
+    return self._ready.popleft()
+
+  def _finish(self):
+    self._selector.close()
+    self._selector = None
+    self.returncode = self.proc.wait()
+    if self.check and self.returncode:
+      raise subprocess.CalledProcessError(self.returncode, self.proc.args)
+
+  def wait(self):
+    """Consume the rest of the output and return the exit code."""
+    for _ in self:
+      pass
+    return self.returncode
+
+  def close(self):
+    """Kill the process if its output didn't end yet, and reap it."""
+    if self._selector is None:
+      return
+    for key in list(self._selector.get_map().values()):
+      key.data.close()
+      key.fileobj.close()
+    self._selector.close()
+    self._selector = None
+    self._ready.clear()
+    if self.proc.poll() is None:
+      self.proc.kill()
+    self.returncode = self.proc.wait()
+
+
+def open_stream(container, args, lines=False, chunk_size=CHUNK_SIZE,
+                max_line=MAX_LINE, stdout_tee=None, stderr_tee=None,
+                check=False, **kwargs):
+  """
+  Start `args` in the jail of `container` and return an `OutputStream` of
+  its output. Other keyword arguments are passed to `container.Popen()`.
+  """
+  proc = container.Popen(args, **get_popen_kwargs(kwargs, stderr_tee))
+  try:
+    return OutputStream(proc, lines, chunk_size, max_line, stdout_tee,
+                        stderr_tee, check)
+  except BaseException:
+    proc.kill()
+    proc.wait()
+    raise
+
+
+class AsyncOutputStream(object):
+  """
+  Asynchronously iterates over the output of `args` run in the jail of
+  `container` (see `uchroot.aio`), yielding `Chunk` as they arrive. The
+  process is started by `start()`, when entering the stream as an async
+  context manager, or by the first iteration. The arguments are those of
+  `open_stream()`.
+
+  The event loop reads ahead at most about twice `chunk_size` bytes of each
+  pipe. Tee files are written synchronously.
+  """
+
+  def __init__(self, container, args, lines=False, chunk_size=CHUNK_SIZE,
+               max_line=MAX_LINE, stdout_tee=None, stderr_tee=None,
+               check=False, **kwargs):
+    self.container = container
+    self.args = list(args)
+    self.lines = lines
+    self.chunk_size = chunk_size
+    self.max_line = max_line
+    self.stdout_tee = stdout_tee
+    self.stderr_tee = stderr_tee
+    self.check = check
+    self.kwargs = get_popen_kwargs(kwargs, stderr_tee)
+    self.proc = None
+    self.returncode = None
+    self._ready = collections.deque()
+    # map of each pending read to its pipe and source
+    self._reads = {}
+    self._closed = False
+
+  async def __aenter__(self):
+    await self.start()
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, traceback):
+    await self.close()
+
+  def __aiter__(self):
+    return self
+
+  async def start(self):
+    """Start the process, unless it was already started."""
+    if self.proc is not None or self._closed:
+      return
+    from uchroot import aio  # pylint: disable=import-outside-toplevel
+
+    # NOTE: `limit` bounds the data buffered by each StreamReader before
+    # it stops reading from its pipe.
+    self.proc = await aio.create_subprocess_exec(
+        self.container, *self.args, limit=self.chunk_size, **self.kwargs)
+    try:
+      sources = make_sources(self.proc.stdout, self.proc.stderr, self.lines,
+                             self.max_line, self.stdout_tee, self.stderr_tee)
+    except BaseException:
+      await self.close()
+      raise
+    for reader, source in sources:
+      self._schedule_read(reader, source)
+
+  def _schedule_read(self, reader, source):
+    task = asyncio.ensure_future(reader.read(self.chunk_size))
+    self._reads[task] = (reader, source)
+
+  async def __anext__(self):
+    await self.start()
+    while not self._ready:
+      if self._closed:
+        raise StopAsyncIteration
+      if not self._reads:
+        await self._finish()
+        raise StopAsyncIteration
+      done, _ = await asyncio.wait(
+          list(self._reads), return_when=asyncio.FIRST_COMPLETED)
+      for task in done:
+        reader, source = self._reads.pop(task)
+        data = task.result()
+        if data:
+          self._ready.extend(source.feed(data))
+          self._schedule_read(reader, source)
+        else:
+          self._ready.extend(source.finish())
+    return self._ready.popleft()
+
+  async def _finish(self):
+    self._closed = True
+    self.returncode = await self.proc.wait()
+    if self.check and self.returncode:
+      raise subprocess.CalledProcessError(self.returncode, self.args)
+
+  async def wait(self):
+    """Consume the rest of the output and return the exit code."""
+    async for _ in self:
+      pass
+    return self.returncode
+
+  async def close(self):
+    """Kill the process if its output didn't end yet, and reap it."""
+    if self._closed:
+      return
+    self._closed = True
+    self._ready.clear()
+    if self.proc is not None and self.proc.returncode is None:
+      try:
+        self.proc.kill()
+      except ProcessLookupError:
+        pass
+    # NOTE: the process is only reaped once its pipes reach EOF, so the
+    # output left in them is read and discarded.
+    while self._reads:
+      done, _ = await asyncio.wait(
+          list(self._reads), return_when=asyncio.FIRST_COMPLETED)
+      for task in done:
+        reader, source = self._reads.pop(task)
+        if task.result():
+          self._schedule_read(reader, source)
+        else:
+          source.close()
+    if self.proc is not None:
+      self.returncode = await self.proc.wait()
@@ -0,0 +1,173 @@
+"""
+Tests for uchroot. They build jails of a fake rootfs which exposes the host
+userspace (see `uchroot.benchmark.make_fake_rootfs()`), and are skipped if
+this host can't create them.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import uchroot
+from uchroot import __main__ as uchroot_main
+from uchroot import benchmark
+from uchroot import serve
+
+_CAN_JAIL = None
+
+
+def can_jail():
+  """Return true if this host can build a (single id) jail."""
+  global _CAN_JAIL  # pylint: disable=global-statement
+  if _CAN_JAIL is None:
+    tmpdir = tempfile.mkdtemp(prefix="uchroot-test-")
+    try:
+      rootfs, binds = benchmark.make_fake_rootfs(tmpdir)
+      container = uchroot.Container(rootfs=rootfs, binds=binds,
+                                    idmap="single")
+      _CAN_JAIL = container.call(["true"]) == 0
+    except (OSError, subprocess.SubprocessError):
+      _CAN_JAIL = False
+    finally:
+      shutil.rmtree(tmpdir)
+  return _CAN_JAIL
+
+
+def make_config_rootfs(parent_dir, **config):
+  """
+  Create a fake rootfs under `parent_dir` with a ``.uchroot.py`` config file
+  which sets its binds, a single id and `config`. Return its path.
+  """
+  rootfs, binds = benchmark.make_fake_rootfs(parent_dir)
+  config = dict(config, binds=binds, idmap="single")
+  with open(os.path.join(rootfs, ".uchroot.py"), "w") as outfile:
+    for key, value in sorted(config.items()):
+      outfile.write("{} = {!r}\n".format(key, value))
+  return rootfs
+
+
+class OverlayChangesTest(unittest.TestCase):
+  """Changes tracked in the upper layer of a persistent overlay."""
+
+  def setUp(self):
+    if not can_jail():
+      self.skipTest("Can't build jails on this host")
+    self.tmpdir = tempfile.mkdtemp(prefix="uchroot-test-")
+    rootfs, binds = benchmark.make_fake_rootfs(self.tmpdir)
+    os.makedirs(os.path.join(rootfs, "etc", "sub"))
+    for name in ("c", "d"):
+      with open(os.path.join(rootfs, "etc", "sub", name), "w") as outfile:
+        outfile.write("x\n")
+    self.container = uchroot.Container(
+        rootfs=rootfs, binds=binds, idmap="single", track_changes=True,
+        overlay=os.path.join(self.tmpdir, "overlay"))
+
+  def tearDown(self):
+    self.container.close()
+    shutil.rmtree(self.tmpdir)
+
+  def get_changes(self, script):
+    self.assertEqual(0, self.container.call(["sh", "-c", script]))
+    changes = self.container.last_changes
+    return (changes.created, changes.modified, changes.deleted)
+
+  def test_recreated_after_delete(self):
+    self.assertEqual(
+        ([], [], ["/etc/sub", "/etc/sub/c", "/etc/sub/d"]),
+        self.get_changes("rm -rf /etc/sub"))
+    self.assertEqual(
+        (["/etc/sub", "/etc/sub/c"], [], []),
+        self.get_changes("mkdir /etc/sub; echo z > /etc/sub/c"))
+    self.assertEqual(
+        (["/etc/sub/e"], [], []),
+        self.get_changes("echo z > /etc/sub/e"))
+    self.assertEqual(
+        ([], [], ["/etc/sub", "/etc/sub/c", "/etc/sub/e"]),
+        self.get_changes("rm -rf /etc/sub"))
+
+  def test_recreated_in_one_command(self):
+    self.assertEqual(
+        ([], ["/etc/sub", "/etc/sub/c"], ["/etc/sub/d"]),
+        self.get_changes("rm -rf /etc/sub; mkdir /etc/sub; "
+                         "echo z > /etc/sub/c"))
+
+
+class ServeTest(unittest.TestCase):
+  """A command forwarded to `uchroot serve` behaves like a local run."""
+
+  def setUp(self):
+    if not can_jail():
+      self.skipTest("Can't build jails on this host")
+    self.tmpdir = tempfile.mkdtemp(prefix="uchroot-test-")
+    self.socket_path = os.path.join(self.tmpdir, "uchroot.sock")
+    self.server = serve.Server(socket_path=self.socket_path)
+    self.server.bind()
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def tearDown(self):
+    self.server.close()
+    shutil.rmtree(self.tmpdir)
+
+  def run_forwarded(self, rootfs, argv):
+    returncode = serve.forward(rootfs, argv, socket_path=self.socket_path)
+    self.assertIsNotNone(returncode)
+    return returncode
+
+  def run_local(self, rootfs, argv):
+    env = dict(os.environ, UCHROOT_SOCKET=self.socket_path + ".none",
+               PYTHONPATH=os.path.dirname(os.path.dirname(
+                   os.path.abspath(uchroot.__file__))))
+    return subprocess.call(
+        [sys.executable, "-m", "uchroot", "--no-daemon", rootfs] + argv,
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL, env=env)
+
+  def check_same(self, rootfs, argvs):
+    """Run `argvs` in turn both ways and compare their exit codes."""
+    local = [self.run_local(rootfs, argv) for argv in argvs]
+    forwarded = [self.run_forwarded(rootfs, argv) for argv in argvs]
+    self.assertEqual(local, forwarded)
+    return forwarded
+
+  def test_shared_jail(self):
+    rootfs = make_config_rootfs(self.tmpdir)
+    returncodes = self.check_same(rootfs, [
+        ["sh", "-c", "exit 3"],
+        ["sh", "-c", "mkdir -p /tmp && touch /tmp/foo"],
+        ["test", "-e", "/tmp/foo"]])
+    self.assertEqual([3, 0, 0], returncodes)
+
+  def test_tmpfs_overlay(self):
+    rootfs = make_config_rootfs(self.tmpdir, overlay="tmpfs")
+    returncodes = self.check_same(rootfs, [
+        ["sh", "-c", "touch /foo"],
+        ["test", "-e", "/foo"]])
+    self.assertEqual([0, 1], returncodes)
+    self.assertFalse(os.path.exists(os.path.join(rootfs, "foo")))
+
+  def test_pid_namespace(self):
+    rootfs = make_config_rootfs(self.tmpdir, pid_namespace=True)
+    # NOTE: the command is the child of the init process of the namespace
+    returncodes = self.check_same(rootfs, [["sh", "-c", "exit $$"]])
+    self.assertEqual([2], returncodes)
+
+  def test_subprocess_is_local(self):
+    parser = argparse.ArgumentParser()
+    uchroot_main.setup_parser(parser, uchroot_main.ARG_EXAMPLES)
+    with mock.patch("os.isatty", return_value=False):
+      self.assertTrue(uchroot_main.can_forward(
+          parser.parse_args(["/rootfs", "true"])))
+      self.assertFalse(uchroot_main.can_forward(
+          parser.parse_args(["-s", "/rootfs", "true"])))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,346 @@
+"""
+Resource accounting for the commands run in a jail.
+
+Each accounted process is reaped with wait4(), which reports the resources
+used by the process and by the descendants it waited for. Orphaned
+descendants, which are reaped by someone else, are not included.
+
+Optionally, each command also runs in its own cgroup (v2) below a cgroup
+created for its container. The cgroup of the container lives in a subtree
+delegated to the user, e.g.::
+
+  systemd-run --user --scope -p Delegate=yes <program>
+
+It may be given limits (e.g. ``{"memory.max": "2G", "cpu.max": "50000
+100000"}``) which apply to all of the container's commands together. The
+cgroup of a command covers its whole process tree and reports its cpu.stat,
+memory.peak and io.stat.
+"""
+
+import collections
+import errno
+import itertools
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# The resources used by one command. Times are in seconds, `max_rss` is in
+# KiB and is the largest of the process and the descendants it waited for,
+# and block counts are in units of 512 bytes. `wall_time` runs until the
+# process is reaped (by wait() or poll()), so it includes the time between
+# its exit and a late poll(). `cgroup` is a `CgroupStats`
+# if the command ran in its own cgroup, otherwise None.
+Usage = collections.namedtuple("Usage", [
+    "wall_time", "user_time", "system_time", "max_rss", "minor_faults",
+    "major_faults", "read_blocks", "write_blocks", "voluntary_switches",
+    "involuntary_switches", "cgroup"])
+
+# The statistics of the cgroup of one command. `cpu` maps the keys of
+# cpu.stat to their values, `memory_peak` is in bytes (None if the memory
+# controller or memory.peak is not available), and `io` maps each device
+# ("major:minor") to a dictionary of its io.stat counters.
+CgroupStats = collections.namedtuple(
+    "CgroupStats", ["cpu", "memory_peak", "io"])
+
+# Controllers enabled (if available) for the cgroups of commands
+CGROUP_CONTROLLERS = ("cpu", "io", "memory", "pids")
+
+
+def make_usage(rusage, wall_time, cgroup_stats=None):
+  """Return the `Usage` for a `resource.struct_rusage` from wait4()."""
+  return Usage(wall_time, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss,
+               rusage.ru_minflt, rusage.ru_majflt, rusage.ru_inblock,
+               rusage.ru_oublock, rusage.ru_nvcsw, rusage.ru_nivcsw,
+               cgroup_stats)
+
+
+def read_cgroup_file(path):
+  """Return the content of a cgroup interface file, or None if missing."""
+  try:
+    with open(path, "r") as infile:
+      return infile.read()
+  except (IOError, OSError) as err:
+    if err.errno in (errno.ENOENT, errno.EOPNOTSUPP):
+      return None
+    raise
+
+
+def write_cgroup_file(path, value):
+  with open(path, "w") as outfile:
+    outfile.write(value)
+
+
+def parse_flat_keyed(text):
+  """Parse the "key value" lines of e.g. cpu.stat into a dictionary."""
+  result = {}
+  for line in (text or "").splitlines():
+    key, value = line.split()
+    result[key] = int(value)
+  return result
+
+
+def parse_nested_keyed(text):
+  """
+  Parse the "name key=value ..." lines of e.g. io.stat into a dictionary
+  of dictionaries.
+  """
+  result = {}
+  for line in (text or "").splitlines():
+    parts = line.split()
+    if not parts:
+      continue
+    result[parts[0]] = dict(
+        (key, int(value))
+        for key, value in (part.split("=", 1) for part in parts[1:]))
+  return result
+
+
+class JoinCgroup(object):
+  """
+  A preexec_fn which moves the child into a cgroup, then calls the
+  `next_fn` (e.g. which enters the jail). The cgroup must be joined before
+  the jail is entered, where it would not be reachable.
+  """
+
+  def __init__(self, path, next_fn=None):
+    self.procs_path = os.path.join(path, "cgroup.procs")
+    self.next_fn = next_fn
+
+  def __call__(self):
+    procs_fd = os.open(self.procs_path, os.O_WRONLY)
+    try:
+      # NOTE: "0" is the writing process
+      os.write(procs_fd, b"0")
+    finally:
+      os.close(procs_fd)
+    if self.next_fn is not None:
+      self.next_fn()
+
+
+class CommandCgroup(object):
+  """The cgroup of one command, within the cgroup of its container."""
+
+  def __init__(self, path):
+    self.path = path
+
+  def read_stats(self):
+    """Return the `CgroupStats` of the cgroup."""
+    memory_peak = read_cgroup_file(os.path.join(self.path, "memory.peak"))
+    if memory_peak is not None:
+      memory_peak = int(memory_peak)
+    return CgroupStats(
+        parse_flat_keyed(read_cgroup_file(
+            os.path.join(self.path, "cpu.stat"))),
+        memory_peak,
+        parse_nested_keyed(read_cgroup_file(
+            os.path.join(self.path, "io.stat"))))
+
+  def remove(self):
+    """
+    Remove the cgroup. Returns false if it still has processes (e.g. which
+    the command started in the background), in which case it is left.
+    """
+    try:
+      os.rmdir(self.path)
+    except OSError as err:
+      if err.errno != errno.EBUSY:
+        raise
+      return False
+    return True
+
+
+class JailCgroup(object):
+  """
+  The cgroup of a container, created under the delegated cgroup `parent`,
+  with `limits` (a dictionary mapping interface files to values) written
+  to it. Commands run in cgroups created within it.
+  """
+
+  def __init__(self, parent, limits=None):
+    self.parent = parent
+    self.limits = limits or {}
+    self.path = None
+    self.leftovers = []
+    self._counter = itertools.count()
+    self._lock = threading.Lock()
+
+  def create(self):
+    """Create the cgroup, enable controllers and set the limits."""
+    self.path = tempfile.mkdtemp(prefix="uchroot-", dir=self.parent)
+    available = (read_cgroup_file(
+        os.path.join(self.path, "cgroup.controllers")) or "").split()
+    controllers = [name for name in CGROUP_CONTROLLERS if name in available]
+    missing = [name for name in CGROUP_CONTROLLERS if name not in available]
+    if missing:
+      logger.debug("cgroup controllers %s are not delegated to %s",
+                   ", ".join(missing), self.parent)
+    if controllers:
+      write_cgroup_file(os.path.join(self.path, "cgroup.subtree_control"),
+                        " ".join("+" + name for name in controllers))
+
+    for key, value in sorted(self.limits.items()):
+      try:
+        write_cgroup_file(os.path.join(self.path, key), str(value))
+      except (IOError, OSError) as err:
+        path = self.path
+        os.rmdir(path)
+        self.path = None
+        raise OSError(err.errno, "Failed to set {} of cgroup {} (is the {} "
+                      "controller delegated?)".format(
+                          key, path, key.split(".")[0])) from err
+
+  def make_command_cgroup(self):
+    """Create and return a `CommandCgroup` for a new command."""
+    with self._lock:
+      if self.path is None:
+        self.create()
+    path = os.path.join(self.path, "cmd-{}".format(next(self._counter)))
+    os.mkdir(path)
+    return CommandCgroup(path)
+
+  def release(self, cgroup):
+    """Remove the cgroup of a command which was reaped."""
+    if not cgroup.remove():
+      self.leftovers.append(cgroup)
+
+  def remove(self):
+    """
+    Remove the cgroup, once no command has processes left in it. Returns
+    false if there are, in which case it is left.
+    """
+    if self.path is None:
+      return True
+    self.leftovers = [cgroup for cgroup in self.leftovers
+                      if not cgroup.remove()]
+    if self.leftovers:
+      logger.warning("Not removing cgroup %s, processes are still running "
+                     "in it", self.path)
+      return False
+    os.rmdir(self.path)
+    self.path = None
+    return True
+
+
+class AccountedPopen(subprocess.Popen):
+  """
+  A subprocess.Popen whose wait() and poll() reap the process with wait4()
+  and store its `Usage` in `usage`. If `jail_cgroup` (a `JailCgroup`) is
+  given, the process runs in a cgroup of its own within it. `on_usage` is
+  called with the usage once the process is reaped.
+  """
+
+  def __init__(self, *args, **kwargs):
+    jail_cgroup = kwargs.pop("jail_cgroup", None)
+    self.on_usage = kwargs.pop("on_usage", None)
+    self.usage = None
+    self.jail_cgroup = jail_cgroup
+    self.cgroup = None
+    if jail_cgroup is not None:
+      self.cgroup = jail_cgroup.make_command_cgroup()
+      kwargs["preexec_fn"] = JoinCgroup(self.cgroup.path,
+                                        kwargs.get("preexec_fn"))
+    self._reap_lock = threading.Lock()
+    self._start_time = time.monotonic()
+    try:
+      super(AccountedPopen, self).__init__(*args, **kwargs)
+    except BaseException:
+      if self.cgroup is not None:
+        jail_cgroup.release(self.cgroup)
+      raise
+
+  def poll(self):
+    if self.returncode is None and self._reap_lock.acquire(False):
+      try:
+        if self.returncode is None:
+          self._reap(os.WNOHANG)
+      finally:
+        self._reap_lock.release()
+    return self.returncode
+
+  def wait(self, timeout=None):
+    if timeout is None:
+      with self._reap_lock:
+        if self.returncode is None:
+          self._reap(0)
+      return self.returncode
+
+    deadline = time.monotonic() + timeout
+    delay = 0.0005
+    while self.poll() is None:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        raise subprocess.TimeoutExpired(self.args, timeout)
+      time.sleep(min(delay, remaining))
+      delay = min(delay * 2, 0.05)
+    return self.returncode
+
+  def _reap(self, wait_flags):
+    """Reap the process with wait4() if it exited, see `os.WNOHANG`."""
+    try:
+      pid, status, rusage = os.wait4(self.pid, wait_flags)
+    except ChildProcessError:
+      # reaped elsewhere (e.g. SIGCHLD is ignored)
+      self.returncode = 0
+      return
+    if pid == self.pid:
+      self.returncode = os.waitstatus_to_exitcode(status)
+      self._record_usage(rusage)
+
+  def _record_usage(self, rusage):
+    wall_time = time.monotonic() - self._start_time
+    cgroup_stats = None
+    if self.cgroup is not None:
+      cgroup_stats = self.cgroup.read_stats()
+      self.jail_cgroup.release(self.cgroup)
+    self.usage = make_usage(rusage, wall_time, cgroup_stats)
+    if self.on_usage is not None:
+      self.on_usage(self.usage)
+
+
+# The subprocess interface used by Container when accounting is enabled.
+Popen = AccountedPopen
+
+
+def call(*popenargs, **kwargs):
+  """Like subprocess.call(), but with an `AccountedPopen`."""
+  timeout = kwargs.pop("timeout", None)
+  with AccountedPopen(*popenargs, **kwargs) as proc:
+    try:
+      return proc.wait(timeout=timeout)
+    except BaseException:
+      proc.kill()
+      raise
+
+
+def check_call(*popenargs, **kwargs):
+  """Like subprocess.check_call(), but with an `AccountedPopen`."""
+  returncode = call(*popenargs, **kwargs)
+  if returncode:
+    raise subprocess.CalledProcessError(
+        returncode, kwargs.get("args", popenargs[0] if popenargs else None))
+  return 0
+
+
+def check_output(*popenargs, **kwargs):
+  """Like subprocess.check_output(), but with an `AccountedPopen`."""
+  if "stdout" in kwargs:
+    raise ValueError("stdout argument not allowed, it will be overridden.")
+  timeout = kwargs.pop("timeout", None)
+  data = kwargs.pop("input", None)
+  if data is not None:
+    kwargs["stdin"] = subprocess.PIPE
+  with AccountedPopen(*popenargs, stdout=subprocess.PIPE, **kwargs) as proc:
+    try:
+      output, _ = proc.communicate(data, timeout=timeout)
+    except BaseException:
+      proc.kill()
+      raise
+    returncode = proc.poll()
+  if returncode:
+    raise subprocess.CalledProcessError(returncode, proc.args, output=output)
+  return output